@@ -0,0 +1,63 @@
+"""Transforming polls one vehicle at a time and column-wise with NumPy.
+
+python bench/batch_transform.py --vehicles 1000 10000 100000
+
+"poll" is update_vehicles with a new position for every vehicle, "publish" a publish tick
+that encodes every vehicle again.
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+from common import load_app
+
+
+def results(rng, count, step):
+    ts = 1700000000000 + step * 1000
+    return [{"latitude": [{"ts": ts, "value": str(round(rng.uniform(48.4, 48.9), 6))}],
+        "longitude": [{"ts": ts, "value": str(round(rng.uniform(8.7, 9.4), 6))}],
+        "pax": [{"ts": ts, "value": str(rng.randrange(0, 80))}]} for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    app = load_app()
+    if app.numpy is None:
+        parser.exit(1, "The batch transform needs NumPy\n")
+    app.BATCH_TRANSFORM_MIN_SIZE = 1
+    rng = random.Random(1)
+    print(f"{'vehicles':>8}  {'poll':>9} {'batch':>9}  {'publish':>9} {'batch':>9}   per vehicle")
+    for count in args.vehicles:
+        ids = [f"device-{index:06d}" for index in range(count)]
+        polls = [results(rng, count, step) for step in range(args.rounds)]
+        timings = {}
+        for batch in (False, True):
+            app.BATCH_TRANSFORM = batch
+            client = app.ThingsboardClient()
+            app.thingsboard_client = client
+            transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+            poll_time = publish_time = float("inf")
+            for poll in polls:
+                # the transform prints a line per poll
+                with contextlib.redirect_stdout(io.StringIO()):
+                    started = time.perf_counter()
+                    client.update_vehicles(ids, poll)
+                    poll_time = min(poll_time, time.perf_counter() - started)
+                started = time.perf_counter()
+                transformer.publish_to_mqtt()
+                publish_time = min(publish_time, time.perf_counter() - started)
+                transformer.publisher.queue.queue.clear()
+            timings[batch] = (poll_time, publish_time)
+        (poll, publish), (batch_poll, batch_publish) = timings[False], timings[True]
+        us = lambda seconds: f"{seconds / count * 1e6:7.2f}us"
+        print(f"{count:>8}  {us(poll)} {us(batch_poll)}  {us(publish)} {us(batch_publish)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Polls with one request per device and with bulk entity data queries.
+
+python bench/bulk.py --devices 500 --latency 0.02
+"""
+import argparse
+import os
+
+from common import CPUTimer, MockProcess, latencies, load_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--polls", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds ThingsBoard takes to answer a request")
+    parser.add_argument("--concurrency", type=int, default=8, help="FETCH_CONCURRENCY of the single requests")
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[100, 1000], help="BULK_PAGE_SIZE values to compare")
+    args = parser.parse_args()
+
+    app = load_app()
+    app.FETCH_CONCURRENCY = args.concurrency
+    device_ids = [f"device-{index:05d}" for index in range(args.devices)]
+    with MockProcess(device_ids, delays={id: args.latency for id in device_ids}, query_delay=args.latency) as mock:
+        os.environ["THINGSBOARD_HOST"] = mock.url
+        app.THINGSBOARD_DEVICE_IDS = ",".join(mock.device_ids)
+        print(f"{args.devices} devices, {args.latency * 1000:.0f}ms latency per request")
+        modes = [("device", None, f"single, FETCH_CONCURRENCY={args.concurrency}")]
+        modes += [("bulk", size, f"bulk, BULK_PAGE_SIZE={size}") for size in args.page_sizes]
+        for mode, page_size, name in modes:
+            app.FETCH_MODE = mode
+            app.BULK_PAGE_SIZE = page_size or app.BULK_PAGE_SIZE
+            client = app.ThingsboardClient()
+            client.get_token()
+            mock.clear()
+            polls = []
+            with CPUTimer() as timer:
+                for _ in range(args.polls):
+                    with CPUTimer() as poll:
+                        client.fetch_vehicle_data()
+                    polls.append(poll.wall)
+            client.executor.shutdown()
+            counted = mock.requests()
+            requests = (counted.get("timeseries", 0) + counted.get("query", 0)) / args.polls
+            print(f"{name:<32} {requests:5.0f} requests per poll, poll {latencies(polls)} "
+                f"vehicles={len(client.get_vehicles())} {timer}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Helpers shared by the benchmark scripts."""
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# the scripts are run as python bench/<name>.py from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.mock_thingsboard import MockThingsboard  # noqa: E402
+from tests.support import load_app  # noqa: E402
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def latencies(values, unit=1000, suffix="ms"):
+    """p50/p95/p99/max of values (in seconds) as a line of text."""
+    return " ".join(f"{name}={percentile(values, fraction) * unit:.2f}{suffix}"
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)))
+
+
+def rss_mb():
+    """Peak resident set size of this process in MiB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return usage / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class CPUTimer:
+    """Wall clock and CPU time (user + system) spent in the with block."""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.cpu_started
+
+    def __str__(self):
+        return f"wall={self.wall:.2f}s cpu={self.cpu:.2f}s ({self.cpu / self.wall:.0%})"
+
+
+class MockProcess:
+    """A MockThingsboard in a child process, so that its CPU time isn't counted as ours.
+
+    delays and query_delay are set on the mock before it starts serving.
+    """
+
+    def __init__(self, devices, delays=None, query_delay=0, **options):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.serve, name="mock-thingsboard",
+            args=(child, devices, delays, query_delay, options), daemon=True)
+
+    def __enter__(self):
+        self.process.start()
+        self.url, self.device_ids = self.connection.recv()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.send("stop")
+        self.process.join()
+
+    def requests(self):
+        """The requests the mock counted so far."""
+        self.connection.send("requests")
+        return self.connection.recv()
+
+    def clear(self):
+        self.connection.send("clear")
+
+    @staticmethod
+    def serve(connection, devices, delays, query_delay, options):
+        with MockThingsboard(devices, **options) as mock:
+            mock.delays = delays or {}
+            mock.query_delay = query_delay
+            connection.send((mock.url, mock.device_ids))
+            while True:
+                command = connection.recv()
+                if command == "requests":
+                    connection.send(dict(mock.requests))
+                elif command == "clear":
+                    mock.requests.clear()
+                else:
+                    return
@@ -0,0 +1,52 @@
+"""Polls a mock ThingsBoard and reports how long a poll takes as the fleet grows.
+
+python bench/fetch.py --devices 100 1000 5000 --latency 0.02 --slow 2 --concurrency 4 16 64
+"""
+import argparse
+import os
+import random
+import threading
+
+from common import CPUTimer, MockProcess, latencies, load_app, rss_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[100, 1000], help="fleet sizes to compare")
+    parser.add_argument("--polls", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds ThingsBoard takes to answer")
+    parser.add_argument("--slow", type=int, default=1, help="devices that never answer within the timeout")
+    parser.add_argument("--timeout", type=float, default=1.0, help="FETCH_TIMEOUT")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64], help="FETCH_CONCURRENCY values to compare")
+    args = parser.parse_args()
+
+    app = load_app()
+    app.FETCH_TIMEOUT = args.timeout
+    app.POLL_INTERVAL = 15
+    print(f"{args.latency * 1000:.0f}ms latency, {args.slow} slow devices, FETCH_TIMEOUT={args.timeout}s")
+    for devices in args.devices:
+        device_ids = [f"device-{index:05d}" for index in range(devices)]
+        delays = {id: args.latency for id in device_ids}
+        for id in random.Random(1).sample(device_ids, min(args.slow, devices)):
+            delays[id] = args.timeout * 10
+        with MockProcess(device_ids, delays=delays) as mock:
+            os.environ["THINGSBOARD_HOST"] = mock.url
+            app.THINGSBOARD_DEVICE_IDS = ",".join(mock.device_ids)
+            for concurrency in args.concurrency:
+                app.FETCH_CONCURRENCY = concurrency
+                client = app.ThingsboardClient()
+                client.get_token()
+                polls = []
+                with CPUTimer() as timer:
+                    for _ in range(args.polls):
+                        with CPUTimer() as poll:
+                            client.fetch_vehicle_data()
+                        polls.append(poll.wall)
+                client.executor.shutdown(wait=False, cancel_futures=True)
+                print(f"devices={devices:<6} FETCH_CONCURRENCY={concurrency:<4} poll {latencies(polls)} "
+                    f"vehicles={len(client.get_vehicles())} {timer} threads={threading.active_count()}")
+    print(f"peak rss={rss_mb():.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
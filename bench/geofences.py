@@ -0,0 +1,68 @@
+"""Zone lookups of a fleet with many geofences.
+
+python bench/geofences.py --vehicles 10000 --zones 500
+
+"scan" tests every zone like a lookup without the grid index would, "find" is the lookup
+of the polls with one vehicle at a time and "find_all" the one of the batch transform.
+"""
+import argparse
+import math
+import random
+import time
+
+from common import load_app
+
+
+def zones(app, count, rng):
+    """Octagons of 100 to 500m spread over the Stuttgart region."""
+    result = []
+    for index in range(count):
+        lat, lon = rng.uniform(48.4, 48.9), rng.uniform(8.7, 9.4)
+        radius = rng.uniform(0.001, 0.005)
+        outline = app.Polygon([app.Vec2(lon + radius * 1.5 * math.cos(angle), lat + radius * math.sin(angle))
+            for angle in (step * math.pi / 4 for step in range(8))])
+        result.append(app.Zone(f"zone-{index}", rng.choice(["suppress", "tag", "reduce"]), [(outline, [])]))
+    return result
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--zones", type=int, default=500)
+    parser.add_argument("--cell-sizes", type=float, nargs="+", default=[0.005, 0.01, 0.05], help="GEOFENCE_CELL_SIZE values to compare")
+    args = parser.parse_args()
+
+    app = load_app()
+    rng = random.Random(1)
+    defined = zones(app, args.zones, rng)
+    lats = [rng.uniform(48.4, 48.9) for _ in range(args.vehicles)]
+    lons = [rng.uniform(8.7, 9.4) for _ in range(args.vehicles)]
+    per_vehicle = lambda seconds: f"{seconds / args.vehicles * 1e6:8.2f}us"
+
+    def scan():
+        return [next((zone for zone in defined if zone.contains(lat, lon)), None) for lat, lon in zip(lats, lons)]
+
+    expected, scan_time = timed(scan)
+    print(f"{args.vehicles} vehicles, {args.zones} zones, {sum(zone is not None for zone in expected)} vehicles in a zone")
+    print(f"scan                   {per_vehicle(scan_time)} per vehicle")
+    for cell_size in args.cell_sizes:
+        geofences, build_time = timed(lambda: app.Geofences(defined, cell_size))
+        found, find_time = timed(lambda: [geofences.find(lat, lon) for lat, lon in zip(lats, lons)])
+        assert found == expected
+        line = f"cell size {cell_size:<6} find {per_vehicle(find_time)}"
+        if app.numpy is not None:
+            lat_array, lon_array = app.numpy.array(lats), app.numpy.array(lons)
+            found, find_all_time = timed(lambda: geofences.find_all(lat_array, lon_array))
+            assert found == expected
+            line += f" find_all {per_vehicle(find_all_time)}"
+        print(f"{line}, index of {len(geofences.cells)} cells built in {build_time * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Rendering the JSON payload of a vehicle with MessageToJson and the way the service does.
+
+python bench/json_payload.py --vehicles 1000 --rounds 5
+"""
+import argparse
+import json
+import random
+import time
+
+from common import load_app
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.json_format import MessageToJson
+from tests.test_payloads import random_vehicle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    app = load_app()
+    rng = random.Random(1)
+    vehicles = [random_vehicle(app, rng, index) for index in range(args.vehicles)]
+    app.thingsboard_client = app.ThingsboardClient()
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    header_bytes, header_json = transformer.header_payload()
+    messages = [app.gtfs_realtime_pb2.FeedMessage.FromString(header_bytes + transformer.encode_entity(vehicle)[1])
+        for vehicle in vehicles]
+
+    def message_to_json():
+        for message in messages:
+            MessageToJson(message)
+
+    def entity_json():
+        for vehicle in vehicles:
+            f'{{"header":{header_json},"entity":[{transformer.entity_json(vehicle, vehicle.occupancy)}]}}'
+
+    def stdlib_entity_json():
+        dump_json = app.dump_json
+        app.dump_json = lambda obj: json.dumps(obj, separators=(",", ":"))
+        try:
+            entity_json()
+        finally:
+            app.dump_json = dump_json
+
+    print(f"{args.vehicles} vehicles, {api_implementation.Type()} protobuf implementation")
+    results = {}
+    for name, render in (("MessageToJson", message_to_json), ("entity_json", entity_json),
+            ("entity_json with json", stdlib_entity_json)):
+        rounds = []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            render()
+            rounds.append(time.perf_counter() - started)
+        results[name] = min(rounds) / args.vehicles
+        print(f"{name:<22} {results[name] * 1e6:7.1f}us per vehicle, {results['MessageToJson'] / results[name]:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
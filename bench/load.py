@@ -0,0 +1,112 @@
+"""Runs the service against a mock ThingsBoard with a moving fleet and a fake MQTT client.
+
+python bench/load.py --devices 100 1000 --duration 30 --poll-interval 5
+
+The service polls and publishes on its own schedule like in production, only the MQTT
+broker is replaced by a client that records when every message is sent. Latency is the
+age of a vehicle's telemetry when its message is sent. With several fleet sizes, every
+size runs in a process of its own so that its CPU time and memory are its own.
+"""
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from common import MockProcess, latencies, load_app, rss_mb
+from tests.fake_mqtt import FakeClient
+
+
+class LatencyClient(FakeClient):
+    """Records the age of the telemetry of every vehicle message it sends."""
+
+    def __init__(self, thingsboard):
+        super().__init__(keep=False)
+        self.thingsboard = thingsboard
+        self.latencies = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if topic.startswith("/json/vp/"):
+            vehicle = self.thingsboard.data.get(topic[9:])
+            if vehicle is not None:
+                self.latencies.append(time.time() - vehicle.timestamp / 1000)
+        return super().publish(topic, payload, qos, retain)
+
+
+def run(args):
+    devices = args.devices[0]
+    app = load_app()
+    for name in ("POLL_INTERVAL", "PUBLISH_INTERVAL", "FETCH_CONCURRENCY", "FETCH_MODE", "PUBLISH_ONLY_CHANGES"):
+        setattr(app, name, getattr(args, name.lower()))
+    if args.profile:
+        app.SamplingProfiler(args.profile).start()
+
+    device_ids = [f"device-{index:05d}" for index in range(devices)]
+    with MockProcess(device_ids, delays={id: args.latency for id in device_ids}, query_delay=args.latency,
+            update_interval=args.update_interval) as mock:
+        os.environ["THINGSBOARD_HOST"] = mock.url
+        app.THINGSBOARD_DEVICE_IDS = ",".join(device_ids)
+        client = app.ThingsboardClient()
+        app.thingsboard_client = client
+        polls = []
+        polling = threading.Lock()
+        fetch_vehicle_data = client.fetch_vehicle_data
+
+        def timed_poll():
+            with polling:
+                started = time.perf_counter()
+                fetch_vehicle_data()
+                polls.append(time.perf_counter() - started)
+        client.fetch_vehicle_data = timed_poll
+
+        transformer = app.GTFSRTHTTP2MQTTTransformer({}, {})
+        transformer.mqttConnected = True
+        mqtt = LatencyClient(client)
+        cpu_started, started = time.process_time(), time.monotonic()
+        transformer.publisher.start(mqtt)
+        time.sleep(args.duration)
+        app.scheduler.stop()
+        cpu, wall = time.process_time() - cpu_started, time.monotonic() - started
+        # a poll still running would fail once the mock is gone
+        with polling:
+            pass
+
+    return [
+        f"{devices} devices: {mqtt.sent / wall:.0f} msg/s, {len(mqtt.latencies) / wall:.0f} vehicles/s, "
+            f"cpu={cpu / wall:.0%} rss={rss_mb():.0f}MiB threads={threading.active_count()}",
+        f"  latency {latencies(mqtt.latencies)}",
+        f"  poll    {latencies(polls)} ({len(polls)} polls)",
+        f"  {app.dropped_messages.value} dropped, {app.stale_messages.value} stale, "
+            f"{transformer.publisher.backlog()} queued at the end"
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[1000])
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run every fleet size")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds ThingsBoard takes to answer")
+    parser.add_argument("--update-interval", type=float, default=1, help="seconds between position reports of a vehicle")
+    parser.add_argument("--poll-interval", type=float, default=5, help="POLL_INTERVAL")
+    parser.add_argument("--publish-interval", type=float, default=1, help="PUBLISH_INTERVAL")
+    parser.add_argument("--fetch-concurrency", type=int, default=32, help="FETCH_CONCURRENCY")
+    parser.add_argument("--fetch-mode", choices=["device", "bulk"], default="device", help="FETCH_MODE")
+    parser.add_argument("--publish-only-changes", action="store_true", help="PUBLISH_ONLY_CHANGES")
+    parser.add_argument("--profile", help="write the sampled stacks of the run to this file, like PROFILE_FILE")
+    args = parser.parse_args()
+
+    if len(args.devices) == 1:
+        # the service's own output is not part of the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = run(args)
+        print("\n".join(report))
+        return
+    for devices in args.devices:
+        # the last --devices wins
+        subprocess.run([sys.executable, __file__] + sys.argv[1:] + ["--devices", str(devices)], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Cost of publishing a fleet per vehicle and tick.
+
+python bench/publish.py --vehicles 1000 --ticks 20
+
+"rebuild" builds, serializes and renders every vehicle from scratch on every tick, like
+the service did before it cached the entity payloads. "moved" is a tick in which every
+vehicle has a new position, "unchanged" one in which none has. "websocket" publishes
+updates from a second thread while the ticks run, as in websocket ingestion.
+"""
+import argparse
+import threading
+import time
+
+from common import CPUTimer, latencies, load_app, rss_mb
+
+from google.protobuf.json_format import MessageToJson
+
+
+def rebuild(app, vehicles, publisher):
+    for vehicle in vehicles:
+        nfeedmsg = app.gtfs_realtime_pb2.FeedMessage()
+        nfeedmsg.header.gtfs_realtime_version = "1.0"
+        nfeedmsg.header.incrementality = nfeedmsg.header.DIFFERENTIAL
+        nfeedmsg.header.timestamp = int(time.time())
+        ent = nfeedmsg.entity.add()
+        ent.id = vehicle.id
+        ent.vehicle.trip.trip_id = "unknown-trip-id"
+        ent.vehicle.position.latitude = vehicle.latitude
+        ent.vehicle.position.longitude = vehicle.longitude
+        ent.vehicle.vehicle.id = vehicle.id
+        ent.vehicle.occupancy_status = vehicle.occupancy
+        ent.vehicle.occupancy_percentage = vehicle.occupancy_percentage
+        topic = app.TopicBuilder().topic(vehicle)
+        publisher.publish(topic, nfeedmsg.SerializeToString())
+        publisher.publish(f"/json/vp/{vehicle.id}", MessageToJson(nfeedmsg))
+
+
+def move(client, count, step):
+    for index in range(count):
+        client.data.update(f"bus-{index:05d}", 48.59 + (index + step) * 1e-5, 8.86 + index * 1e-5,
+            index % 40, 0, index % 100, 1700000000000 + step * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--ticks", type=int, default=20)
+    args = parser.parse_args()
+
+    app = load_app()
+    client = app.ThingsboardClient()
+    app.thingsboard_client = client
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    transformer.mqttConnected = True
+    publisher = transformer.publisher
+    move(client, args.vehicles, 0)
+
+    def drain():
+        while not publisher.queue.empty():
+            publisher.queue.get_nowait()
+
+    def report(name, ticks):
+        per_vehicle = sorted(ticks)[len(ticks) // 2] / args.vehicles
+        print(f"{name:<10} {per_vehicle * 1e6:7.1f}us per vehicle, tick {latencies(ticks)}")
+
+    print(f"{args.vehicles} vehicles, {args.ticks} ticks, JSON by {'orjson' if hasattr(app, 'orjson') else 'json'}")
+    for name in ("rebuild", "moved", "unchanged"):
+        ticks = []
+        for step in range(1, args.ticks + 1):
+            if name != "unchanged":
+                move(client, args.vehicles, step)
+            with CPUTimer() as timer:
+                if name == "rebuild":
+                    rebuild(app, client.get_vehicles(), publisher)
+                else:
+                    transformer.publish_to_mqtt()
+            ticks.append(timer.wall)
+            drain()
+        report(name, ticks)
+
+    # ticks with every vehicle moved, while another thread publishes websocket updates
+    stop = threading.Event()
+    updates = []
+
+    def websocket():
+        step = 0
+        while not stop.is_set():
+            step += 1
+            vehicle = client.data.update(f"ws-{step % 500}", 48.6, 8.87 + step * 1e-6, 1, 0, 1, 1700000000000 + step)
+            started = time.perf_counter()
+            transformer.publish_vehicle_update(vehicle)
+            updates.append(time.perf_counter() - started)
+            time.sleep(0.0005)
+
+    thread = threading.Thread(target=websocket)
+    thread.start()
+    ticks = []
+    for step in range(args.ticks + 1, 2 * args.ticks + 1):
+        move(client, args.vehicles, step)
+        with CPUTimer() as timer:
+            transformer.publish_to_mqtt()
+        ticks.append(timer.wall)
+        drain()
+    stop.set()
+    thread.join()
+    report("websocket", ticks)
+    print(f"{'':<10} {len(updates)} updates, publish_vehicle_update {latencies(updates)}")
+    print(f"peak rss={rss_mb():.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
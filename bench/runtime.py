@@ -0,0 +1,98 @@
+"""Polls, transforms and publishes a fleet in the threaded and the asyncio runtime.
+
+python bench/runtime.py --devices 1000 --concurrency 8 64
+
+Both runtimes poll a mock ThingsBoard with one request per device and publish to a fake
+MQTT client. A cycle is a poll, a publish tick and sending all of its messages.
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+import aiohttp
+
+from common import CPUTimer, MockProcess, latencies, load_app, rss_mb
+from tests.fake_mqtt import FakeAsyncClient, FakeClient
+
+
+def threaded(app, args):
+    client = app.ThingsboardClient()
+    app.thingsboard_client = client
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    transformer.mqttConnected = True
+    mqtt = FakeClient(latency=args.publish_latency, keep=False)
+    transformer.publisher.start(mqtt)
+    client.get_token()
+
+    cycles = []
+    with CPUTimer() as timer:
+        for _ in range(args.cycles):
+            with CPUTimer() as cycle:
+                client.fetch_vehicle_data()
+                expected = mqtt.sent + 2 * len(client.data)
+                transformer.publish_to_mqtt()
+                while mqtt.sent < expected:
+                    time.sleep(0.001)
+            cycles.append(cycle.wall)
+    threads = threading.active_count()
+    client.executor.shutdown()
+    return cycles, timer, mqtt.sent, threads
+
+
+async def asyncio_runtime(app, args):
+    client = app.ThingsboardClient()
+    app.thingsboard_client = client
+    runtime = app.AsyncRuntime({}, {})
+    transformer = runtime.transformer
+    transformer.mqttConnected = True
+    runtime.fetch_slots = asyncio.Semaphore(app.FETCH_CONCURRENCY)
+    runtime.publisher = app.AsyncMQTTPublisher()
+    transformer.publisher = runtime.publisher
+    mqtt = FakeAsyncClient(latency=args.publish_latency, keep=False)
+    publishing = asyncio.create_task(runtime.publisher.run(mqtt))
+    await asyncio.to_thread(client.get_token)
+
+    cycles = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=app.FETCH_CONCURRENCY)) as session:
+        with CPUTimer() as timer:
+            for _ in range(args.cycles):
+                with CPUTimer() as cycle:
+                    await runtime.fetch_vehicle_data(session)
+                    expected = mqtt.sent + 2 * len(client.data)
+                    transformer.publish_to_mqtt()
+                    while mqtt.sent < expected:
+                        await asyncio.sleep(0.001)
+                cycles.append(cycle.wall)
+    publishing.cancel()
+    return cycles, timer, mqtt.sent, threading.active_count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds ThingsBoard takes to answer")
+    parser.add_argument("--publish-latency", type=float, default=0, help="seconds every MQTT publish takes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 64], help="FETCH_CONCURRENCY values to compare")
+    args = parser.parse_args()
+
+    app = load_app()
+    device_ids = [f"device-{index:05d}" for index in range(args.devices)]
+    with MockProcess(device_ids, delays={id: args.latency for id in device_ids}) as mock:
+        os.environ["THINGSBOARD_HOST"] = mock.url
+        app.THINGSBOARD_DEVICE_IDS = ",".join(mock.device_ids)
+        print(f"{args.devices} devices, {args.latency * 1000:.0f}ms latency, {args.cycles} cycles")
+        for concurrency in args.concurrency:
+            app.FETCH_CONCURRENCY = concurrency
+            for name, run in (("threaded", lambda: threaded(app, args)),
+                    ("asyncio", lambda: asyncio.run(asyncio_runtime(app, args)))):
+                cycles, timer, sent, threads = run()
+                print(f"{name:<8} FETCH_CONCURRENCY={concurrency:<4} cycle {latencies(cycles)} "
+                    f"{sent / timer.wall:6.0f} msg/s {timer} threads={threads}")
+    print(f"peak rss={rss_mb():.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
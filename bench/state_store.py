@@ -0,0 +1,93 @@
+"""Memory and time per vehicle of the vehicle state store at different fleet sizes.
+
+python bench/state_store.py --vehicles 1000 10000 100000
+
+"dicts" is a list with a dict per vehicle, like the service kept its vehicles before it
+had the store.
+"""
+import argparse
+import gc
+import itertools
+import time
+import tracemalloc
+
+from common import load_app
+
+
+def fill_store(app, count, step):
+    store = app.VehicleStateStore()
+    store.update_many([(f"bus-{index:06d}", 48.59 + index * 1e-6, 8.86 + step * 1e-6, index % 60, 1, index % 100,
+        1700000000000 + step, None, None) for index in range(count)])
+    return store
+
+
+def fill_dicts(count, step):
+    return [{"id": f"bus-{index:06d}", "latitude": 48.59 + index * 1e-6, "longitude": 8.86 + step * 1e-6,
+        "pax": index % 60, "occupancy": 1, "occupancy_percentage": index % 100, "timestamp": 1700000000000 + step,
+        "zone": None, "trip": None} for index in range(count)]
+
+
+def allocated(build):
+    """What build returns and the bytes it keeps allocated."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    app = load_app()
+    print(f"{'vehicles':>8}  {'store':>9} {'dicts':>9}  {'update':>8} {'unchanged':>9} {'snapshot':>8} {'iterate':>8} {'dicts':>8}")
+    for count in args.vehicles:
+        store, store_size = allocated(lambda: fill_store(app, count, 0))
+        dicts, dicts_size = allocated(lambda: fill_dicts(count, 0))
+        # every vehicle moved, then none did
+        updates = [[(f"bus-{index:06d}", 48.59 + index * 1e-6, 8.86 + step * 1e-6, index % 60, 1, index % 100,
+            1700000000000 + step, None, None) for index in range(count)] for step in range(1, 6)]
+        moved = iter(updates)
+        update = timed(lambda: store.update_many(next(moved)))
+        unchanged = timed(lambda: store.update_many(updates[-1]))
+
+        changes = itertools.count()
+
+        def snapshot():
+            # a change, so that the snapshot is copied
+            store.update("bus-000000", 48.59, 8.86, 0, 1, 0, next(changes))
+            store.snapshot()
+        snapshot_time = timed(snapshot)
+
+        vehicles = store.values()
+
+        def iterate():
+            for vehicle in vehicles:
+                (vehicle.id, vehicle.latitude, vehicle.longitude, vehicle.pax, vehicle.timestamp, vehicle.version)
+
+        def iterate_dicts():
+            for vehicle in dicts:
+                (vehicle["id"], vehicle["latitude"], vehicle["longitude"], vehicle["pax"], vehicle["timestamp"])
+
+        per_vehicle = lambda seconds: f"{seconds / count * 1e9:6.0f}ns"
+        print(f"{count:>8}  {store_size / count:7.0f}B {dicts_size / count:7.0f}B  {per_vehicle(update)} "
+            f"{per_vehicle(unchanged):>9} {per_vehicle(snapshot_time)} {per_vehicle(timed(iterate))} {per_vehicle(timed(iterate_dicts))}")
+    print("bytes and times per vehicle: update with all vehicles moved, unchanged, copying the snapshot, "
+        "reading the fields of all vehicles from the store and from dicts")
+
+
+if __name__ == "__main__":
+    main()
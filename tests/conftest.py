@@ -0,0 +1,34 @@
+import pytest
+
+from tests.mock_thingsboard import MockThingsboard
+from tests.support import load_app
+
+
+@pytest.fixture(scope="session")
+def app():
+    return load_app()
+
+
+@pytest.fixture
+def mock():
+    with MockThingsboard() as thingsboard:
+        yield thingsboard
+
+
+@pytest.fixture
+def client(app, mock, monkeypatch):
+    """A ThingsboardClient polling the devices of the mock ThingsBoard."""
+    monkeypatch.setenv("THINGSBOARD_HOST", mock.url)
+    monkeypatch.setattr(app, "THINGSBOARD_DEVICE_IDS", ",".join(mock.device_ids))
+    client = app.ThingsboardClient()
+    yield client
+    client.executor.shutdown(wait=False, cancel_futures=True)
+
+
+@pytest.fixture
+def transformer(app, client, monkeypatch):
+    """A transformer publishing the vehicles of client, without polling or MQTT."""
+    monkeypatch.setattr(app, "thingsboard_client", client)
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    transformer.mqttConnected = True
+    return transformer
@@ -0,0 +1,182 @@
+"""Stand-ins for the MQTT clients the service publishes with."""
+import asyncio
+import itertools
+import threading
+import time
+from collections import Counter, deque
+
+
+class MessageInfo:
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+class FakeClient:
+    """Records what is published instead of sending it.
+
+    latency is how long every publish takes, like a client whose socket is full, and
+    rc the result code publish returns.
+    """
+
+    def __init__(self, latency=0, rc=0, keep=True):
+        self.latency = latency
+        self.rc = rc
+        # all (time.monotonic(), topic, payload, qos, retain) if keep, otherwise just counted
+        self.keep = keep
+        self.messages = []
+        self.topics = Counter()
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.mids = itertools.count(1)
+        self.max_inflight = None
+        self.max_queued = None
+        self.on_publish = None
+        # paho's buffer of packets not yet written to the socket, empty as if written at once
+        self._out_packet = deque()
+
+    def max_inflight_messages_set(self, inflight):
+        self.max_inflight = inflight
+
+    def max_queued_messages_set(self, queue_size):
+        self.max_queued = queue_size
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.record(topic, payload, qos, retain)
+
+    def record(self, topic, payload, qos, retain):
+        with self.lock:
+            if self.rc == 0:
+                self.sent += 1
+                self.topics[topic] += 1
+                if self.keep:
+                    self.messages.append((time.monotonic(), topic, payload, qos, retain))
+            return MessageInfo(self.rc, next(self.mids))
+
+    def published(self, prefix=""):
+        with self.lock:
+            return [message for message in self.messages if message[1].startswith(prefix)]
+
+
+class StalledClient(FakeClient):
+    """A FakeClient whose socket takes nothing, accepted messages wait until write."""
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = super().publish(topic, payload, qos, retain)
+        with self.lock:
+            self._out_packet.append(info.mid)
+        return info
+
+    def write(self, count):
+        """Writes the first count messages and tells the publisher like paho does."""
+        for _ in range(count):
+            with self.lock:
+                mid = self._out_packet.popleft()
+            self.on_publish(self, None, mid)
+
+
+class FakeAsyncClient(FakeClient):
+    """Like FakeClient, with the awaitable publish of the asyncio MQTT client."""
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.record(topic, payload, qos, retain)
+
+
+class FakeBroker:
+    """An in-process broker with retained messages and last wills.
+
+    Messages queue up until deliver, which hands them to the subscribed clients one after
+    the other, including the ones sent by the callbacks, like paho's network thread does.
+    """
+
+    def __init__(self):
+        self.retained = {}
+        self.clients = []
+        self.pending = []
+        self.lock = threading.RLock()
+
+    def client(self):
+        return BrokerClient(self)
+
+    def send(self, topic, payload, retain):
+        payload = payload.encode() if isinstance(payload, str) else payload or b""
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            self.pending.extend((client, topic, payload) for client in self.clients)
+
+    def deliver(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                client, topic, payload = self.pending.pop(0)
+            client.receive(topic, payload)
+
+
+class BrokerMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class BrokerClient(FakeClient):
+    """A FakeClient connected to a FakeBroker, with the subscriptions and will of paho's client."""
+
+    def __init__(self, broker):
+        super().__init__()
+        self.broker = broker
+        self.callbacks = {}
+        self.subscriptions = set()
+        self.will = None
+        self.connected = False
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, retain)
+
+    def connect(self):
+        with self.broker.lock:
+            self.connected = True
+            self.broker.clients.append(self)
+
+    def subscribe(self, topic, qos=0):
+        with self.broker.lock:
+            self.subscriptions.add(topic)
+            if topic in self.broker.retained:
+                self.broker.pending.append((self, topic, self.broker.retained[topic]))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = super().publish(topic, payload, qos, retain)
+        if self.connected:
+            self.broker.send(topic, payload, retain)
+        return info
+
+    def disconnect(self):
+        self.drop()
+
+    def crash(self):
+        """Loses the connection without a goodbye, the broker sends the will."""
+        self.drop()
+        if self.will is not None:
+            self.broker.send(*self.will)
+
+    def drop(self):
+        with self.broker.lock:
+            self.connected = False
+            self.subscriptions.clear()
+            self.broker.clients.remove(self)
+            self.broker.pending = [message for message in self.broker.pending if message[0] is not self]
+
+    def receive(self, topic, payload):
+        if topic in self.subscriptions and topic in self.callbacks:
+            self.callbacks[topic](self, None, BrokerMessage(topic, payload))
@@ -0,0 +1,363 @@
+"""A stand-in for the parts of the ThingsBoard REST API the service uses.
+
+Every device drives around Herrenberg on a circle of its own and reports a new position
+every update_interval seconds. Requests are counted, and devices can be made slow to
+answer to see how the service copes with them. The telemetry websocket pushes the new
+positions of subscribed devices.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import math
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def jwt(expires, id):
+    # unsigned, the service only reads the exp claim
+    def encode(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+    return f"{encode({'alg': 'none'})}.{encode({'exp': expires, 'jti': id})}.signature"
+
+
+class MockThingsboard:
+    def __init__(self, devices=4, update_interval=1.0, delays=None, token_lifetime=3600):
+        if isinstance(devices, int):
+            devices = [f"device-{index:05d}" for index in range(devices)]
+        self.device_ids = list(devices)
+        self.indexes = {id: index for index, id in enumerate(self.device_ids)}
+        # HTTP status answered to all requests of a kind, like "devices", instead of the result
+        self.failures = {}
+        # device type and customer id of the devices that don't have the defaults
+        self.types = {}
+        self.customers = {}
+        self.update_interval = update_interval
+        # seconds the telemetry request of a device is held before it is answered
+        self.delays = dict(delays or {})
+        # seconds every entity data query is held before it is answered
+        self.query_delay = 0
+        # server attributes by device id
+        self.attributes = {}
+        self.token_lifetime = token_lifetime
+        self.tokens = set()
+        self.token_ids = itertools.count()
+        # requests by kind, and by kind and device id for the per-device ones
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        # open telemetry websockets
+        self.websockets = set()
+        handler = type("Handler", (RequestHandler,), {"thingsboard": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/api"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="mock-thingsboard", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.close_websockets()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, kind, id=None):
+        with self.lock:
+            self.requests[kind if id is None else (kind, id)] += 1
+
+    def issue_token(self):
+        with self.lock:
+            token = jwt(int(time.time()) + self.token_lifetime, next(self.token_ids))
+            self.tokens.add(token)
+        return {"token": token, "refreshToken": f"refresh-{token}"}
+
+    def add_device(self, id, type="bus", customer=None):
+        with self.lock:
+            self.device_ids.append(id)
+            self.indexes[id] = len(self.indexes)
+            self.types[id] = type
+            self.customers[id] = customer
+
+    def remove_device(self, id):
+        with self.lock:
+            self.device_ids.remove(id)
+            del self.indexes[id]
+
+    def devices(self, page, page_size, type=None, customer=None):
+        """A page of the device list, like /api/tenant/devices returns it."""
+        with self.lock:
+            devices = [id for id in self.device_ids if (type is None or self.types.get(id, "bus") == type)
+                and (customer is None or self.customers.get(id) == customer)]
+        data = devices[page * page_size:(page + 1) * page_size]
+        return {
+            "data": [{"id": {"entityType": "DEVICE", "id": id}, "name": id, "type": self.types.get(id, "bus")} for id in data],
+            "totalPages": -(-len(devices) // page_size),
+            "totalElements": len(devices),
+            "hasNext": (page + 1) * page_size < len(devices)
+        }
+
+    def query(self, query):
+        """A page of the result of an entity data query with an entityList filter."""
+        link = query["pageLink"]
+        page, page_size = link["page"], link["pageSize"]
+        with self.lock:
+            ids = [id for id in query["entityFilter"]["entityList"] if id in self.indexes]
+        data = []
+        for id in ids[page * page_size:(page + 1) * page_size]:
+            latest = {}
+            for value in query.get("latestValues", []):
+                if value["type"] == "TIME_SERIES":
+                    ts, found = self.latest(id, [value["key"]]).get(value["key"], (0, ""))
+                else:
+                    found = self.attributes.get(id, {}).get(value["key"])
+                    ts, found = (int(time.time() * 1000), str(found)) if found is not None else (0, "")
+                # keys without a value come back with an empty one
+                latest.setdefault(value["type"], {})[value["key"]] = {"ts": ts, "value": found}
+            data.append({"entityId": {"entityType": "DEVICE", "id": id}, "latest": latest})
+        return {
+            "data": data,
+            "totalPages": -(-len(ids) // page_size),
+            "totalElements": len(ids),
+            "hasNext": (page + 1) * page_size < len(ids)
+        }
+
+    def close_websockets(self):
+        """Drops all websocket connections, like a restart of ThingsBoard would."""
+        with self.lock:
+            websockets = list(self.websockets)
+        for websocket in websockets:
+            websocket.close()
+
+    def subscriptions(self):
+        """Device id by subscription id of all open websockets."""
+        with self.lock:
+            return [dict(websocket.subscriptions) for websocket in self.websockets]
+
+    def telemetry(self, id, now=None):
+        """Timestamp (in ms), latitude, longitude and pax the device reports at now."""
+        now = time.time() if now is None else now
+        tick = int(now // self.update_interval)
+        index = self.indexes[id]
+        angle = index * 0.7 + tick * 0.01
+        radius = 0.005 + index % 50 * 0.0005
+        return (int(tick * self.update_interval * 1000), round(48.596 + radius * math.sin(angle), 6),
+            round(8.870 + radius * math.cos(angle), 6), (index * 7 + tick) % 60)
+
+    def latest(self, id, keys):
+        """(ts, value) by key, values are strings like ThingsBoard returns them."""
+        ts, latitude, longitude, pax = self.telemetry(id)
+        values = {"latitude": latitude, "longitude": longitude, "pax": pax}
+        return {key: (ts, str(values[key])) for key in keys if key in values}
+
+    def timeseries(self, id, keys):
+        return {key: [{"ts": ts, "value": value}] for key, (ts, value) in self.latest(id, keys).items()}
+
+
+class TelemetryWebsocket:
+    """Server side of a websocket of the telemetry plugin, frames per RFC 6455."""
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, thingsboard, connection):
+        self.thingsboard = thingsboard
+        self.connection = connection
+        # device id and keys by subscription id
+        self.subscriptions = {}
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+
+    @classmethod
+    def accept_key(cls, key):
+        return base64.b64encode(hashlib.sha1((key + cls.GUID).encode()).digest()).decode()
+
+    def send(self, payload, opcode=0x1):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack("!H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(payload))
+        with self.send_lock:
+            self.connection.sendall(header + payload)
+
+    def receive(self, rfile):
+        """Opcode and payload of the next frame, the client's frames are always masked."""
+        first, second = rfile.read(2)
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack("!H", rfile.read(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", rfile.read(8))
+        mask = rfile.read(4) if second & 0x80 else bytes(4)
+        payload = rfile.read(length)
+        return first & 0x0f, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    def push(self, cmd_id, id, keys):
+        latest = self.thingsboard.latest(id, keys)
+        message = {"subscriptionId": cmd_id, "errorCode": 0, "errorMsg": None,
+            "data": {key: [[ts, value]] for key, (ts, value) in latest.items()},
+            "latestValues": {key: ts for key, (ts, value) in latest.items()}}
+        self.send(json.dumps(message).encode())
+
+    def command(self, commands):
+        for command in commands.get("tsSubCmds", []):
+            cmd_id = command["cmdId"]
+            if command.get("unsubscribe"):
+                self.subscriptions.pop(cmd_id, None)
+            elif command["entityId"] not in self.thingsboard.indexes:
+                self.send(json.dumps({"subscriptionId": cmd_id, "errorCode": 4,
+                    "errorMsg": "Entity not found", "data": {}}).encode())
+            else:
+                keys = command.get("keys", "").split(",")
+                self.subscriptions[cmd_id] = (command["entityId"], keys)
+                # the latest values right away, then whenever they change
+                self.push(cmd_id, command["entityId"], keys)
+
+    def publish(self):
+        tick = int(time.time() // self.thingsboard.update_interval)
+        while not self.closed.wait((tick + 1) * self.thingsboard.update_interval - time.time()):
+            tick += 1
+            try:
+                for cmd_id, (id, keys) in list(self.subscriptions.items()):
+                    self.push(cmd_id, id, keys)
+            except OSError:
+                return
+
+    def serve(self, rfile):
+        threading.Thread(target=self.publish, name="mock-websocket", daemon=True).start()
+        try:
+            while not self.closed.is_set():
+                opcode, payload = self.receive(rfile)
+                if opcode == 0x1:
+                    self.command(json.loads(payload))
+                elif opcode == 0x9:
+                    self.send(payload, opcode=0xa)
+                elif opcode == 0x8:
+                    self.send(payload[:2], opcode=0x8)
+                    break
+        except (OSError, ValueError):
+            # closed by either side
+            pass
+        finally:
+            self.closed.set()
+
+    def close(self):
+        self.closed.set()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    thingsboard = None
+    # keeps connections open like ThingsBoard does, so the client's pool is used
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting for a slow answer
+            pass
+
+    def failed(self, kind):
+        status = self.thingsboard.failures.get(kind)
+        if status is not None:
+            self.send_json(status, {"message": "Internal server error", "errorCode": 2})
+        return status is not None
+
+    def authorized(self):
+        header = self.headers.get("X-Authorization", "")
+        if header.startswith("Bearer ") and header[7:] in self.thingsboard.tokens:
+            return True
+        self.send_json(401, {"message": "Authentication failed", "errorCode": 10})
+        return False
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlparse(self.path).path
+        if path == "/api/auth/login":
+            self.thingsboard.count("login")
+            self.send_json(200, self.thingsboard.issue_token())
+        elif path == "/api/auth/token":
+            self.thingsboard.count("refresh")
+            self.send_json(200, self.thingsboard.issue_token())
+        elif path == "/api/entitiesQuery/find":
+            self.thingsboard.count("query")
+            if not self.authorized() or self.failed("query"):
+                return
+            time.sleep(self.thingsboard.query_delay)
+            self.send_json(200, self.thingsboard.query(body))
+        else:
+            self.send_json(404, {"message": f"No route for {path}"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.split("/")
+        if url.path == "/api/ws/plugins/telemetry":
+            self.thingsboard.count("websocket")
+            if query.get("token", [""])[0] not in self.thingsboard.tokens:
+                self.send_json(401, {"message": "Authentication failed", "errorCode": 10})
+                return
+            self.upgrade()
+        elif url.path.startswith("/api/plugins/telemetry/DEVICE/") and url.path.endswith("/values/timeseries"):
+            id = parts[5]
+            self.thingsboard.count("timeseries")
+            self.thingsboard.count("timeseries", id)
+            if not self.authorized():
+                return
+            time.sleep(self.thingsboard.delays.get(id, 0))
+            if id not in self.thingsboard.indexes:
+                self.send_json(404, {"message": f"Device {id} not found"})
+                return
+            self.send_json(200, self.thingsboard.timeseries(id, query.get("keys", [""])[0].split(",")))
+        elif url.path == "/api/tenant/devices" or (url.path.startswith("/api/customer/") and url.path.endswith("/devices")):
+            self.thingsboard.count("devices")
+            if not self.authorized() or self.failed("devices"):
+                return
+            customer = parts[3] if parts[2] == "customer" else None
+            self.send_json(200, self.thingsboard.devices(int(query["page"][0]), int(query["pageSize"][0]),
+                query.get("type", [None])[0], customer))
+        else:
+            self.send_json(404, {"message": f"No route for {url.path}"})
+
+    def upgrade(self):
+        websocket = TelemetryWebsocket(self.thingsboard, self.connection)
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocket.accept_key(self.headers["Sec-WebSocket-Key"]))
+        self.end_headers()
+        self.wfile.flush()
+        with self.thingsboard.lock:
+            self.thingsboard.websockets.add(websocket)
+        try:
+            websocket.serve(self.rfile)
+        finally:
+            with self.thingsboard.lock:
+                self.thingsboard.websockets.discard(websocket)
+            self.close_connection = True
@@ -0,0 +1,35 @@
+"""Loads the service script as a module for the tests and benchmarks."""
+import importlib.util
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "thingsboard-to-gtfsrt-mqtt.py")
+MODULE = "thingsboard_to_gtfsrt_mqtt"
+
+# read when the module is imported, the tests point their own clients at a mock ThingsBoard
+os.environ.setdefault("THINGSBOARD_HOST", "http://127.0.0.1:9/api")
+os.environ.setdefault("THINGSBOARD_USERNAME", "tenant@thingsboard.org")
+os.environ.setdefault("THINGSBOARD_PASSWORD", "tenant")
+
+
+def load_app():
+    """The service module, imported once per process."""
+    if MODULE not in sys.modules:
+        # gtfs_realtime_pb2 is imported from next to the script
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        spec = importlib.util.spec_from_file_location(MODULE, SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[MODULE] = module
+        spec.loader.exec_module(module)
+    return sys.modules[MODULE]
+
+
+def wait_for(condition, timeout=5):
+    """Whether condition became true within timeout seconds, for the tests of background threads."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+import requests
+
+from tests.test_publish import drain, vehicle
+
+AGGREGATE_TOPIC = "/gtfsrt/full"
+
+
+@pytest.fixture
+def aggregating(app, transformer, monkeypatch):
+    monkeypatch.setattr(app, "AGGREGATE_TOPIC", AGGREGATE_TOPIC)
+    return transformer
+
+
+@pytest.fixture
+def server(app, transformer):
+    server = app.ThreadingHTTPServer(("127.0.0.1", 0), app.FeedRequestHandler)
+    server.transformer = transformer
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def decode(app, payload):
+    return app.gtfs_realtime_pb2.FeedMessage.FromString(payload)
+
+
+def aggregates(transformer):
+    return [message for message in drain(transformer) if message[1] == AGGREGATE_TOPIC]
+
+
+def test_aggregate_holds_every_vehicle(app, aggregating, client):
+    for step in range(3):
+        vehicle(client, f"bus-{step}", step)
+
+    aggregating.publish_to_mqtt()
+
+    feed = decode(app, aggregating.aggregate_payload())
+    assert feed.header.incrementality == feed.header.FULL_DATASET
+    assert feed.header.gtfs_realtime_version == "1.0"
+    assert [entity.id for entity in feed.entity] == ["bus-0", "bus-1", "bus-2"]
+    assert feed.entity[1].vehicle.position.latitude == pytest.approx(48.5901, abs=1e-5)
+    [(enqueued_at, topic, payload, qos, retain)] = aggregates(aggregating)
+    assert retain and payload == aggregating.aggregate_payload()
+
+
+def test_aggregate_is_only_rebuilt_after_a_change(app, aggregating, client):
+    vehicle(client, "bus-1")
+    vehicle(client, "bus-2")
+    aggregating.publish_to_mqtt()
+    first = aggregating.aggregate
+    drain(aggregating)
+
+    aggregating.publish_to_mqtt()
+
+    assert aggregating.aggregate is first
+    assert aggregates(aggregating) == []
+
+    vehicle(client, "bus-2", 5)
+    aggregating.publish_to_mqtt()
+
+    assert aggregating.aggregate is not first
+    assert len(aggregates(aggregating)) == 1
+    position = decode(app, aggregating.aggregate_payload()).entity[1].vehicle.position
+    assert position.latitude == pytest.approx(48.5905, abs=1e-5)
+
+    # a vehicle no longer reported is dropped from the feed
+    client.data.retain({"bus-1"})
+    aggregating.publish_to_mqtt()
+
+    assert [entity.id for entity in decode(app, aggregating.aggregate_payload()).entity] == ["bus-1"]
+
+
+def test_http_serves_the_aggregate(app, transformer, client, server, monkeypatch):
+    # the aggregate is only built when it is published or served
+    monkeypatch.setattr(app, "HTTP_PORT", "0")
+    assert requests.get(f"{server}/gtfs-rt/vehicle-positions.pb").status_code == 503
+
+    vehicle(client, "bus-1")
+    transformer.publish_to_mqtt()
+    response = requests.get(f"{server}/gtfs-rt/vehicle-positions.pb")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-protobuf"
+    assert [entity.id for entity in decode(app, response.content).entity] == ["bus-1"]
+
+
+def test_http_serves_metrics(server):
+    response = requests.get(f"{server}/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE publishes_suppressed counter" in response.text
+    assert requests.get(f"{server}/feed").status_code == 404
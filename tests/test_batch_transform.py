@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+
+def poll(rng, ids, step):
+    """Telemetry of a poll, some devices without any and some unchanged since the last one."""
+    results = []
+    for index, id in enumerate(ids):
+        if index % 17 == 0:
+            results.append(None)
+            continue
+        ts = 1700000000000 + (0 if index % 5 == 0 else step * 1000)
+        # every 50th vehicle is at the bus depot, which is suppressed by default
+        lat, lon = (48.649, 8.817) if index % 50 == 0 else (rng.uniform(-60, 60), rng.uniform(-170, 170))
+        results.append({"latitude": [{"ts": ts, "value": str(round(lat, 6))}],
+            "longitude": [{"ts": ts - index % 3, "value": str(round(lon, 6))}],
+            "pax": [{"ts": ts, "value": str(rng.randrange(0, 120))}]})
+    return results
+
+
+def states(client):
+    return {vehicle.id: (vehicle.latitude, vehicle.longitude, vehicle.pax, vehicle.occupancy,
+        vehicle.occupancy_percentage, vehicle.timestamp, vehicle.zone.name if vehicle.zone else None, vehicle.trip)
+        for vehicle in client.get_vehicles()}
+
+
+def test_batch_and_scalar_transform_agree(app, client, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_TRANSFORM_MIN_SIZE", 1)
+    ids = [f"device-{index:05d}" for index in range(1500)]
+    capacities = {id: app.CapacityRegistry.parse({"seated": 20 + index % 40, "standing": index % 30})
+        for index, id in enumerate(ids[::7])}
+    scalar = app.ThingsboardClient()
+    for each in (client, scalar):
+        each.capacities.update(capacities)
+
+    rng = random.Random(1)
+    for step in range(3):
+        results = poll(rng, ids, step)
+        monkeypatch.setattr(app, "BATCH_TRANSFORM", True)
+        client.update_vehicles(ids, results)
+        monkeypatch.setattr(app, "BATCH_TRANSFORM", False)
+        scalar.update_vehicles(ids, results)
+
+        assert states(client) == states(scalar)
+        assert len(states(client)) == 1500 - 89 - 28
+
+
+def test_geohashes_match_geohash(app):
+    rng = random.Random(1)
+    positions = [(rng.uniform(-89, 89), rng.uniform(-179, 179)) for _ in range(5000)]
+    positions += [(48.6, 8.87), (-0.0005, -0.0005), (0.1, 0.1), (48.999999, 8.9999995)]
+    lats = numpy.array([lat for lat, lon in positions])
+    lons = numpy.array([lon for lat, lon in positions])
+
+    assert app.TopicBuilder.geohashes(lats, lons) == [app.TopicBuilder.geohash(lat, lon) for lat, lon in positions]
+
+
+def test_batch_encoding_publishes_the_same(app, client, transformer, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_TRANSFORM_MIN_SIZE", 1)
+    ids = [f"device-{index:05d}" for index in range(300)]
+    client.update_vehicles(ids, poll(random.Random(1), ids, 1))
+
+    def encoded(batch):
+        # topic, entity bytes and entity JSON per vehicle, the header changes every second
+        monkeypatch.setattr(app, "BATCH_TRANSFORM", batch)
+        transformer.payloads.clear()
+        transformer.publish_to_mqtt()
+        return dict(transformer.payloads)
+
+    batch = encoded(True)
+    assert len(batch) == 277
+    assert batch == encoded(False)
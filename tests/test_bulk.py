@@ -0,0 +1,69 @@
+import pytest
+
+
+@pytest.fixture
+def bulk(app, monkeypatch):
+    monkeypatch.setattr(app, "FETCH_MODE", "bulk")
+    monkeypatch.setattr(app, "BULK_PAGE_SIZE", 3)
+
+
+def states(client):
+    return {vehicle.id: (vehicle.latitude, vehicle.longitude, vehicle.pax, vehicle.timestamp)
+        for vehicle in client.get_vehicles()}
+
+
+def test_bulk_gives_same_vehicles_as_single_requests(app, client, mock, monkeypatch):
+    for index in range(4, 10):
+        mock.add_device(f"device-{index:05d}")
+    client.device_ids = list(mock.device_ids)
+    # a position that doesn't change between the two polls
+    mock.update_interval = 3600
+    client.fetch_vehicle_data()
+    single = states(client)
+    client.data.retain(set())
+
+    monkeypatch.setattr(app, "FETCH_MODE", "bulk")
+    monkeypatch.setattr(app, "BULK_PAGE_SIZE", 3)
+    client.fetch_vehicle_data()
+
+    assert states(client) == single
+    assert len(single) == 10
+    # 10 devices, 3 per page
+    assert mock.requests["query"] == 4
+
+
+def test_devices_without_telemetry_are_skipped(client, mock, bulk):
+    client.device_ids = mock.device_ids + ["unknown"]
+
+    client.fetch_vehicle_data()
+
+    assert sorted(states(client)) == mock.device_ids
+
+
+def test_vehicles_of_a_failed_query_are_dropped(client, mock, bulk):
+    client.fetch_vehicle_data()
+    mock.failures["query"] = 500
+
+    client.fetch_vehicle_data()
+
+    assert states(client) == {}
+
+
+def test_expired_token_is_renewed(client, mock, bulk):
+    client.fetch_vehicle_data()
+    mock.tokens.clear()
+
+    client.fetch_vehicle_data()
+
+    assert mock.requests["login"] == 2
+    assert sorted(states(client)) == mock.device_ids
+
+
+def test_capacity_attributes(app, client, mock, bulk):
+    mock.attributes = {mock.device_ids[0]: {"seatedCapacity": 20, "standingCapacity": 10},
+        mock.device_ids[1]: {"seatedCapacity": 0}}
+
+    client.fetch_capacities()
+
+    assert client.capacities.get(mock.device_ids[0]) == (20, 10)
+    assert client.capacities.get(mock.device_ids[1]) == client.capacities.default
@@ -0,0 +1,160 @@
+import json
+import os
+import stat
+import time
+
+import pytest
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "checkpoint.json")
+
+
+@pytest.fixture
+def restarted(app):
+    """Builds clients like a restarted service would, with the same environment."""
+    clients = []
+
+    def build():
+        clients.append(app.ThingsboardClient())
+        return clients[-1]
+
+    yield build
+    for client in clients:
+        client.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def vehicles(client):
+    return sorted((vehicle.id, vehicle.latitude, vehicle.longitude, vehicle.pax, vehicle.timestamp)
+        for vehicle in client.data.values())
+
+
+def rewrite(path, **changes):
+    with open(path) as f:
+        state = json.load(f)
+    state.update(changes)
+    with open(path, "w") as f:
+        json.dump(state, f)
+
+
+def test_round_trip(app, client, mock, path, restarted):
+    client.fetch_vehicle_data()
+    app.Checkpoint(path, client).save()
+    requests = sum(mock.requests.values())
+
+    restored = restarted()
+    assert app.Checkpoint(path, restored).restore()
+
+    assert vehicles(restored) == vehicles(client) and len(vehicles(client)) == 4
+    assert (restored.token, restored.token_refresh) == (client.token, client.token_refresh)
+    assert restored.token_expiry == client.token_expiry
+    # nothing was asked from ThingsBoard
+    assert sum(mock.requests.values()) == requests
+    # it holds the token
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_restored_vehicles_are_derived_again(app, client, path, restarted):
+    client.fetch_vehicle_data()
+    vehicle = client.data.get("device-00000")
+    app.Checkpoint(path, client).save()
+
+    restored = restarted()
+    restored.capacities.configured["device-00000"] = (1, 0)
+    restored.capacities.update({})
+    app.Checkpoint(path, restored).restore()
+
+    assert restored.data.get("device-00000").occupancy == restored.capacities.occupancy("device-00000", vehicle.pax)[0]
+
+
+@pytest.mark.parametrize("version", [None, 0, 2])
+def test_other_version_is_ignored(app, client, path, restarted, version):
+    client.fetch_vehicle_data()
+    app.Checkpoint(path, client).save()
+    rewrite(path, version=version)
+
+    restored = restarted()
+
+    assert not app.Checkpoint(path, restored).restore()
+    assert vehicles(restored) == [] and restored.token is None
+
+
+def test_old_checkpoint_is_ignored(app, client, path, restarted):
+    client.fetch_vehicle_data()
+    app.Checkpoint(path, client).save()
+    rewrite(path, written=time.time() - 301)
+
+    restored = restarted()
+
+    assert not app.Checkpoint(path, restored, max_age=300).restore()
+    assert vehicles(restored) == []
+    assert app.Checkpoint(path, restored, max_age=600).restore()
+
+
+def test_missing_or_broken_checkpoint(app, client, path):
+    assert not app.Checkpoint(path, client).restore()
+
+    with open(path, "w") as f:
+        f.write('{"version": 1, "writ')
+
+    assert not app.Checkpoint(path, client).restore()
+
+
+@pytest.mark.parametrize("discovery", [True, False])
+def test_discovered_devices(app, client, mock, path, restarted, monkeypatch, discovery):
+    monkeypatch.setattr(app, "DEVICE_DISCOVERY", discovery)
+    mock.add_device("device-00004")
+    client.discover_devices()
+    assert "device-00004" in client.device_ids
+    app.Checkpoint(path, client).save()
+
+    restored = restarted()
+    app.Checkpoint(path, restored).restore()
+
+    # without discovery the configured devices count
+    assert ("device-00004" in restored.device_ids) == discovery
+    assert ("device-00004" in restored.all_device_ids) == discovery
+
+
+@pytest.mark.parametrize("attributes", [True, False])
+def test_capacities_read_from_thingsboard(app, client, path, restarted, monkeypatch, attributes):
+    monkeypatch.setattr(app, "CAPACITY_ATTRIBUTES", attributes)
+    client.capacities.update({"device-00001": (20, 30)})
+    app.Checkpoint(path, client).save()
+
+    restored = restarted()
+    app.Checkpoint(path, restored).restore()
+
+    assert (restored.capacities.get("device-00001") == (20, 30)) == attributes
+
+
+def test_vehicles_of_other_shards_are_skipped(app, client, path, restarted, monkeypatch):
+    client.fetch_vehicle_data()
+    app.Checkpoint(path, client).save()
+    monkeypatch.setattr(app, "SHARD_INDEX", 1)
+    monkeypatch.setattr(app, "SHARD_COUNT", 2)
+
+    restored = restarted()
+    app.Checkpoint(path, restored).restore()
+
+    owned = [vehicle for vehicle in vehicles(client) if restored.shard.owns(vehicle[0])]
+    assert 0 < len(owned) < 4
+    assert vehicles(restored) == owned
+
+
+def test_vehicles_in_suppress_zones_are_skipped(app, client, path, restarted):
+    client.fetch_vehicle_data()
+    app.Checkpoint(path, client).save()
+    vehicle = client.data.get("device-00002")
+    # the zone was added to the geofences since the checkpoint was written
+    lat, lon = vehicle.latitude, vehicle.longitude
+    outline = app.Polygon([app.Vec2(lon - 1e-4, lat - 1e-4), app.Vec2(lon + 1e-4, lat - 1e-4),
+        app.Vec2(lon + 1e-4, lat + 1e-4), app.Vec2(lon - 1e-4, lat + 1e-4)])
+
+    restored = restarted()
+    restored.geofences = app.Geofences([app.Zone("yard", "suppress", [(outline, [])])])
+    app.Checkpoint(path, restored).restore()
+
+    assert [vehicle[0] for vehicle in vehicles(restored)] == ["device-00000", "device-00001", "device-00003"]
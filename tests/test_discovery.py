@@ -0,0 +1,71 @@
+import pytest
+
+
+@pytest.fixture
+def discovery(app, client, monkeypatch):
+    monkeypatch.setattr(app, "DEVICE_PAGE_SIZE", 3)
+    changes = []
+    client.device_listeners.append(lambda added, removed: changes.append((sorted(added), sorted(removed))))
+    return changes
+
+
+def test_pages_through_all_devices(client, mock, discovery):
+    for index in range(4, 11):
+        mock.add_device(f"device-{index:05d}")
+
+    client.discover_devices()
+
+    assert client.device_ids == mock.device_ids
+    # 11 devices, 3 per page
+    assert mock.requests["devices"] == 4
+    assert discovery == [(mock.device_ids[4:], [])]
+
+
+def test_added_and_removed_devices_are_diffed(client, mock, discovery):
+    client.fetch_vehicle_data()
+    removed = mock.device_ids[0]
+    mock.remove_device(removed)
+    mock.add_device("device-new")
+
+    client.discover_devices()
+
+    assert client.device_ids == mock.device_ids
+    assert discovery == [(["device-new"], [removed])]
+    assert client.data.get(removed) is None
+    client.fetch_vehicle_data()
+    assert client.data.get("device-new") is not None
+
+
+def test_unchanged_fleet_is_not_reported(client, discovery):
+    client.discover_devices()
+
+    assert discovery == []
+
+
+def test_filters_by_type(app, client, mock, discovery, monkeypatch):
+    monkeypatch.setattr(app, "THINGSBOARD_DEVICE_TYPE", "bus")
+    mock.add_device("tram-1", type="tram")
+
+    client.discover_devices()
+
+    assert "tram-1" not in client.device_ids
+    assert discovery == []
+
+
+def test_customer_devices(app, client, mock, discovery, monkeypatch):
+    monkeypatch.setattr(app, "THINGSBOARD_CUSTOMER_ID", "customer-1")
+    mock.add_device("bus-of-customer", customer="customer-1")
+
+    client.discover_devices()
+
+    assert client.device_ids == ["bus-of-customer"]
+
+
+def test_failed_discovery_keeps_devices(client, mock, discovery):
+    devices = list(client.device_ids)
+    mock.failures["devices"] = 500
+
+    client.discover_devices()
+
+    assert client.device_ids == devices
+    assert discovery == []
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import aiohttp
+
+
+def polled(client):
+    return sorted(vehicle.id for vehicle in client.get_vehicles())
+
+
+def test_poll_fetches_all_devices(client, mock):
+    client.fetch_vehicle_data()
+
+    assert polled(client) == mock.device_ids
+    ts, latitude, longitude, pax = mock.telemetry(mock.device_ids[0])
+    vehicle = client.data.get(mock.device_ids[0])
+    assert (vehicle.latitude, vehicle.longitude, vehicle.pax) == (latitude, longitude, pax)
+    assert mock.requests["login"] == 1
+
+
+def test_slow_device_is_not_retried(app, client, mock, monkeypatch):
+    monkeypatch.setattr(app, "FETCH_TIMEOUT", 0.5)
+    slow = mock.device_ids[1]
+    mock.delays[slow] = 3
+
+    started = time.monotonic()
+    client.fetch_vehicle_data()
+
+    # one timeout, not one per retry
+    assert time.monotonic() - started < 2
+    assert mock.requests["timeseries", slow] == 1
+    assert polled(client) == [id for id in mock.device_ids if id != slow]
+
+
+def test_poll_gives_up_on_devices_when_next_poll_is_due(app, client, mock, monkeypatch):
+    monkeypatch.setattr(app, "FETCH_TIMEOUT", 5)
+    monkeypatch.setattr(app, "POLL_INTERVAL", 0.5)
+    slow = mock.device_ids[2]
+    mock.delays[slow] = 2
+
+    started = time.monotonic()
+    client.fetch_vehicle_data()
+
+    assert time.monotonic() - started < 1.5
+    assert polled(client) == [id for id in mock.device_ids if id != slow]
+
+
+def test_asyncio_poll_gives_up_on_devices_when_next_poll_is_due(app, client, mock, monkeypatch):
+    monkeypatch.setattr(app, "thingsboard_client", client)
+    monkeypatch.setattr(app, "FETCH_TIMEOUT", 5)
+    monkeypatch.setattr(app, "POLL_INTERVAL", 0.5)
+    runtime = app.AsyncRuntime({}, {})
+    slow = mock.device_ids[1]
+    mock.delays[slow] = 2
+    failures = app.fetch_failures.value
+
+    async def poll():
+        # one at a time, so the devices after the slow one wait behind it
+        runtime.fetch_slots = asyncio.Semaphore(1)
+        async with aiohttp.ClientSession() as session:
+            await runtime.fetch_vehicle_data(session)
+
+    started = time.monotonic()
+    asyncio.run(poll())
+
+    assert time.monotonic() - started < 1.5
+    assert polled(client) == mock.device_ids[:1]
+    assert app.fetch_failures.value - failures == 3
+
+
+def test_expired_token_is_renewed(client, mock):
+    client.fetch_vehicle_data()
+    mock.tokens.clear()
+
+    client.fetch_vehicle_data()
+
+    assert mock.requests["login"] == 2
+    assert polled(client) == mock.device_ids
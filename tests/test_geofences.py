@@ -0,0 +1,136 @@
+import json
+import random
+
+import pytest
+
+
+def square(lon, lat, size):
+    return [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+
+
+def feature(coordinates, type="Polygon", **properties):
+    return {"type": "Feature", "properties": properties, "geometry": {"type": type, "coordinates": coordinates}}
+
+
+@pytest.fixture
+def geofences(app, tmp_path):
+    path = tmp_path / "geofences.json"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        feature([square(8.80, 48.60, 0.01)], name="depot"),
+        # a ring with a hole in the middle
+        feature([[square(8.85, 48.60, 0.03), square(8.86, 48.61, 0.01)]], type="MultiPolygon", name="centre", action="tag"),
+        # overlaps the centre, which comes first
+        feature([square(8.87, 48.60, 0.03)], name="station", action="reduce", publish_interval=60),
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [8.9, 48.6]}}
+    ]}))
+    return app.Geofences.load(str(path))
+
+
+def test_load(geofences):
+    assert [(zone.name, zone.action) for zone in geofences.zones] == [
+        ("depot", "suppress"), ("centre", "tag"), ("station", "reduce")]
+    assert geofences.zones[2].publish_interval == 60
+
+
+@pytest.mark.parametrize("lat, lon, expected", [
+    (48.605, 8.805, "depot"),
+    (48.605, 8.855, "centre"),
+    # in the hole of the centre
+    (48.615, 8.865, None),
+    # where the centre and the station overlap
+    (48.605, 8.875, "centre"),
+    (48.605, 8.895, "station"),
+    (48.5, 8.805, None)
+])
+def test_find(geofences, lat, lon, expected):
+    zone = geofences.find(lat, lon)
+
+    assert (zone.name if zone else None) == expected
+
+
+def test_find_all_matches_find(geofences):
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(1)
+    lats = numpy.array([rng.uniform(48.59, 48.64) for _ in range(2000)])
+    lons = numpy.array([rng.uniform(8.79, 8.91) for _ in range(2000)])
+
+    assert geofences.find_all(lats, lons) == [geofences.find(lat, lon) for lat, lon in zip(lats, lons)]
+
+
+@pytest.mark.parametrize("interval", ["30", True, 0, -5, [30]])
+def test_publish_interval_must_be_a_positive_number(app, interval):
+    with pytest.raises(ValueError, match="publish_interval"):
+        app.Zone("station", "reduce", [], interval)
+
+
+def test_unknown_action(app):
+    with pytest.raises(ValueError, match="Unknown action"):
+        app.Zone("station", "hide", [], None)
+
+
+def report(client, positions, ts=1700000000000):
+    """Polls the vehicles at the positions (lat, lon) by id."""
+    client.update_vehicles(list(positions), [{key: [{"ts": ts, "value": str(value)}]
+        for key, value in (("latitude", lat), ("longitude", lon), ("pax", 10))} for lat, lon in positions.values()])
+
+
+def published(transformer):
+    return [topic for enqueued_at, topic, payload, qos, retain in transformer.publisher.queue.queue if topic.startswith("/json")]
+
+
+def age(transformer, seconds):
+    """Moves the last publish of every vehicle seconds into the past."""
+    transformer.published = {id: (state, at - seconds) for id, (state, at) in transformer.published.items()}
+
+
+def test_actions(transformer, client, geofences):
+    client.geofences = geofences
+    report(client, {"in-depot": (48.605, 8.805), "in-centre": (48.605, 8.855), "at-station": (48.605, 8.895),
+        "elsewhere": (48.5, 8.805)})
+
+    assert client.data.get("in-depot") is None
+    transformer.publish_to_mqtt()
+    assert sorted(published(transformer)) == ["/json/vp/at-station", "/json/vp/elsewhere", "/json/vp/in-centre"]
+    assert geofences.zones[0].vehicles is None
+    assert [zone.vehicles.value for zone in geofences.zones[1:]] == [1, 1]
+
+    # the vehicle at the station is only published again after 60s
+    age(transformer, 30)
+    transformer.publish_to_mqtt()
+    assert published(transformer).count("/json/vp/at-station") == 1
+    assert published(transformer).count("/json/vp/in-centre") == 2
+    age(transformer, 30)
+    transformer.publish_to_mqtt()
+    assert published(transformer).count("/json/vp/at-station") == 2
+
+
+def test_zone_gauge_goes_back_to_zero(transformer, client, geofences):
+    client.geofences = geofences
+    report(client, {"bus-1": (48.605, 8.855)})
+    transformer.publish_to_mqtt()
+    assert geofences.zones[1].vehicles.value == 1
+
+    report(client, {"bus-1": (48.5, 8.855)}, ts=1700000001000)
+    transformer.publish_to_mqtt()
+
+    assert geofences.zones[1].vehicles.value == 0
+
+
+def test_zone_names_must_be_unique(app, tmp_path):
+    path = tmp_path / "geofences.json"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        feature([square(8.80, 48.60, 0.01)], name="depot"),
+        feature([square(8.85, 48.60, 0.01)], name="depot", action="tag")
+    ]}))
+
+    with pytest.raises(ValueError, match="depot"):
+        app.Geofences.load(str(path))
+
+
+def test_zone_names_are_escaped_in_metrics(app):
+    zone = app.Zone('Depot "Nord"\\West\nside', "tag", [(app.Polygon([app.Vec2(0, 0), app.Vec2(1, 0), app.Vec2(1, 1)]), [])])
+    zone.vehicles.set(3)
+
+    lines = [line for line in app.render_metrics().splitlines() if line.startswith("zone_vehicles{")]
+
+    assert 'zone_vehicles{zone="Depot \\"Nord\\"\\\\West\\nside",action="tag"} 3' in lines
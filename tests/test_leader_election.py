@@ -0,0 +1,175 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from tests.fake_mqtt import FakeBroker
+from tests.support import SCRIPT, wait_for
+
+
+@pytest.fixture
+def broker():
+    return FakeBroker()
+
+
+def instance(app, broker, id):
+    """A LeaderElection connected to broker, with the times it was elected."""
+    elected = []
+    election = app.LeaderElection(id, lambda: elected.append(time.time()))
+    election.elected = elected
+    client = broker.client()
+    election.attach(client)
+    client.connect()
+    election.on_connect(client)
+    broker.deliver()
+    return election
+
+
+def test_first_instance_leads_and_the_other_stands_by(app, broker):
+    a = instance(app, broker, "a")
+    a.heartbeat()
+    b = instance(app, broker, "b")
+    b.heartbeat()
+    a.heartbeat()
+    broker.deliver()
+
+    assert a.leader and not b.leader
+    assert len(a.elected) == 1 and not b.elected
+    assert b.lease["leader"] == "a"
+
+
+def test_standby_takes_over_when_the_leader_crashes(app, broker):
+    a = instance(app, broker, "a")
+    a.heartbeat()
+    b = instance(app, broker, "b")
+
+    a.client.crash()
+    a.on_disconnect()
+    broker.deliver()
+
+    assert b.leader and not a.leader
+    assert len(b.elected) == 1
+    # the old leader comes back as standby
+    a.client.connect()
+    a.on_connect(a.client)
+    broker.deliver()
+    a.heartbeat()
+    broker.deliver()
+    assert not a.leader
+    assert a.lease["leader"] == "b"
+
+
+def test_standby_takes_over_an_expired_lease(app, broker, monkeypatch):
+    monkeypatch.setattr(app, "LEADER_LEASE_TIME", 0.05)
+    a = instance(app, broker, "a")
+    a.heartbeat()
+    b = instance(app, broker, "b")
+    b.heartbeat()
+    broker.deliver()
+    assert not b.leader
+
+    # the leader hangs, the broker doesn't notice and sends no will
+    a.client.disconnect()
+    time.sleep(0.1)
+    b.heartbeat()
+    broker.deliver()
+
+    assert b.leader
+    assert len(b.elected) == 1
+
+
+def test_the_earlier_of_two_claims_wins(app, broker):
+    a = instance(app, broker, "a")
+    b = instance(app, broker, "b")
+
+    # both claim before receiving the other's lease
+    a.heartbeat()
+    b.heartbeat()
+    broker.deliver()
+
+    assert a.leader and not b.leader
+    assert b.lease["leader"] == "a"
+
+
+def test_new_leader_does_not_publish_stale_vehicles(app, client, mock, broker, monkeypatch):
+    monkeypatch.setattr(app, "LEADER_ELECTION", True)
+    monkeypatch.setattr(app, "LEADER_ID", "b")
+    monkeypatch.setattr(app, "thingsboard_client", client)
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    transformer.mqttConnected = True
+    # what the standby held from before, far from where the device is now
+    stale = client.data.update(mock.device_ids[0], 10.0, 8.0, 0, 0, 0, 1700000000000)
+    polling = threading.Event()
+    release = threading.Event()
+    fetch_vehicle_data = client.fetch_vehicle_data
+
+    def slow_fetch():
+        polling.set()
+        release.wait(5)
+        fetch_vehicle_data()
+
+    client.fetch_vehicle_data = slow_fetch
+    a = instance(app, broker, "a")
+    a.heartbeat()
+    broker.deliver()
+    standby = broker.client()
+    transformer.election.attach(standby)
+    standby.connect()
+    transformer.election.on_connect(standby)
+    broker.deliver()
+
+    a.client.crash()
+    broker.deliver()
+
+    assert transformer.election.leader
+    assert polling.wait(5)
+    transformer.publish_to_mqtt()
+    transformer.publish_vehicle_update(stale)
+    assert transformer.publisher.queue.empty()
+
+    release.set()
+    assert wait_for(transformer.is_publishing)
+    transformer.publish_to_mqtt()
+    topics = []
+    while not transformer.publisher.queue.empty():
+        topics.append(transformer.publisher.queue.get_nowait()[1])
+    positions = [topic for topic in topics if f"/{mock.device_ids[0]}/" in topic]
+    assert positions and all("/48;8/" in topic for topic in positions)
+
+
+def test_takeover_poll_of_an_earlier_term_does_not_count(app, transformer, monkeypatch):
+    transformer.election = app.LeaderElection("b", transformer.onElected)
+    transformer.election.leader = True
+    transformer.election.since = 2.0
+    transformer.takeover_polled = 1.0
+
+    assert transformer.is_active()
+    assert not transformer.is_publishing()
+
+
+def test_refuses_to_start_with_mqtt_sharding():
+    environment = {**os.environ, "LEADER_ELECTION": "true", "SHARDING": "mqtt", "MQTT_BROKER_URL": "127.0.0.1",
+        "MQTT_USER": "user", "MQTT_PASSWORD": "password"}
+
+    result = subprocess.run([sys.executable, SCRIPT], env=environment, capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 1
+    assert "LEADER_ELECTION can't be combined with SHARDING=mqtt" in result.stdout
+
+
+def test_asyncio_runtime_publishes_without_election(app, client, monkeypatch):
+    monkeypatch.setattr(app, "LEADER_ELECTION", True)
+    monkeypatch.setattr(app, "thingsboard_client", client)
+    runtime = app.AsyncRuntime({}, {})
+    transformer = runtime.transformer
+    transformer.mqttConnected = True
+    client.data.update("bus-1", 48.59, 8.86, 0, 0, 0, 1700000000000)
+
+    transformer.publish_to_mqtt()
+
+    assert transformer.election is None
+    assert transformer.is_publishing()
+    assert not transformer.publisher.queue.empty()
@@ -0,0 +1,44 @@
+import json
+import random
+
+import pytest
+from google.protobuf.json_format import MessageToJson
+
+
+def random_vehicle(app, rng, index):
+    trip = None
+    if rng.random() < 0.5:
+        trip = app.TripMatch(f"trip-{index}", f"route/{index % 7}", str(index % 90), "bus", rng.randrange(2),
+            "Herrenberg ZOB", "20240301", f"{rng.randrange(5, 25):02d}:{rng.randrange(60):02d}:00",
+            f"stop-{index}", rng.randrange(1, 40))
+    return app.VehicleState(f"device-{index}", rng.uniform(-90, 90), rng.uniform(-180, 180), rng.randrange(100),
+        rng.choice([0, 1, 2, 3, 4, 5, 6]), rng.randrange(101), 1700000000000, None, trip, index)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_json_matches_message_to_json(app, transformer, seed):
+    rng = random.Random(seed)
+    for index in range(200):
+        vehicle = random_vehicle(app, rng, index)
+        header_bytes, header_json = transformer.header_payload()
+        topic, entity_bytes, entity_json = transformer.encode_entity(vehicle)
+
+        message = app.gtfs_realtime_pb2.FeedMessage.FromString(header_bytes + entity_bytes)
+        expected = json.loads(MessageToJson(message))
+        # Parsed from the encoded message, the position holds the coordinates rounded to 32 bits.
+        # The pinned protobuf renders the doubles of the message the service built.
+        expected["entity"][0]["vehicle"]["position"].update(latitude=vehicle.latitude, longitude=vehicle.longitude)
+        rendered = f'{{"header":{header_json},"entity":[{entity_json}]}}'
+
+        # the same fields in the same order with the same values
+        assert json.dumps(json.loads(rendered)) == json.dumps(expected)
+
+
+@pytest.mark.parametrize("value", [0.0, 48.6, 8.870001, -33.123456, 179.99999, 1e-7, 48.59612345678901])
+def test_coordinates_are_rendered_as_reported(app, transformer, value):
+    vehicle = app.VehicleState("device-1", value, -value, 0, 0, 0, 1700000000000, None, None, 1)
+
+    topic, entity_bytes, entity_json = transformer.encode_entity(vehicle)
+
+    position = json.loads(entity_json)["vehicle"]["position"]
+    assert (position["latitude"], position["longitude"]) == (value, -value)
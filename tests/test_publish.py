@@ -0,0 +1,197 @@
+import asyncio
+import random
+import sys
+import threading
+import time
+
+from tests.fake_mqtt import FakeAsyncClient, FakeClient, StalledClient
+from tests.support import wait_for
+
+
+def vehicle(client, id, step=0):
+    return client.data.update(id, 48.59 + step * 1e-4, 8.86 + step * 1e-4, step % 40, 0, step % 100, 1700000000000 + step * 1000)
+
+
+def drain(transformer):
+    messages = []
+    while not transformer.publisher.queue.empty():
+        messages.append(transformer.publisher.queue.get_nowait())
+    return messages
+
+
+def test_publishes_entity_and_json(transformer, client):
+    vehicle(client, "bus-1")
+
+    transformer.publish_to_mqtt()
+
+    topics = [topic for enqueued_at, topic, payload, qos, retain in drain(transformer)]
+    assert topics[0].startswith("/gtfsrt/vp/hb/1/1/bus//0/unknown-headsign/unknown-trip-id/unknown-next-stop/00:00/bus-1/48;8/")
+    assert topics[1] == "/json/vp/bus-1"
+
+
+def test_websocket_updates_during_publish_ticks(transformer, client):
+    """Updates published from the websocket thread while the tick prunes the caches."""
+    errors = []
+    stop = threading.Event()
+
+    def ticks():
+        try:
+            for step in range(300):
+                # vehicles come and go, so every tick has caches to prune
+                ids = [f"bus-{index}" for index in range(200) if (index + step) % 3]
+                for id in ids:
+                    vehicle(client, id, step)
+                client.data.retain(set(ids))
+                transformer.publish_to_mqtt()
+                drain(transformer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stop.set()
+
+    def updates():
+        rng = random.Random(1)
+        step = 0
+        try:
+            while not stop.is_set():
+                step += 1
+                transformer.publish_vehicle_update(vehicle(client, f"ws-{rng.randrange(500)}", step))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    # switching threads often makes them meet in the middle of the caches' updates
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=ticks), threading.Thread(target=updates)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+
+
+def test_publisher_sends_queued_messages(transformer, client):
+    fake = FakeClient()
+    vehicle(client, "bus-1")
+    transformer.publish_to_mqtt()
+
+    transformer.publisher.start(fake)
+
+    assert fake.max_inflight is not None
+    assert wait_for(lambda: len(fake.messages) == 2)
+    assert [topic for sent_at, topic, payload, qos, retain in fake.messages][1] == "/json/vp/bus-1"
+
+
+def test_first_publish_is_recorded_when_the_client_accepts_a_message(app):
+    publisher = app.MQTTPublisher()
+    fake = FakeClient(rc=4)
+    failed = app.failed_messages.value
+    publisher.start(fake)
+
+    publisher.publish("/json/vp/bus-1", "{}")
+
+    assert wait_for(lambda: app.failed_messages.value > failed)
+    assert publisher.first_publish is None
+    fake.rc = 0
+    publisher.publish("/json/vp/bus-1", "{}")
+    assert wait_for(lambda: publisher.first_publish is not None)
+    assert app.startup_time.value == publisher.first_publish > 0
+
+
+def test_async_first_publish_is_recorded_after_the_publish(app):
+    publisher = app.AsyncMQTTPublisher()
+    # publishes take a while, the time is recorded once they finished
+    fake = FakeAsyncClient(latency=0.2)
+
+    started = time.monotonic() - app.STARTED
+
+    async def publish():
+        task = asyncio.create_task(publisher.run(fake))
+        publisher.publish("/json/vp/bus-1", "{}")
+        await asyncio.sleep(0.1)
+        assert publisher.first_publish is None
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(publish())
+
+    assert fake.sent == 1
+    assert app.startup_time.value == publisher.first_publish >= started + 0.2
+
+
+def test_publisher_stops_handing_messages_to_a_stalled_socket(app, monkeypatch):
+    monkeypatch.setattr(app, "MQTT_QUEUE_SIZE", 50)
+    monkeypatch.setattr(app, "MQTT_MAX_QUEUED", 10)
+    monkeypatch.setattr(app, "MQTT_MAX_MESSAGE_AGE", 0.3)
+    publisher = app.MQTTPublisher()
+    stalled = StalledClient()
+    dropped, stale = app.dropped_messages.value, app.stale_messages.value
+    publisher.start(stalled)
+
+    for index in range(100):
+        publisher.publish(f"/json/vp/bus-{index}", "{}")
+
+    assert wait_for(lambda: len(stalled._out_packet) == 10)
+    time.sleep(0.1)
+    assert stalled.sent == 10
+    assert publisher.backlog() <= 50
+    assert app.dropped_messages.value - dropped >= 40
+
+    # what waited while the socket was stalled is too old by the time it is written
+    time.sleep(0.3)
+    stalled.write(10)
+    assert wait_for(lambda: publisher.backlog() == 0 and app.stale_messages.value - stale >= 40)
+    publisher.publish("/json/vp/bus-new", "{}")
+    assert wait_for(lambda: stalled.sent == 11)
+    assert stalled.messages[-1][1] == "/json/vp/bus-new"
+
+
+def published_ids(transformer):
+    return sorted(topic[9:] for enqueued_at, topic, payload, qos, retain in drain(transformer) if topic.startswith("/json/vp/"))
+
+
+def age(transformer, seconds):
+    """Moves the last publish of every vehicle seconds into the past."""
+    transformer.published = {id: (state, at - seconds) for id, (state, at) in transformer.published.items()}
+
+
+def test_every_vehicle_is_published_every_tick_by_default(transformer, client):
+    vehicle(client, "bus-1")
+    vehicle(client, "bus-2")
+
+    transformer.publish_to_mqtt()
+    transformer.publish_to_mqtt()
+
+    assert published_ids(transformer) == ["bus-1", "bus-1", "bus-2", "bus-2"]
+
+
+def test_unchanged_vehicles_wait_for_the_heartbeat(app, transformer, client, monkeypatch):
+    monkeypatch.setattr(app, "PUBLISH_ONLY_CHANGES", True)
+    monkeypatch.setattr(app, "HEARTBEAT_INTERVAL", 30)
+    vehicle(client, "bus-1")
+    vehicle(client, "bus-2")
+    transformer.publish_to_mqtt()
+    assert published_ids(transformer) == ["bus-1", "bus-2"]
+    suppressed = app.suppressed_publishes.value
+
+    transformer.publish_to_mqtt()
+
+    assert published_ids(transformer) == []
+    assert app.suppressed_publishes.value - suppressed == 2
+
+    # a new position goes out right away, the other vehicle still waits
+    vehicle(client, "bus-1", 1)
+    age(transformer, 20)
+    transformer.publish_to_mqtt()
+    assert published_ids(transformer) == ["bus-1"]
+    assert app.suppressed_publishes.value - suppressed == 3
+
+    # 30s after its last publish the unchanged vehicle is published again
+    age(transformer, 10)
+    transformer.publish_to_mqtt()
+    assert published_ids(transformer) == ["bus-2"]
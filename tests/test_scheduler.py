@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+
+class FakeClock:
+    """A clock that only moves when the scheduler waits or a job takes time."""
+
+    def __init__(self, scheduler=None):
+        self.now = 100.0
+        self.scheduler = scheduler
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, delay):
+        self.now += delay
+        return self.scheduler.stopped.is_set()
+
+
+@pytest.fixture
+def clock(app):
+    clock = FakeClock()
+    clock.scheduler = app.Scheduler(clock=clock, wait=clock.wait)
+    return clock
+
+
+def job(app, overrun="skip", interval=1.0, func=None, next_run=10.0):
+    job = app.Job("test", interval, func, overrun, 0)
+    job.next_run = next_run
+    return job
+
+
+@pytest.mark.parametrize("overrun", ["skip", "coalesce", "catch_up"])
+def test_next_deadline_on_time(app, overrun):
+    scheduler = app.Scheduler()
+    on_time = job(app, overrun)
+
+    assert scheduler.next_deadline(on_time, 10.4) == 11.0
+    assert on_time.missed.value == 0
+
+
+@pytest.mark.parametrize("overrun, deadline, missed", [
+    # the runs at 11, 12 and 13 are dropped, the next one is on the grid after now
+    ("skip", 14.0, 3),
+    # one run right away for all of them, the last one that was due
+    ("coalesce", 13.0, 3),
+    # every missed run is made up for, one after the other
+    ("catch_up", 11.0, 0)
+])
+def test_next_deadline_after_overrun(app, overrun, deadline, missed):
+    scheduler = app.Scheduler()
+    overran = job(app, overrun)
+
+    assert scheduler.next_deadline(overran, 13.5) == deadline
+    assert overran.missed.value == missed
+
+
+def test_next_deadline_exactly_at_deadline(app):
+    scheduler = app.Scheduler()
+
+    assert scheduler.next_deadline(job(app, "skip"), 11.0) == 12.0
+
+
+def run(app, clock, durations, overrun="skip", interval=1.0):
+    """Start times of a job taking the given durations, run by the scheduler's loop."""
+    starts = []
+
+    def func():
+        starts.append(clock.now)
+        clock.now += durations[len(starts) - 1]
+        if len(starts) == len(durations):
+            clock.scheduler.stop()
+
+    scheduled = job(app, overrun, interval, func, next_run=clock.now + interval)
+    clock.scheduler.loop(scheduled)
+    return starts, scheduled
+
+
+def test_loop_does_not_drift(app, clock):
+    starts, scheduled = run(app, clock, [0.3] * 5)
+
+    assert starts == [101.0, 102.0, 103.0, 104.0, 105.0]
+    assert scheduled.duration.count == 5
+    assert scheduled.lag.sum == 0
+
+
+@pytest.mark.parametrize("overrun, expected", [
+    ("skip", [101.0, 104.0, 105.0, 106.0]),
+    ("coalesce", [101.0, 103.5, 104.0, 105.0]),
+    ("catch_up", [101.0, 103.5, 103.6, 104.0])
+])
+def test_loop_overrun(app, clock, overrun, expected):
+    # the first run takes 2.5s, so the runs at 102 and 103 are due while it still runs
+    starts, scheduled = run(app, clock, [2.5, 0.1, 0.1, 0.1], overrun)
+
+    assert starts == pytest.approx(expected)
+
+
+def test_stopped_scheduler_runs_nothing(app, clock):
+    clock.scheduler.stop()
+
+    starts, scheduled = run(app, clock, [0.1])
+
+    assert starts == []
+
+
+def test_add_runs_job_at_fixed_rate(app, monkeypatch):
+    # add installs a hook that exits the process when a job fails
+    monkeypatch.setattr(threading, "excepthook", threading.excepthook)
+    scheduler = app.Scheduler()
+    runs = []
+
+    scheduler.add("test", 0.05, lambda: runs.append(time.monotonic()), jitter=0.01)
+    time.sleep(0.5)
+    scheduler.stop()
+
+    assert 5 <= len(runs) <= 10
+    assert len(scheduler.jobs) == 1
+    assert 0 <= scheduler.jobs[0].offset <= 0.01
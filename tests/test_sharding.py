@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from tests.support import ROOT, wait_for
+
+# polls the devices of one static shard and prints the polled ids
+POLL_SHARD = """
+import json
+from tests.support import load_app
+client = load_app().thingsboard_client
+client.fetch_vehicle_data()
+print(json.dumps(sorted(vehicle.id for vehicle in client.get_vehicles())))
+"""
+
+
+def test_replicas_own_every_device_once(app):
+    ids = [f"device-{index:05d}" for index in range(3000)]
+    replicas = ["a", "b", "c", "d"]
+
+    owners = [[replica for replica in replicas if app.Shard(replica, replicas).owns(id)] for id in ids]
+
+    assert all(len(owner) == 1 for owner in owners)
+    # about a quarter each
+    for replica in replicas:
+        assert 600 < sum(owner == [replica] for owner in owners) < 900
+
+
+def test_joining_replica_only_takes_devices(app):
+    ids = [f"device-{index:05d}" for index in range(3000)]
+    before = {id: next(replica for replica in "abc" if app.Shard(replica, "abc").owns(id)) for id in ids}
+
+    after = {id: next(replica for replica in "abcd" if app.Shard(replica, "abcd").owns(id)) for id in ids}
+
+    moved = [id for id in ids if before[id] != after[id]]
+    assert all(after[id] == "d" for id in moved)
+    assert 600 < len(moved) < 900
+
+
+@pytest.mark.parametrize("count", [1, 3])
+def test_static_shards_in_processes_poll_every_device_once(mock, count):
+    for index in range(4, 40):
+        mock.add_device(f"device-{index:05d}")
+    environment = {**os.environ, "THINGSBOARD_HOST": mock.url, "THINGSBOARD_DEVICE_IDS": ",".join(mock.device_ids),
+        "SHARD_COUNT": str(count)}
+
+    processes = [subprocess.Popen([sys.executable, "-c", POLL_SHARD], cwd=ROOT, stdout=subprocess.PIPE, text=True,
+        env={**environment, "SHARD_INDEX": str(index)}) for index in range(count)]
+    polled = [json.loads(process.communicate(timeout=60)[0].splitlines()[-1]) for process in processes]
+
+    assert sorted(id for shard in polled for id in shard) == mock.device_ids
+    assert all(mock.requests["timeseries", id] == 1 for id in mock.device_ids)
+    if count > 1:
+        assert all(shard for shard in polled)
+
+
+def announcement(replica, present=True):
+    return SimpleNamespace(topic=f"/gtfsrt/replicas/{replica}", payload=replica.encode() if present else b"")
+
+
+def test_reshard_does_not_block_the_network_thread(app, client, mock, monkeypatch):
+    monkeypatch.setattr(app, "SHARDING", "mqtt")
+    monkeypatch.setattr(app, "SHARD_REPLICA_ID", "a")
+    monkeypatch.setattr(app, "thingsboard_client", client)
+    client.shard = app.Shard("a", ["a"])
+    transformer = app.GTFSRTHTTP2MQTTTransformer({}, {}, start_polling=False)
+    for index in range(4, 40):
+        mock.add_device(f"device-{index:05d}")
+    client.update_devices(list(mock.device_ids))
+    # a device listener that blocks, like fetching the capacities of added devices
+    release = threading.Event()
+    changes = []
+    client.device_listeners.append(lambda added, removed: (release.wait(5), changes.append(sorted(removed))))
+
+    transformer.onReplicaMessage(None, None, announcement("b"))
+    transformer.onReplicaMessage(None, None, announcement("c"))
+
+    assert not release.is_set()
+    release.set()
+    shards = {replica: set(id for id in mock.device_ids if app.Shard(replica, "abc").owns(id)) for replica in "abc"}
+    assert wait_for(lambda: set(client.device_ids) == shards["a"])
+
+    # the replica leaving gives its devices back
+    transformer.onReplicaMessage(None, None, announcement("c", present=False))
+    shards = {replica: set(id for id in mock.device_ids if app.Shard(replica, "ab").owns(id)) for replica in "ab"}
+    assert wait_for(lambda: set(client.device_ids) == shards["a"])
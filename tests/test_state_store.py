@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.fixture
+def store(app):
+    return app.VehicleStateStore()
+
+
+def test_unchanged_update_keeps_state(store):
+    first = store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000)
+
+    assert store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000) is first
+    assert store.version == first.version == 1
+
+
+def test_changed_update_replaces_state(store):
+    first = store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000)
+
+    second = store.update("bus-1", 48.6, 8.87, 11, 1, 18, 2000)
+
+    assert second is not first
+    assert second.version == store.version == 2
+    # the old state is never changed, readers holding it keep a consistent vehicle
+    assert (first.pax, first.timestamp) == (10, 1000)
+    assert store.get("bus-1") is second
+
+
+def test_snapshot_is_only_copied_after_changes(store):
+    store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000)
+    snapshot = store.snapshot()
+
+    store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000)
+    assert store.snapshot() is snapshot
+
+    store.update("bus-2", 48.6, 8.87, 10, 1, 17, 1000)
+    changed = store.snapshot()
+    assert changed is not snapshot
+    assert [vehicle.id for vehicle in changed.vehicles] == ["bus-1", "bus-2"]
+    assert [vehicle.id for vehicle in snapshot.vehicles] == ["bus-1"]
+
+
+def test_update_many_and_retain(store):
+    store.update_many([(f"bus-{index}", 48.6, 8.87, index, 1, index, 1000, None, None) for index in range(5)])
+    assert store.version == 5
+    updated = store.updated
+
+    store.retain({"bus-1", "bus-3"})
+
+    assert sorted(vehicle.id for vehicle in store.values()) == ["bus-1", "bus-3"]
+    assert store.version == 8
+    assert store.updated >= updated
+    assert len(store) == 2
+
+
+def test_vehicle_state_has_no_dict(store):
+    vehicle = store.update("bus-1", 48.6, 8.87, 10, 1, 17, 1000)
+
+    with pytest.raises(AttributeError):
+        vehicle.extra = True
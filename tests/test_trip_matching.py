@@ -0,0 +1,120 @@
+import datetime
+import os
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from tests.support import ROOT
+
+BERLIN = ZoneInfo("Europe/Berlin")
+
+# points of the sample line's shape, from the Bahnhof to the Krankenhaus
+BAHNHOF = (48.59430, 8.86910)
+# half way between the Marktplatz and the Schießmauer
+MARKTPLATZ_SCHIESSMAUER = (48.59780, 8.87240)
+# half way between the Schießmauer and the Längenholz
+SCHIESSMAUER_LAENGENHOLZ = (48.60095, 8.87580)
+KRANKENHAUS = (48.60600, 8.88200)
+
+
+def at(date, time):
+    """Timestamp in ms of the local time in Herrenberg."""
+    local = datetime.datetime.fromisoformat(f"{date}T{time}").replace(tzinfo=BERLIN)
+    return int(local.timestamp() * 1000)
+
+
+@pytest.fixture
+def matcher(app):
+    return app.TripMatcher.load(os.path.join(ROOT, "sample-gtfs"))
+
+
+def test_load(matcher):
+    assert len(matcher.trips) == 171
+    assert matcher.stop_ids == ["hb-bahnhof", "hb-marktplatz", "hb-schiessmauer", "hb-laengenholz", "hb-krankenhaus"]
+
+
+def test_finds_the_trip_the_vehicle_is_on(app, matcher):
+    match = matcher.match("bus-1", *MARKTPLATZ_SCHIESSMAUER, at("2026-10-23", "10:04:30"))
+
+    assert match == app.TripMatch("weekday-0-1000", "1", "1", "bus", 0, "Krankenhaus", "20261023", "10:00:00",
+        "hb-schiessmauer", 3)
+
+
+def test_finds_the_trip_in_the_other_direction(matcher):
+    # on the way back the 10:10 trip passes here at 10:17:30
+    match = matcher.match("bus-1", *MARKTPLATZ_SCHIESSMAUER, at("2026-10-23", "10:16:00"))
+
+    assert (match.trip_id, match.direction_id, match.stop_id) == ("weekday-1-1010", 1, "hb-marktplatz")
+
+
+def test_no_trip_away_from_the_line_or_the_schedule(matcher):
+    assert matcher.match("bus-1", 48.58, 8.85, at("2026-10-23", "10:04:30")) is None
+    assert matcher.match("bus-2", *MARKTPLATZ_SCHIESSMAUER, at("2026-10-23", "03:00:00")) is None
+
+
+def test_next_stop_advances_along_the_trip(matcher):
+    first = matcher.match("bus-1", *MARKTPLATZ_SCHIESSMAUER, at("2026-10-23", "10:04:30"))
+    # a few minutes late, still on the same trip
+    second = matcher.match("bus-1", *SCHIESSMAUER_LAENGENHOLZ, at("2026-10-23", "10:09:00"))
+
+    assert (first.trip_id, first.stop_id, first.stop_sequence) == ("weekday-0-1000", "hb-schiessmauer", 3)
+    assert (second.trip_id, second.stop_id, second.stop_sequence) == ("weekday-0-1000", "hb-laengenholz", 4)
+
+
+@pytest.mark.parametrize("date, trip_id", [
+    ("2026-10-23", "weekday-0-1000"),
+    ("2026-10-24", "weekend-0-1000"),
+    ("2026-10-25", "weekend-0-1000"),
+    # Christmas runs the weekend timetable, calendar_dates swaps the services
+    ("2026-12-25", "weekend-0-1000"),
+    ("2026-12-18", "weekday-0-1000"),
+])
+def test_calendar(matcher, date, trip_id):
+    match = matcher.match("bus-1", *MARKTPLATZ_SCHIESSMAUER, at(date, "10:04:30"))
+
+    assert match.trip_id == trip_id
+    assert match.start_date == date.replace("-", "")
+
+
+def test_trip_after_midnight_belongs_to_the_previous_service_day(matcher):
+    # the last trip of Friday reaches the Längenholz at 24:04:00
+    match = matcher.match("bus-1", *SCHIESSMAUER_LAENGENHOLZ, at("2026-10-24", "00:02:30"))
+
+    assert (match.trip_id, match.start_date, match.start_time) == ("weekday-0-2355", "20261023", "23:55:00")
+    assert match.stop_id == "hb-laengenholz"
+
+
+def test_vehicle_waiting_at_the_terminus_gets_its_next_departure(matcher):
+    matcher.match("bus-1", *SCHIESSMAUER_LAENGENHOLZ, at("2026-10-23", "10:07:30"))
+    arrived = matcher.match("bus-1", *KRANKENHAUS, at("2026-10-23", "10:12:00"))
+    assert (arrived.trip_id, arrived.stop_id) == ("weekday-0-1000", "hb-krankenhaus")
+
+    # arriving forgot the trip, so the vehicle isn't held on it while it waits
+    waiting = matcher.match("bus-1", *KRANKENHAUS, at("2026-10-23", "10:25:00"))
+    turned = matcher.match("bus-1", *SCHIESSMAUER_LAENGENHOLZ, at("2026-10-23", "10:34:30"))
+
+    assert (waiting.trip_id, waiting.stop_id) == ("weekday-1-1030", "hb-laengenholz")
+    assert (turned.trip_id, turned.stop_id) == ("weekday-1-1030", "hb-schiessmauer")
+
+
+def test_forgets_vehicles_no_longer_reported(matcher):
+    matcher.match("bus-1", *MARKTPLATZ_SCHIESSMAUER, at("2026-10-23", "10:04:30"))
+    matcher.match("bus-2", *BAHNHOF, at("2026-10-23", "10:02:00"))
+
+    matcher.retain({"bus-2"})
+
+    assert list(matcher.states) == ["bus-2"]
+
+
+def test_topic_of_a_matched_vehicle(transformer, client, matcher):
+    client.matcher = matcher
+    ts = at("2026-10-23", "10:04:30")
+    client.update_telemetry("bus-1", {"latitude": [[ts, str(MARKTPLATZ_SCHIESSMAUER[0])]],
+        "longitude": [[ts, str(MARKTPLATZ_SCHIESSMAUER[1])]], "pax": [[ts, "5"]]})
+
+    transformer.publish_to_mqtt()
+
+    topics = []
+    while not transformer.publisher.queue.empty():
+        topics.append(transformer.publisher.queue.get_nowait()[1])
+    assert "/gtfsrt/vp/hb/1/1/bus/1/0/Krankenhaus/weekday-0-1000/hb-schiessmauer/10:00/bus-1/48;8/58/97/72/1" in topics
@@ -0,0 +1,61 @@
+import pytest
+
+from tests.support import wait_for
+
+
+@pytest.fixture
+def subscriber(app, client, mock, monkeypatch):
+    monkeypatch.setattr(app, "WEBSOCKET_RECONNECT_DELAY", 0.1)
+    mock.update_interval = 0.2
+    subscriber = app.ThingsboardSubscriber(client)
+    subscriber.start()
+    yield subscriber
+    subscriber.stop()
+
+
+def test_subscribes_to_all_devices(subscriber, client, mock):
+    assert wait_for(lambda: len(client.data) == len(mock.device_ids))
+
+    assert [sorted(id for id, keys in subscriptions.values()) for subscriptions in mock.subscriptions()] == [mock.device_ids]
+    ts, latitude, longitude, pax = mock.telemetry(mock.device_ids[0])
+    vehicle = client.data.get(mock.device_ids[0])
+    assert (vehicle.latitude, vehicle.longitude) == pytest.approx((latitude, longitude), abs=0.01)
+
+
+def test_pushed_updates_reach_listeners(subscriber, client, mock):
+    updated = []
+    client.listeners.append(updated.append)
+    assert wait_for(lambda: len(client.data) == len(mock.device_ids))
+    first = client.data.get(mock.device_ids[0]).timestamp
+
+    assert wait_for(lambda: client.data.get(mock.device_ids[0]).timestamp > first)
+
+    assert {vehicle.id for vehicle in updated} == set(mock.device_ids)
+
+
+def test_subscriptions_follow_discovery(subscriber, client, mock):
+    assert wait_for(lambda: subscriber.connected)
+    removed, *kept = mock.device_ids
+
+    client.update_devices(kept)
+
+    assert wait_for(lambda: [sorted(id for id, keys in subscriptions.values()) for subscriptions in mock.subscriptions()] == [kept])
+    assert client.data.get(removed) is None
+
+
+def test_unknown_device_is_ignored(subscriber, client, mock):
+    assert wait_for(lambda: subscriber.connected)
+
+    client.update_devices(mock.device_ids + ["unknown"])
+
+    assert wait_for(lambda: len(mock.subscriptions()[0]) == len(mock.device_ids))
+    assert client.data.get("unknown") is None
+
+
+def test_reconnects_and_resubscribes(subscriber, client, mock):
+    assert wait_for(lambda: subscriber.connected)
+
+    mock.close_websockets()
+
+    assert wait_for(lambda: mock.requests["websocket"] == 2 and subscriber.connected)
+    assert wait_for(lambda: [len(subscriptions) for subscriptions in mock.subscriptions()] == [len(mock.device_ids)])
@@ -1,37 +1,1016 @@
-import os, sys, datetime, json, time, threading
+import os, sys, datetime, json, time, threading, base64, queue, random, bisect, resource, atexit
+import csv, io, math, zipfile, hashlib, socket
+
+# startup_first_publish_seconds is measured from here, before the slower imports below
+STARTED = time.monotonic()
+
+from array import array
+from collections import namedtuple
+from zoneinfo import ZoneInfo
 from threading import Event, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import ssl
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
 import paho.mqtt.client as mqtt
+import aiomqtt
+import aiohttp
 import requests
+import websocket
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
-from google.protobuf.json_format import MessageToJson
 import gtfs_realtime_pb2
 import logging
-from planar import Vec2, BoundingBox
+from planar import Vec2, Polygon
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+
+    def dump_json(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def dump_json(obj):
+        return json.dumps(obj, separators=(",", ":"))
 
 if(os.getenv("LOG_LEVEL") == "DEBUG"):
     logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Number of devices whose telemetry is fetched in parallel and the timeout (in seconds)
+# applied to every single device request.
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "5"))
+# The JWT is refreshed once it expires within TOKEN_REFRESH_MARGIN seconds, checked every
+# TOKEN_CHECK_INTERVAL seconds in the background.
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+TOKEN_CHECK_INTERVAL = int(os.getenv("TOKEN_CHECK_INTERVAL", "60"))
+# ThingsBoard is polled every POLL_INTERVAL seconds, shifted by a random offset of up to
+# POLL_JITTER seconds so that replicas don't poll at the same moment. POLL_OVERRUN decides what
+# happens to polls that were due while a slow poll was running: "skip" drops them, "coalesce"
+# runs one poll right away, "catch_up" runs all of them.
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "15"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0"))
+POLL_OVERRUN = os.getenv("POLL_OVERRUN", "skip")
+PUBLISH_INTERVAL = float(os.getenv("PUBLISH_INTERVAL", "1"))
+# GeoJSON file with the zones (depots, workshops, layover areas) in which vehicles are handled
+# differently, indexed in a grid of GEOFENCE_CELL_SIZE degrees.
+GEOFENCES_FILE = os.getenv("GEOFENCES_FILE")
+GEOFENCE_CELL_SIZE = float(os.getenv("GEOFENCE_CELL_SIZE", "0.01"))
+# Static GTFS feed (zip file or directory) the vehicles are matched against to find their trip,
+# route and next stop. A vehicle is on a trip when it is at most MATCH_MAX_DISTANCE meters from
+# the trip's shape and at most MATCH_MAX_DELAY seconds off its schedule.
+GTFS_PATH = os.getenv("GTFS_PATH")
+MATCH_MAX_DISTANCE = float(os.getenv("MATCH_MAX_DISTANCE", "100"))
+MATCH_MAX_DELAY = int(os.getenv("MATCH_MAX_DELAY", "900"))
+# meters a second off schedule weighs against the distance when choosing between trips
+MATCH_DELAY_WEIGHT = 1.0
+# size in degrees of the grid cells in which stops near a vehicle are looked up
+MATCH_CELL_SIZE = 0.01
+# seconds of schedule a vehicle may go back along its trip, more is GPS noise no longer
+MATCH_MAX_BACKTRACK = 30
+# With BATCH_TRANSFORM enabled and NumPy installed, polls of at least BATCH_TRANSFORM_MIN_SIZE
+# devices are transformed column-wise. Reading the values out of the JSON responses still
+# dominates, so this is only about as fast as the per-vehicle loop for now.
+BATCH_TRANSFORM = os.getenv("BATCH_TRANSFORM", "false").lower() == "true"
+BATCH_TRANSFORM_MIN_SIZE = int(os.getenv("BATCH_TRANSFORM_MIN_SIZE", "1000"))
+# Vehicles have VEHICLE_SEATED_CAPACITY seats and room for VEHICLE_STANDING_CAPACITY standing
+# passengers unless CAPACITY_FILE or, with CAPACITY_ATTRIBUTES enabled, the devices' server
+# attributes in ThingsBoard say otherwise. The attributes are read again every
+# CAPACITY_REFRESH_INTERVAL seconds.
+VEHICLE_SEATED_CAPACITY = int(os.getenv("VEHICLE_SEATED_CAPACITY", "60"))
+VEHICLE_STANDING_CAPACITY = int(os.getenv("VEHICLE_STANDING_CAPACITY", "0"))
+CAPACITY_FILE = os.getenv("CAPACITY_FILE")
+CAPACITY_ATTRIBUTES = os.getenv("CAPACITY_ATTRIBUTES", "false").lower() == "true"
+CAPACITY_REFRESH_INTERVAL = int(os.getenv("CAPACITY_REFRESH_INTERVAL", "3600"))
+CAPACITY_ATTRIBUTE_KEYS = {"seated": "seatedCapacity", "standing": "standingCapacity"}
+# OccupancyStatus names with the occupancy in percent of the total capacity from which on
+# they apply
+OCCUPANCY_THRESHOLDS = os.getenv("OCCUPANCY_THRESHOLDS", "MANY_SEATS_AVAILABLE:0,FEW_SEATS_AVAILABLE:50,STANDING_ROOM_ONLY:85")
+# "threaded" runs polling and publishing on their own threads, "asyncio" runs fetching,
+# transformation and publishing on one event loop.
+RUNTIME_MODE = os.getenv("RUNTIME_MODE", "threaded")
+MQTT_RECONNECT_DELAY = int(os.getenv("MQTT_RECONNECT_DELAY", "5"))
+# "poll" fetches telemetry over REST, "websocket" subscribes to telemetry updates and only
+# falls back to REST polling while the websocket is disconnected.
+INGESTION_MODE = os.getenv("INGESTION_MODE", "poll")
+WEBSOCKET_RECONNECT_DELAY = int(os.getenv("WEBSOCKET_RECONNECT_DELAY", "5"))
+TELEMETRY_KEYS = ["latitude", "longitude", "pax"]
+# Devices are either listed in THINGSBOARD_DEVICE_IDS or, with DEVICE_DISCOVERY enabled, read
+# from the tenant's (or THINGSBOARD_CUSTOMER_ID's) devices of THINGSBOARD_DEVICE_TYPE every
+# DEVICE_DISCOVERY_INTERVAL seconds.
+THINGSBOARD_DEVICE_IDS = os.getenv("THINGSBOARD_DEVICE_IDS")
+DEVICE_DISCOVERY = os.getenv("DEVICE_DISCOVERY", "false").lower() == "true"
+DEVICE_DISCOVERY_INTERVAL = int(os.getenv("DEVICE_DISCOVERY_INTERVAL", "300"))
+DEVICE_PAGE_SIZE = int(os.getenv("DEVICE_PAGE_SIZE", "100"))
+THINGSBOARD_DEVICE_TYPE = os.getenv("THINGSBOARD_DEVICE_TYPE")
+THINGSBOARD_CUSTOMER_ID = os.getenv("THINGSBOARD_CUSTOMER_ID")
+# "device" fetches the telemetry of every device with its own request, "bulk" fetches the
+# latest telemetry of BULK_PAGE_SIZE devices at a time through the entity data query API.
+FETCH_MODE = os.getenv("FETCH_MODE", "device")
+BULK_PAGE_SIZE = int(os.getenv("BULK_PAGE_SIZE", "1000"))
+# The devices are split between SHARD_COUNT replicas by their ids, this replica polls and
+# publishes those of SHARD_INDEX. With SHARDING "mqtt" the replicas instead announce themselves
+# with retained messages under SHARD_TOPIC and split the devices between the replicas that are
+# connected, this one as SHARD_REPLICA_ID.
+SHARDING = os.getenv("SHARDING", "static")
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_TOPIC = os.getenv("SHARD_TOPIC", "/gtfsrt/replicas")
+SHARD_REPLICA_ID = os.getenv("SHARD_REPLICA_ID", socket.gethostname())
+# With LEADER_ELECTION enabled, only the instance holding the retained lease on LEADER_TOPIC
+# polls and publishes, the others stand by with their connections and tokens kept fresh. The
+# leader renews the lease every LEADER_HEARTBEAT_INTERVAL seconds, a standby takes it over when
+# the leader disconnected or didn't renew it for LEADER_LEASE_TIME seconds.
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "false").lower() == "true"
+LEADER_TOPIC = os.getenv("LEADER_TOPIC", "/gtfsrt/leader")
+LEADER_ID = os.getenv("LEADER_ID", SHARD_REPLICA_ID)
+LEADER_HEARTBEAT_INTERVAL = float(os.getenv("LEADER_HEARTBEAT_INTERVAL", "5"))
+LEADER_LEASE_TIME = float(os.getenv("LEADER_LEASE_TIME", str(3 * LEADER_HEARTBEAT_INTERVAL)))
+# Only publish vehicles whose position, occupancy or telemetry timestamp changed, unchanged
+# vehicles are republished every HEARTBEAT_INTERVAL seconds.
+PUBLISH_ONLY_CHANGES = os.getenv("PUBLISH_ONLY_CHANGES", "false").lower() == "true"
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
+# A FULL_DATASET feed of all vehicles is published on AGGREGATE_TOPIC and served on HTTP_PORT
+# when they are set.
+AGGREGATE_TOPIC = os.getenv("AGGREGATE_TOPIC")
+HTTP_PORT = os.getenv("HTTP_PORT")
+# QoS of the binary /gtfsrt/vp topics (and the aggregate feed) and of the /json/vp topics
+MQTT_QOS_GTFSRT = int(os.getenv("MQTT_QOS_GTFSRT", "0"))
+MQTT_QOS_JSON = int(os.getenv("MQTT_QOS_JSON", "0"))
+# Messages wait in a queue of at most MQTT_QUEUE_SIZE messages for the publisher thread and are
+# dropped when they are older than MQTT_MAX_MESSAGE_AGE seconds by the time it gets to them.
+MQTT_QUEUE_SIZE = int(os.getenv("MQTT_QUEUE_SIZE", "10000"))
+MQTT_MAX_MESSAGE_AGE = float(os.getenv("MQTT_MAX_MESSAGE_AGE", "5"))
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", "100"))
+MQTT_MAX_QUEUED = int(os.getenv("MQTT_MAX_QUEUED", "1000"))
+# With PROFILE_FILE set, the stacks of all threads are sampled every PROFILE_INTERVAL seconds and
+# written to it every PROFILE_DUMP_INTERVAL seconds.
+PROFILE_FILE = os.getenv("PROFILE_FILE")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DUMP_INTERVAL = float(os.getenv("PROFILE_DUMP_INTERVAL", "60"))
+# With CHECKPOINT_FILE set, the vehicles, discovered devices, capacities and token are written to
+# it every CHECKPOINT_INTERVAL seconds. A checkpoint of at most CHECKPOINT_MAX_AGE seconds is
+# restored on startup and its vehicles are published while the first poll runs in the background.
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "30"))
+CHECKPOINT_MAX_AGE = float(os.getenv("CHECKPOINT_MAX_AGE", "300"))
+
+
+# Every metric registers itself here and is served on /metrics. Updates are plain attribute
+# increments without a lock, so they cost next to nothing on the hot path.
+METRICS = []
+
+class Counter:
+    TYPE = "counter"
+
+    def __init__(self, name, description, labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+        METRICS.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + "_total", self.labels, self.value
+
+class Gauge:
+    TYPE = "gauge"
+
+    def __init__(self, name, description, labels=None, function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+        # called for the value on every scrape instead of it being set
+        self.function = function
+        METRICS.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.labels, self.function() if self.function else self.value
+
+class Histogram:
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS, labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.buckets = buckets
+        # observations per bucket, the last one counts everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        METRICS.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        # Prometheus buckets are cumulative, they are only added up when scraped
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield self.name + "_bucket", {**self.labels, "le": str(bound)}, cumulative
+        cumulative += self.counts[-1]
+        yield self.name + "_bucket", {**self.labels, "le": "+Inf"}, cumulative
+        yield self.name + "_sum", self.labels, self.sum
+        yield self.name + "_count", self.labels, cumulative
+
+def escape_label(value):
+    # zone names come from the geofences file and may contain anything
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_labels(labels):
+    return ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    described = set()
+    # metrics of the same name but with other labels are listed under one description
+    for metric in sorted(METRICS, key=lambda metric: metric.name):
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+        for name, labels, value in metric.samples():
+            if labels:
+                name = f"{name}{{{render_labels(labels)}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+BYTE_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+suppressed_publishes = Counter("publishes_suppressed", "Vehicle publishes skipped because nothing changed or a zone limits the rate")
+sent_messages = Counter("mqtt_messages_sent", "Messages handed to the MQTT client")
+failed_messages = Counter("mqtt_messages_failed", "Messages the MQTT client refused, e.g. while disconnected")
+dropped_messages = Counter("mqtt_messages_dropped", "Messages dropped because the outbound queue was full")
+stale_messages = Counter("mqtt_messages_stale", "Messages dropped because they were too old to be sent")
+snapshot_age = Gauge("snapshot_age_seconds", "Time since the vehicle snapshot last published was changed")
+tick_jitter = Gauge("publish_tick_jitter_seconds", "Deviation of the last publish tick from PUBLISH_INTERVAL")
+device_fetch_time = Histogram("thingsboard_request_seconds", "Time of a single telemetry request to ThingsBoard", labels={"request": "device"})
+bulk_fetch_time = Histogram("thingsboard_request_seconds", "Time of a single telemetry request to ThingsBoard", labels={"request": "bulk"})
+fetch_failures = Counter("thingsboard_request_failures", "Requests to ThingsBoard that failed")
+poll_time = Histogram("thingsboard_poll_seconds", "Time to fetch the telemetry of all devices")
+token_time = Histogram("thingsboard_token_seconds", "Time to get a ThingsBoard token, including logins")
+tick_time = Histogram("publish_tick_seconds", "Time of one publish_to_mqtt tick")
+encode_time = Histogram("entity_encode_seconds", "Time to encode the protobuf and JSON entity of a vehicle",
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .005))
+message_size = Histogram("mqtt_message_bytes", "Size of the MQTT messages published", buckets=BYTE_BUCKETS)
+vehicle_publishes = Counter("vehicle_publishes", "Vehicles published to MQTT")
+zone_suppressed = Counter("vehicles_suppressed", "Vehicle updates dropped because the vehicle is in a suppress zone")
+mqtt_reconnects = Counter("mqtt_reconnects", "Connections to the MQTT broker after the first one")
+publish_latency = Histogram("vehicle_publish_latency_seconds", "Time from the telemetry timestamp of a vehicle to its first publish",
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 15, 30, 60, 120))
+checkpoint_time = Histogram("checkpoint_seconds", "Time to write the state checkpoint")
+startup_time = Gauge("startup_first_publish_seconds", "Time from the start of the process to its first successful MQTT publish")
+leader_state = Gauge("leader", "1 while this instance holds the leader lease")
+leader_takeovers = Counter("leader_takeovers", "Times this instance took over the leader lease")
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def resident_memory():
+    # current RSS from /proc, ru_maxrss would only be the peak
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+process_cpu = Gauge("process_cpu_seconds", "User and system CPU time of the process", function=cpu_seconds)
+process_memory = Gauge("process_resident_memory_bytes", "Resident memory of the process", function=resident_memory)
+
+
+class CapacityRegistry:
+    """Seated and standing capacity of every vehicle and the occupancy derived from it.
+
+    Capacities come from a JSON file ({"<device id>": {"seated": 40, "standing": 50}}) and
+    from ThingsBoard device attributes, which take precedence. Both are kept in memory, so
+    looking up a vehicle never needs a request.
+    """
+
+    def __init__(self, default, thresholds, configured=None):
+        # (seated, standing) of vehicles we know nothing about
+        self.default = default
+        self.configured = configured or {}
+        self.attributes = {}
+        self.capacities = dict(self.configured)
+        # sorted start percentages and the OccupancyStatus values starting at them
+        self.thresholds = [percent for percent, status in thresholds]
+        self.statuses = [status for percent, status in thresholds]
+
+    def get(self, id):
+        return self.capacities.get(id, self.default)
+
+    def total(self, id):
+        seated, standing = self.capacities.get(id, self.default)
+        return seated + standing
+
+    def occupancy(self, id, pax):
+        """OccupancyStatus value and occupancy_percentage of the vehicle with pax passengers."""
+        percent = pax / self.total(id) * 100
+        index = max(bisect.bisect_right(self.thresholds, percent) - 1, 0)
+        return self.statuses[index], round(percent)
+
+    def update(self, attributes, replace=True):
+        """Stores capacities read from ThingsBoard, returns the ids whose capacity changed.
+
+        With replace, attributes holds all devices and capacities missing from it are dropped.
+        """
+        previous = self.capacities
+        self.attributes = dict(attributes) if replace else {**self.attributes, **attributes}
+        # replaced as a whole, readers on other threads always see a complete dict
+        self.capacities = {**self.configured, **self.attributes}
+        ids = set(previous).union(self.capacities)
+        return [id for id in ids if previous.get(id) != self.capacities.get(id)]
+
+    @staticmethod
+    def parse(values):
+        # (seated, standing) from a dict with "seated" and "standing" values, None when they
+        # are missing or leave no room for anybody
+        try:
+            seated = int(float(values.get("seated") or 0))
+            standing = int(float(values.get("standing") or 0))
+        except (TypeError, ValueError):
+            return None
+        if seated < 0 or standing < 0 or seated + standing <= 0:
+            return None
+        return seated, standing
+
+    @staticmethod
+    def parse_thresholds(spec):
+        thresholds = []
+        for entry in spec.split(","):
+            name, percent = entry.split(":")
+            status = gtfs_realtime_pb2.VehiclePosition.OccupancyStatus.Value(name.strip())
+            thresholds.append((float(percent), status))
+        return sorted(thresholds)
+
+    @classmethod
+    def load(cls, path=None):
+        configured = {}
+        if path:
+            with open(path) as f:
+                for id, values in json.load(f).items():
+                    capacity = cls.parse(values)
+                    if capacity is None:
+                        print(f"Ignoring invalid capacity of vehicle {id}")
+                        continue
+                    configured[id] = capacity
+        return cls(
+            (VEHICLE_SEATED_CAPACITY, VEHICLE_STANDING_CAPACITY),
+            cls.parse_thresholds(OCCUPANCY_THRESHOLDS),
+            configured
+        )
+
+
+class VehicleState:
+    """State of a vehicle, never changed once created so it can be shared between threads."""
+    __slots__ = ("id", "latitude", "longitude", "pax", "occupancy", "occupancy_percentage", "timestamp", "zone", "trip", "version")
+
+    def __init__(self, id, latitude, longitude, pax, occupancy, occupancy_percentage, timestamp, zone, trip, version):
+        self.id = id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.pax = pax
+        # GTFS-RT OccupancyStatus value and occupancy in percent of the vehicle's capacity
+        self.occupancy = occupancy
+        self.occupancy_percentage = occupancy_percentage
+        self.timestamp = timestamp
+        # the Zone the vehicle is in and the TripMatch of the trip it serves, if any
+        self.zone = zone
+        self.trip = trip
+        # version of the store when this state was created, lets consumers tell whether
+        # they already saw it
+        self.version = version
+
+
+class Snapshot:
+    __slots__ = ("version", "updated", "vehicles")
+
+    def __init__(self, version, updated, vehicles):
+        self.version = version
+        # monotonic time of the last change included in the snapshot
+        self.updated = updated
+        self.vehicles = vehicles
+
+
+class VehicleStateStore:
+    """Latest state of every reported vehicle, keyed by device id.
+
+    Writers replace vehicle states under a lock, readers get an immutable snapshot of all
+    vehicles which is only copied again after something changed.
+    """
+
+    def __init__(self):
+        self.vehicles = {}
+        # incremented whenever any vehicle is changed, added or removed
+        self.version = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.current = Snapshot(0, self.updated, ())
+
+    def update(self, id, latitude, longitude, pax, occupancy, occupancy_percentage, timestamp, zone=None, trip=None):
+        with self.lock:
+            vehicle = self.set_vehicle(id, latitude, longitude, pax, occupancy, occupancy_percentage, timestamp, zone, trip)
+            if vehicle.version == self.version:
+                self.updated = time.monotonic()
+            return vehicle
+
+    def update_many(self, updates):
+        # takes the lock once for a whole poll
+        with self.lock:
+            version = self.version
+            for update in updates:
+                self.set_vehicle(*update)
+            if self.version != version:
+                self.updated = time.monotonic()
+
+    def set_vehicle(self, id, latitude, longitude, pax, occupancy, occupancy_percentage, timestamp, zone, trip):
+        # the caller holds the lock and sets self.updated
+        vehicle = self.vehicles.get(id)
+        if (vehicle is not None and vehicle.latitude == latitude and vehicle.longitude == longitude
+                and vehicle.pax == pax and vehicle.occupancy == occupancy
+                and vehicle.occupancy_percentage == occupancy_percentage
+                and vehicle.timestamp == timestamp and vehicle.zone is zone and vehicle.trip == trip):
+            return vehicle
+
+        self.version += 1
+        vehicle = VehicleState(id, latitude, longitude, pax, occupancy, occupancy_percentage, timestamp, zone, trip, self.version)
+        self.vehicles[id] = vehicle
+        return vehicle
+
+    def remove(self, id):
+        with self.lock:
+            if self.vehicles.pop(id, None) is not None:
+                self.version += 1
+                self.updated = time.monotonic()
+
+    def retain(self, ids):
+        for id in [id for id in list(self.vehicles) if id not in ids]:
+            self.remove(id)
+
+    def get(self, id):
+        return self.vehicles.get(id)
+
+    def snapshot(self):
+        snapshot = self.current
+        if snapshot.version != self.version:
+            with self.lock:
+                snapshot = Snapshot(self.version, self.updated, tuple(self.vehicles.values()))
+                self.current = snapshot
+        return snapshot
+
+    def values(self):
+        return self.snapshot().vehicles
+
+    def __len__(self):
+        return len(self.vehicles)
+
+
+class Zone:
+    """An area with an action for the vehicles inside it.
+
+    "suppress" stops publishing vehicles in the zone, "tag" only counts them in the zone's
+    vehicles gauge and "reduce" publishes them at most every publish_interval seconds.
+    """
+    ACTIONS = ("suppress", "tag", "reduce")
+
+    def __init__(self, name, action, polygons, publish_interval=None):
+        if action not in self.ACTIONS:
+            raise ValueError(f"Unknown action {action} for zone {name}")
+        if publish_interval is not None and (isinstance(publish_interval, bool)
+                or not isinstance(publish_interval, (int, float)) or publish_interval <= 0):
+            raise ValueError(f"publish_interval of zone {name} must be a positive number of seconds, not {publish_interval!r}")
+        self.name = name
+        self.action = action
+        self.publish_interval = publish_interval if publish_interval is not None else HEARTBEAT_INTERVAL
+        # suppressed vehicles are never published, so only the others are counted
+        self.vehicles = None
+        if action != "suppress":
+            self.vehicles = Gauge("zone_vehicles", "Vehicles in the zone at the last publish tick",
+                labels={"zone": name, "action": action})
+        # (outline, holes) per polygon, points are Vec2(lon, lat) like in GeoJSON
+        self.polygons = polygons
+        boxes = [outline.bounding_box for outline, holes in polygons]
+        self.min_lon = min(box.min_point.x for box in boxes)
+        self.max_lon = max(box.max_point.x for box in boxes)
+        self.min_lat = min(box.min_point.y for box in boxes)
+        self.max_lat = max(box.max_point.y for box in boxes)
+
+    def contains(self, lat, lon):
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon):
+            return False
+        point = Vec2(lon, lat)
+        for outline, holes in self.polygons:
+            if outline.contains_point(point) and not any(hole.contains_point(point) for hole in holes):
+                return True
+        return False
+
+
+class Geofences:
+    """Finds the zone of a position through a grid index over the zones' bounding boxes.
+
+    Every grid cell lists the zones overlapping it, so a lookup only tests the polygons
+    of the few zones near the position, however many zones there are.
+    """
+
+    def __init__(self, zones, cell_size=GEOFENCE_CELL_SIZE):
+        self.zones = zones
+        self.cell_size = cell_size
+        self.cells = {}
+        for zone in zones:
+            for lat_cell in range(self.cell(zone.min_lat), self.cell(zone.max_lat) + 1):
+                for lon_cell in range(self.cell(zone.min_lon), self.cell(zone.max_lon) + 1):
+                    self.cells.setdefault((lat_cell, lon_cell), []).append(zone)
+
+    def cell(self, degrees):
+        return int(degrees // self.cell_size)
+
+    def find_all(self, lats, lons):
+        """Zone of every position of the two NumPy arrays, None where there is none."""
+        zones = [None] * len(lats)
+        if not self.cells:
+            return zones
+        # only positions in a cell that has zones need the exact polygon test
+        lat_cells = numpy.floor_divide(lats, self.cell_size).astype(numpy.int64)
+        lon_cells = numpy.floor_divide(lons, self.cell_size).astype(numpy.int64)
+        known_lat = numpy.array([cell[0] for cell in self.cells], dtype=numpy.int64)
+        known_lon = numpy.array([cell[1] for cell in self.cells], dtype=numpy.int64)
+        candidates = numpy.isin(lat_cells, known_lat) & numpy.isin(lon_cells, known_lon)
+        for index in numpy.flatnonzero(candidates):
+            zones[index] = self.find(float(lats[index]), float(lons[index]))
+        return zones
+
+    def find(self, lat, lon):
+        # zones are checked in the order they were defined, the first match wins
+        for zone in self.cells.get((self.cell(lat), self.cell(lon)), ()):
+            if zone.contains(lat, lon):
+                return zone
+        return None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            features = json.load(f)["features"]
+
+        zones = []
+        names = set()
+        for index, feature in enumerate(features):
+            geometry = feature["geometry"]
+            properties = feature.get("properties") or {}
+            if geometry["type"] == "Polygon":
+                rings = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                rings = geometry["coordinates"]
+            else:
+                print(f"Ignoring geofence {index} of unsupported type {geometry['type']}")
+                continue
+            polygons = [
+                (Polygon([Vec2(*point[:2]) for point in outline]),
+                 [Polygon([Vec2(*point[:2]) for point in hole]) for hole in holes])
+                for outline, *holes in rings
+            ]
+            name = properties.get("name", str(index))
+            # the name labels the zone's metrics, which must be unique
+            if name in names:
+                raise ValueError(f"Zone name {name} is used more than once")
+            names.add(name)
+            zones.append(Zone(
+                name,
+                properties.get("action", "suppress"),
+                polygons,
+                properties.get("publish_interval")
+            ))
+        return cls(zones)
+
+    @classmethod
+    def default(cls):
+        # the bus depot in Herrenberg
+        outline = Polygon([Vec2(8.81578, 48.64853), Vec2(8.81885, 48.64853), Vec2(8.81885, 48.64936), Vec2(8.81578, 48.64936)])
+        return cls([Zone("bus depot", "suppress", [(outline, [])])])
+
+
+TripMatch = namedtuple("TripMatch", [
+    "trip_id", "route_id", "route_short_name", "mode", "direction_id", "headsign",
+    "start_date", "start_time", "stop_id", "stop_sequence"
+])
+
+# GTFS route_type (and extended route type by hundreds) to the mode of the MQTT topic
+ROUTE_MODES = {0: "tram", 1: "subway", 2: "rail", 3: "bus", 4: "ferry", 5: "cablecar", 6: "gondola",
+    7: "funicular", 11: "trolleybus", 12: "monorail"}
+EXTENDED_ROUTE_MODES = {100: "rail", 200: "bus", 400: "subway", 700: "bus", 800: "trolleybus",
+    900: "tram", 1000: "ferry", 1300: "gondola", 1400: "funicular"}
+
+
+def distance_to_segment(lat, lon, lat1, lon1, lat2, lon2):
+    """Distance in meters from a position to a segment and how far along the segment it is."""
+    # equirectangular around the position, plenty accurate over the length of a segment
+    scale = math.cos(math.radians(lat)) * 111320
+    x1, y1 = (lon1 - lon) * scale, (lat1 - lat) * 110540
+    x2, y2 = (lon2 - lon) * scale, (lat2 - lat) * 110540
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    fraction = 0.0 if length == 0 else min(max(-(x1 * dx + y1 * dy) / length, 0.0), 1.0)
+    return math.hypot(x1 + fraction * dx, y1 + fraction * dy), fraction
+
+
+def parse_gtfs_time(value):
+    # seconds since the start of the service day, may be beyond 24:00:00
+    hours, minutes, seconds = value.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+class Trip:
+    __slots__ = ("id", "route_id", "route_short_name", "mode", "service_id", "direction_id",
+        "headsign", "start_time", "times", "stops", "sequences", "shape", "breaks")
+
+    def __init__(self, id, route, service_id, direction_id, headsign):
+        self.id = id
+        self.route_id, self.route_short_name, self.mode = route
+        self.service_id = service_id
+        self.direction_id = direction_id
+        self.headsign = headsign
+        # departure time, stop index and stop_sequence of every stop, in order
+        self.times = array("i")
+        self.stops = array("i")
+        self.sequences = array("i")
+        # (lats, lons) of the trip's shape and the index of the shape point at every stop
+        self.shape = None
+        self.breaks = None
+
+
+class TripMatcher:
+    """Matches vehicle positions to the trips of a static GTFS feed.
+
+    The feed is loaded once into arrays: the stop times of every trip, the visits of every
+    stop sorted by time and a grid over the stops. A vehicle without a trip is matched
+    against the trips passing the stops around it at about that time. Once it has a trip,
+    an update only checks the next few segments of that trip, and the vehicle is only
+    matched from scratch again after it left the trip.
+    """
+
+    def __init__(self, rows, cell_size=MATCH_CELL_SIZE):
+        self.cell_size = cell_size
+        agency = next(iter(rows("agency.txt")))
+        self.timezone = ZoneInfo(agency["agency_timezone"])
+
+        self.stop_ids = []
+        self.stop_lats = array("d")
+        self.stop_lons = array("d")
+        stop_index = {}
+        for row in rows("stops.txt"):
+            if not row.get("stop_lat") or not row.get("stop_lon"):
+                continue
+            stop_index[row["stop_id"]] = len(self.stop_ids)
+            self.stop_ids.append(row["stop_id"])
+            self.stop_lats.append(float(row["stop_lat"]))
+            self.stop_lons.append(float(row["stop_lon"]))
+
+        routes = {}
+        for row in rows("routes.txt"):
+            route_type = int(row.get("route_type") or 3)
+            mode = ROUTE_MODES.get(route_type) or EXTENDED_ROUTE_MODES.get(route_type // 100 * 100, "bus")
+            routes[row["route_id"]] = (row["route_id"], row.get("route_short_name") or "", mode)
+
+        shapes = {}
+        for row in rows("shapes.txt"):
+            shapes.setdefault(row["shape_id"], []).append(
+                (int(row["shape_pt_sequence"]), float(row["shape_pt_lat"]), float(row["shape_pt_lon"])))
+        for shape_id, points in shapes.items():
+            points.sort()
+            shapes[shape_id] = (array("d", (point[1] for point in points)), array("d", (point[2] for point in points)))
+
+        self.trips = []
+        trip_index = {}
+        trip_shapes = []
+        for row in rows("trips.txt"):
+            if row["route_id"] not in routes:
+                continue
+            trip_index[row["trip_id"]] = len(self.trips)
+            self.trips.append(Trip(row["trip_id"], routes[row["route_id"]], row["service_id"],
+                int(row.get("direction_id") or 0), row.get("trip_headsign") or ""))
+            trip_shapes.append(row.get("shape_id"))
+
+        stop_times = [[] for trip in self.trips]
+        for row in rows("stop_times.txt"):
+            index = trip_index.get(row["trip_id"])
+            stop = stop_index.get(row["stop_id"])
+            departure = row.get("departure_time") or row.get("arrival_time")
+            # stops without a time of their own don't help matching
+            if index is not None and stop is not None and departure:
+                stop_times[index].append((int(row["stop_sequence"]), parse_gtfs_time(departure), stop))
+
+        # trips passing every stop as (time, trip index, position in the trip), sorted by time
+        visits = [[] for stop in self.stop_ids]
+        breaks = {}
+        for index, (trip, times) in enumerate(zip(self.trips, stop_times)):
+            times.sort()
+            trip.sequences.extend(sequence for sequence, departure, stop in times)
+            trip.times.extend(departure for sequence, departure, stop in times)
+            trip.stops.extend(stop for sequence, departure, stop in times)
+            if len(times) < 2:
+                continue
+            trip.start_time = "%02d:%02d:%02d" % (trip.times[0] // 3600, trip.times[0] // 60 % 60, trip.times[0] % 60)
+            for position, stop in enumerate(trip.stops):
+                visits[stop].append((trip.times[position], index, position))
+            shape = shapes.get(trip_shapes[index])
+            if shape is not None:
+                # trips of the same shape and stops share the positions of their stops on it
+                key = (trip_shapes[index], trip.stops.tobytes())
+                if key not in breaks:
+                    breaks[key] = self.shape_breaks(shape, trip.stops)
+                trip.shape = shape
+                trip.breaks = breaks[key]
+
+        self.visit_times = []
+        self.visit_trips = []
+        self.visit_positions = []
+        for stop_visits in visits:
+            stop_visits.sort()
+            self.visit_times.append(array("i", (visit[0] for visit in stop_visits)))
+            self.visit_trips.append(array("i", (visit[1] for visit in stop_visits)))
+            self.visit_positions.append(array("i", (visit[2] for visit in stop_visits)))
+
+        self.cells = {}
+        for stop, (lat, lon) in enumerate(zip(self.stop_lats, self.stop_lons)):
+            if self.visit_times[stop]:
+                self.cells.setdefault((self.cell(lat), self.cell(lon)), []).append(stop)
+
+        self.calendar = {}
+        for row in rows("calendar.txt"):
+            weekdays = tuple(row[day] == "1" for day in
+                ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"))
+            self.calendar[row["service_id"]] = (row["start_date"], row["end_date"], weekdays)
+        self.calendar_dates = {}
+        for row in rows("calendar_dates.txt"):
+            self.calendar_dates.setdefault(row["date"], {})[row["service_id"]] = row["exception_type"]
+        self.active_services = {}
+
+        # (trip index, service date, segment, scheduled time) per vehicle, the segment being
+        # the one between stop `segment` and the next stop of the trip
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def cell(self, degrees):
+        return int(degrees // self.cell_size)
+
+    def shape_breaks(self, shape, stops):
+        # index of the shape point closest to every stop, never going back along the shape
+        lats, lons = shape
+        breaks = array("i")
+        start = 0
+        for stop in stops:
+            lat, lon = self.stop_lats[stop], self.stop_lons[stop]
+            scale = math.cos(math.radians(lat)) ** 2
+            start = min(range(start, len(lats)),
+                key=lambda point: (lats[point] - lat) ** 2 + (lons[point] - lon) ** 2 * scale)
+            breaks.append(start)
+        return breaks
+
+    def services(self, date):
+        services = self.active_services.get(date)
+        if services is None:
+            day = date.strftime("%Y%m%d")
+            weekday = date.weekday()
+            services = set(service_id for service_id, (start, end, weekdays) in self.calendar.items()
+                if start <= day <= end and weekdays[weekday])
+            for service_id, exception_type in self.calendar_dates.get(day, {}).items():
+                if exception_type == "1":
+                    services.add(service_id)
+                else:
+                    services.discard(service_id)
+            if len(self.active_services) > 7:
+                self.active_services.clear()
+            self.active_services[date] = services
+        return services
+
+    def segment_distance(self, trip, segment, lat, lon):
+        # distance to the trip's shape between two stops, to the straight line without a shape
+        first, last = trip.stops[segment], trip.stops[segment + 1]
+        distance, fraction = distance_to_segment(lat, lon, self.stop_lats[first], self.stop_lons[first],
+            self.stop_lats[last], self.stop_lons[last])
+        if trip.shape is not None and trip.breaks[segment + 1] > trip.breaks[segment]:
+            lats, lons = trip.shape
+            distance = min(distance_to_segment(lat, lon, lats[point], lons[point], lats[point + 1], lons[point + 1])[0]
+                for point in range(trip.breaks[segment], trip.breaks[segment + 1]))
+        return distance, fraction
+
+    def score(self, trip, segments, lat, lon, seconds):
+        # best (score, segment, fraction, scheduled time at the position) of the trip's segments
+        # for the position at seconds into the service day, None when the vehicle is not on
+        # any of them
+        best = None
+        for segment in segments:
+            distance, fraction = self.segment_distance(trip, segment, lat, lon)
+            if distance > MATCH_MAX_DISTANCE:
+                continue
+            scheduled = trip.times[segment] + fraction * (trip.times[segment + 1] - trip.times[segment])
+            delay = seconds - scheduled
+            if abs(delay) > MATCH_MAX_DELAY:
+                continue
+            score = distance + MATCH_DELAY_WEIGHT * abs(delay)
+            if best is None or score < best[0]:
+                best = (score, segment, fraction, scheduled)
+        return best
+
+    def service_days(self, timestamp):
+        # trips after midnight belong to the previous service day
+        local = datetime.datetime.fromtimestamp(timestamp / 1000, self.timezone)
+        seconds = local.hour * 3600 + local.minute * 60 + local.second
+        date = local.date()
+        return ((date, seconds), (date - datetime.timedelta(days=1), seconds + 86400))
+
+    def match(self, id, lat, lon, timestamp):
+        """TripMatch of the vehicle at the position at timestamp (in ms), None without a trip."""
+        with self.lock:
+            state = self.states.get(id)
+            if state is not None:
+                state = self.follow(state, lat, lon, timestamp)
+            if state is None:
+                state = self.find(lat, lon, timestamp)
+            if state is None:
+                self.states.pop(id, None)
+                return None
+            self.states[id] = state
+
+        index, date, segment, scheduled = state
+        trip = self.trips[index]
+        # the vehicle is heading to the stop at the end of its segment
+        return TripMatch(trip.id, trip.route_id, trip.route_short_name, trip.mode, trip.direction_id,
+            trip.headsign, date.strftime("%Y%m%d"), trip.start_time, self.stop_ids[trip.stops[segment + 1]],
+            trip.sequences[segment + 1])
+
+    def follow(self, state, lat, lon, timestamp):
+        index, date, segment, scheduled = state
+        trip = self.trips[index]
+        for day, seconds in self.service_days(timestamp):
+            if day != date:
+                continue
+            last = len(trip.stops) - 2
+            # vehicles move on, so only the segment it was on and the next ones are checked
+            best = self.score(trip, range(max(segment - 1, 0), min(segment + 3, last + 1)), lat, lon, seconds)
+            if best is None or best[3] < scheduled - MATCH_MAX_BACKTRACK:
+                # it left the trip or is going the other way
+                return None
+            if best[1] == last and best[2] == 1.0:
+                # it arrived at the terminus, where it may start its next trip
+                return None
+            return (index, date, best[1], best[3])
+        return None
+
+    def find(self, lat, lon, timestamp):
+        best = None
+        lat_cell, lon_cell = self.cell(lat), self.cell(lon)
+        nearby = [stop for lat_offset in (-1, 0, 1) for lon_offset in (-1, 0, 1)
+            for stop in self.cells.get((lat_cell + lat_offset, lon_cell + lon_offset), ())]
+        for date, seconds in self.service_days(timestamp):
+            services = self.services(date)
+            seen = set()
+            for stop in nearby:
+                times = self.visit_times[stop]
+                start = bisect.bisect_left(times, seconds - MATCH_MAX_DELAY)
+                end = bisect.bisect_right(times, seconds + MATCH_MAX_DELAY)
+                for visit in range(start, end):
+                    index, position = self.visit_trips[stop][visit], self.visit_positions[stop][visit]
+                    trip = self.trips[index]
+                    if trip.service_id not in services or (index, position) in seen:
+                        continue
+                    seen.add((index, position))
+                    # the segments before and after the stop
+                    segments = range(max(position - 1, 0), min(position + 1, len(trip.stops) - 1))
+                    score = self.score(trip, segments, lat, lon, seconds)
+                    if score is not None and (best is None or score[0] < best[0]):
+                        best = (score[0], (index, date, score[1], score[3]))
+        return best[1] if best is not None else None
+
+    def retain(self, ids):
+        with self.lock:
+            for id in [id for id in self.states if id not in ids]:
+                del self.states[id]
+
+    @classmethod
+    def load(cls, path):
+        if os.path.isdir(path):
+            def rows(name):
+                if not os.path.exists(os.path.join(path, name)):
+                    return
+                with open(os.path.join(path, name), encoding="utf-8-sig", newline="") as f:
+                    yield from csv.DictReader(f)
+        else:
+            archive = zipfile.ZipFile(path)
+            def rows(name):
+                if name not in archive.namelist():
+                    return
+                with archive.open(name) as f:
+                    yield from csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+        matcher = cls(rows)
+        print(f"Loaded {len(matcher.trips)} trips and {len(matcher.stop_ids)} stops from {path}")
+        return matcher
+
+
+class Shard:
+    """The devices this replica is responsible for, chosen by rendezvous hashing.
+
+    Every device belongs to the replica with the highest hash of replica and device id.
+    When a replica joins or leaves, only the devices it takes over or gives up move, all
+    others stay where they are.
+    """
+
+    def __init__(self, replica, replicas):
+        self.replica = replica
+        self.replicas = sorted(replicas)
+
+    def owns(self, id):
+        if len(self.replicas) == 1:
+            return self.replicas[0] == self.replica
+        return max(self.replicas, key=lambda replica: self.weight(replica, id)) == self.replica
+
+    @staticmethod
+    def weight(replica, id):
+        return int.from_bytes(hashlib.blake2b(f"{replica}/{id}".encode(), digest_size=8).digest(), "big")
+
+    @classmethod
+    def static(cls):
+        return cls(str(SHARD_INDEX), [str(index) for index in range(SHARD_COUNT)])
+
 
 class ThingsboardClient:
     def __init__(self):
         self.base_url = os.environ['THINGSBOARD_HOST']
         self.session = requests.Session()
         retries = Retry(total=4, backoff_factor=1, status_forcelist=[ 502, 503, 504 ])
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        self.data = []
-        self.bus_depot = BoundingBox([
-            Vec2(48.64936, 8.81578),
-            Vec2(48.64853, 8.81885)
+        # one pooled connection per fetch worker, so concurrent requests don't queue for a socket
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=1, pool_maxsize=FETCH_CONCURRENCY)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Device telemetry isn't retried, the next poll is its retry. Retried read timeouts
+        # would keep a slow device's worker, and with it the poll, busy for several timeouts.
+        self.session.mount(f"{self.base_url}/plugins/telemetry/",
+            HTTPAdapter(max_retries=0, pool_connections=1, pool_maxsize=FETCH_CONCURRENCY))
+        self.executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="fetch")
+        if THINGSBOARD_DEVICE_IDS:
+            self.all_device_ids = [id.strip() for id in THINGSBOARD_DEVICE_IDS.split(",") if id.strip()]
+        else:
+            self.all_device_ids = [
+                '17e40b70-5b04-11eb-98a5-133ebfea8661',
+                '66df3b20-5b02-11eb-98a5-133ebfea8661',
+                '14341fa0-5b00-11eb-98a5-133ebfea8661',
+                'fef36ff0-5afb-11eb-98a5-133ebfea8661'
             ]
-        )
-        print(self.bus_depot)
+        # until other replicas announce themselves in "mqtt" mode, this one owns all devices
+        self.shard = Shard(SHARD_REPLICA_ID, [SHARD_REPLICA_ID]) if SHARDING == "mqtt" else Shard.static()
+        # the devices of the fleet this replica polls
+        self.device_ids = [id for id in self.all_device_ids if self.shard.owns(id)]
+        # called with the added and removed device ids whenever discovery changes the fleet
+        self.device_listeners = []
+        # discovery and resharding change the devices from different threads
+        self.devices_lock = threading.RLock()
+        self.data = VehicleStateStore()
+        # latest (ts, value) per telemetry key and device, as received over the websocket
+        self.telemetry = {}
+        # called with every vehicle updated by the websocket subscription
+        self.listeners = []
+        self.token = None
+        self.token_refresh = None
+        self.token_expiry = 0
+        self.token_lock = threading.Lock()
+        if GEOFENCES_FILE:
+            self.geofences = Geofences.load(GEOFENCES_FILE)
+        else:
+            self.geofences = Geofences.default()
+        print(f"Loaded {len(self.geofences.zones)} geofences")
+        self.capacities = CapacityRegistry.load(CAPACITY_FILE)
+        self.matcher = TripMatcher.load(GTFS_PATH) if GTFS_PATH else None
+        if CAPACITY_ATTRIBUTES:
+            # devices found by discovery get their capacities right away instead of with the
+            # next refresh
+            self.device_listeners.append(self.fetch_added_capacities)
 
     def get_token(self):
+        started = time.perf_counter()
+        with self.token_lock:
+            if self.token is None or self.token_expiry <= time.time():
+                self.login()
+            token_time.observe(time.perf_counter() - started)
+            return self.token
+
+    def login(self):
         token_url = f"{self.base_url}/auth/login"
 
         payload = {
@@ -39,56 +1018,485 @@ class ThingsboardClient:
             "password": os.environ['THINGSBOARD_PASSWORD']
         }
 
-        response = self.session.post(token_url, json=payload)
-        return response.json()["token"]
+        response = self.session.post(token_url, json=payload, timeout=FETCH_TIMEOUT)
+        self.store_token(response.json())
+        print("Logged in to thingsboard")
 
-    def fetch_timeseries(self, id, token):
+    def store_token(self, tokens):
+        self.token = tokens["token"]
+        self.token_refresh = tokens.get("refreshToken")
+        self.token_expiry = self.decode_token_expiry(self.token)
+
+    def decode_token_expiry(self, token):
+        # the exp claim of the unverified JWT payload, we only need it to know when to refresh
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload))["exp"]
+        except (IndexError, ValueError, KeyError):
+            logger.warning("Could not read expiry of thingsboard token, refreshing it early")
+            return time.time() + TOKEN_REFRESH_MARGIN + TOKEN_CHECK_INTERVAL
+
+    def refresh_token(self):
+        if self.token_refresh is None:
+            self.login()
+            return
+
+        refresh_url = f"{self.base_url}/auth/token"
+        response = self.session.post(refresh_url, json={"refreshToken": self.token_refresh}, timeout=FETCH_TIMEOUT)
+        if(response.status_code == 200):
+            self.store_token(response.json())
+            logger.debug("Refreshed thingsboard token")
+        else:
+            print(f"Thingsboard token could not be refreshed ({response.status_code}), logging in again")
+            self.login()
+
+    def refresh_token_if_expiring(self):
+        with self.token_lock:
+            if self.token is None or self.token_expiry - time.time() > TOKEN_REFRESH_MARGIN:
+                return
+            try:
+                self.refresh_token()
+            except requests.exceptions.RequestException as e:
+                print(f"Thingsboard token could not be refreshed: {e}")
+
+    def renew_token(self, rejected_token):
+        # Called after a 401. Only the first worker that sees the rejected token logs in
+        # again, all others pick up the new token.
+        with self.token_lock:
+            if self.token == rejected_token:
+                self.login()
+            return self.token
+
+    def fetch_timeseries(self, id, token, retry=True):
         auth_headers = {
             "X-Authorization": f"Bearer {token}"
         }
         timeseries_url = f"{self.base_url}/plugins/telemetry/DEVICE/{id}/values/timeseries"
-        resp = self.session.get(timeseries_url, headers=auth_headers)
+        started = time.perf_counter()
+        try:
+            # only the keys we use, devices may report dozens of others
+            params = {"keys": ",".join(TELEMETRY_KEYS)}
+            resp = self.session.get(timeseries_url, params=params, headers=auth_headers, timeout=FETCH_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            fetch_failures.inc()
+            print(f"Data for device {id} could not be fetched: {e}")
+            return None
+        finally:
+            device_fetch_time.observe(time.perf_counter() - started)
+        if(resp.status_code == 401 and retry):
+            return self.fetch_timeseries(id, self.renew_token(token), retry=False)
         if(resp.status_code == 200):
             return resp.json()
         else:
+            fetch_failures.inc()
             print(f"Data for device {id} could not be fetched")
             return None
 
+    def discover_devices(self):
+        token = self.get_token()
+        auth_headers = {
+            "X-Authorization": f"Bearer {token}"
+        }
+        if THINGSBOARD_CUSTOMER_ID:
+            devices_url = f"{self.base_url}/customer/{THINGSBOARD_CUSTOMER_ID}/devices"
+        else:
+            devices_url = f"{self.base_url}/tenant/devices"
+        params = {"pageSize": DEVICE_PAGE_SIZE, "page": 0}
+        if THINGSBOARD_DEVICE_TYPE:
+            params["type"] = THINGSBOARD_DEVICE_TYPE
+
+        ids = []
+        while True:
+            try:
+                resp = self.session.get(devices_url, params=params, headers=auth_headers, timeout=FETCH_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                print(f"Devices could not be discovered: {e}")
+                return
+            if(resp.status_code != 200):
+                print(f"Devices could not be discovered ({resp.status_code})")
+                return
+            page = resp.json()
+            ids.extend(device["id"]["id"] for device in page["data"])
+            if not page.get("hasNext"):
+                break
+            params["page"] += 1
+
+        self.update_devices(ids)
+
+    def update_devices(self, ids):
+        with self.devices_lock:
+            self.all_device_ids = ids
+            owned = [id for id in ids if self.shard.owns(id)]
+            known = set(self.device_ids)
+            added = [id for id in owned if id not in known]
+            removed = known.difference(owned)
+            if not added and not removed:
+                return
+
+            self.device_ids = owned
+            for id in removed:
+                self.data.remove(id)
+                self.telemetry.pop(id, None)
+            print(f"Polling {len(owned)} of {len(ids)} devices, {len(added)} added and {len(removed)} removed")
+
+            for listener in self.device_listeners:
+                listener(added, removed)
+
+    def update_replicas(self, replicas):
+        with self.devices_lock:
+            if sorted(replicas) == self.shard.replicas:
+                return
+            print(f"Sharding devices between {len(replicas)} replicas")
+            self.shard = Shard(self.shard.replica, replicas)
+            self.update_devices(self.all_device_ids)
+
+    def find_zone(self, lat, lon):
+        zone = self.geofences.find(lat, lon)
+        if zone is not None and zone.action == "suppress":
+            zone_suppressed.inc()
+            print(f"Vehicle at location {lat}, {lon} is at {zone.name}. Not sending update.")
+        return zone
+
+    def match_trip(self, id, lat, lon, timestamp):
+        if self.matcher is None:
+            return None
+        return self.matcher.match(id, lat, lon, timestamp)
+
+    def fetch_latest_telemetry(self, ids, token):
+        results = {}
+        self.query_entities(self.latest_telemetry_query(ids), token,
+            lambda page: self.parse_latest_telemetry(page, results), "Data for devices", bulk_fetch_time)
+        return results
+
+    def query_entities(self, query, token, on_page, description, request_time=None):
+        # Pages through an entity data query and hands every page to on_page, returns
+        # whether all pages were read.
+        query_url = f"{self.base_url}/entitiesQuery/find"
+        retry = True
+        while True:
+            auth_headers = {
+                "X-Authorization": f"Bearer {token}"
+            }
+            started = time.perf_counter()
+            try:
+                resp = self.session.post(query_url, json=query, headers=auth_headers, timeout=FETCH_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                fetch_failures.inc()
+                print(f"{description} could not be fetched: {e}")
+                return False
+            finally:
+                if request_time is not None:
+                    request_time.observe(time.perf_counter() - started)
+            if(resp.status_code == 401 and retry):
+                token = self.renew_token(token)
+                retry = False
+                continue
+            if(resp.status_code != 200):
+                fetch_failures.inc()
+                print(f"{description} could not be fetched ({resp.status_code})")
+                return False
+
+            page = resp.json()
+            on_page(page)
+            if not page.get("hasNext"):
+                return True
+            query["pageLink"]["page"] += 1
+
+    def latest_telemetry_query(self, ids):
+        return {
+            "entityFilter": {
+                "type": "entityList",
+                "entityType": "DEVICE",
+                "entityList": ids
+            },
+            "pageLink": {"page": 0, "pageSize": BULK_PAGE_SIZE},
+            "latestValues": [{"type": "TIME_SERIES", "key": key} for key in TELEMETRY_KEYS]
+        }
+
+    def capacity_query(self, ids):
+        return {
+            "entityFilter": {
+                "type": "entityList",
+                "entityType": "DEVICE",
+                "entityList": ids
+            },
+            "pageLink": {"page": 0, "pageSize": BULK_PAGE_SIZE},
+            "latestValues": [{"type": "SERVER_ATTRIBUTE", "key": key} for key in CAPACITY_ATTRIBUTE_KEYS.values()]
+        }
+
+    def parse_capacities(self, page, capacities):
+        for entity in page["data"]:
+            latest = entity.get("latest", {}).get("SERVER_ATTRIBUTE", {})
+            capacity = CapacityRegistry.parse({
+                name: latest.get(key, {}).get("value") for name, key in CAPACITY_ATTRIBUTE_KEYS.items()
+            })
+            if capacity is not None:
+                capacities[entity["entityId"]["id"]] = capacity
+
+    def fetch_capacities(self, ids=None):
+        """Reads the capacity attributes of the given devices, of all devices by default."""
+        replace = ids is None
+        ids = list(self.device_ids) if ids is None else list(ids)
+        capacities = {}
+        complete = self.query_entities(self.capacity_query(ids), self.get_token(),
+            lambda page: self.parse_capacities(page, capacities), "Vehicle capacities")
+        if not complete:
+            # keep what we had rather than falling back to the default capacity
+            return
+        self.update_capacities(capacities, replace)
+
+    def fetch_added_capacities(self, added, removed):
+        if added:
+            self.fetch_capacities(added)
+
+    def update_capacities(self, capacities, replace=True):
+        changed = self.capacities.update(capacities, replace)
+        print(f"Read capacities of {len(capacities)} vehicles, {len(changed)} changed")
+        # vehicles keep their telemetry timestamp, so they wouldn't be updated by the next
+        # poll and need their occupancy recalculated here
+        for id in changed:
+            vehicle = self.data.get(id)
+            if vehicle is not None:
+                occupancy, percentage = self.capacities.occupancy(id, vehicle.pax)
+                self.data.update(id, vehicle.latitude, vehicle.longitude, vehicle.pax,
+                    occupancy, percentage, vehicle.timestamp, vehicle.zone, vehicle.trip)
+
+    def parse_latest_telemetry(self, page, results):
+        for entity in page["data"]:
+            latest = entity.get("latest", {}).get("TIME_SERIES", {})
+            # keys without telemetry come back with an empty value
+            if all(latest.get(key, {}).get("value") for key in TELEMETRY_KEYS):
+                # same shape as the response of fetch_timeseries
+                results[entity["entityId"]["id"]] = {
+                    key: [{"ts": latest[key]["ts"], "value": latest[key]["value"]}] for key in TELEMETRY_KEYS
+                }
+
     def fetch_vehicle_data(self):
+        started = time.perf_counter()
         token = self.get_token()
-        ids = [
-            '17e40b70-5b04-11eb-98a5-133ebfea8661',
-            '66df3b20-5b02-11eb-98a5-133ebfea8661',
-            '14341fa0-5b00-11eb-98a5-133ebfea8661',
-            'fef36ff0-5afb-11eb-98a5-133ebfea8661'
-        ]
-        vehicles = []
-        for id in ids:
-            timeseries = self.fetch_timeseries(id, token)
+        ids = list(self.device_ids)
+        if FETCH_MODE == "bulk":
+            latest = self.fetch_latest_telemetry(ids, token)
+            results = [latest.get(id) for id in ids]
+        else:
+            # each device is fetched by its own worker with its own timeout, so a slow device
+            # only delays its own result and not the requests for the rest of the fleet
+            futures = [self.executor.submit(self.fetch_timeseries, id, token) for id in ids]
+            done, pending = wait(futures, timeout=POLL_INTERVAL)
+            if pending:
+                # still queued or running when the next poll is due, they are given up on
+                for future in pending:
+                    future.cancel()
+                fetch_failures.inc(len(pending))
+                print(f"Data for {len(pending)} devices could not be fetched within {POLL_INTERVAL}s")
+            results = [future.result() if future in done else None for future in futures]
+        poll_time.observe(time.perf_counter() - started)
+        self.update_vehicles(ids, results)
+
+    def update_vehicles(self, ids, results):
+        if BATCH_TRANSFORM and numpy is not None and len(ids) >= BATCH_TRANSFORM_MIN_SIZE:
+            self.update_vehicles_batch(ids, results)
+            return
+
+        reported = set()
+        unchanged = 0
+        for id, timeseries in zip(ids, results):
             if(timeseries != None):
 
+                timestamp = max(timeseries[key][0]["ts"] for key in TELEMETRY_KEYS)
+                vehicle = self.data.get(id)
+                if vehicle is not None and vehicle.timestamp == timestamp:
+                    # nothing new since the last poll, the state the publisher knows stays as is
+                    reported.add(id)
+                    unchanged += 1
+                    continue
+
                 lat = float(timeseries["latitude"][0]["value"])
                 lon = float(timeseries["longitude"][0]["value"])
                 pax = int(timeseries["pax"][0]["value"])
-                vehicle = {
-                    "id": id,
-                    "latitude" : lat,
-                    "longitude" : lon,
-                    "pax" : pax
-                }
 
-                point = Vec2(lat, lon)
-                if not self.bus_depot.contains_point(point):
-                    vehicles.append(vehicle)
+                zone = self.find_zone(lat, lon)
+                if zone is None or zone.action != "suppress":
+                    occupancy, percentage = self.capacities.occupancy(id, pax)
+                    trip = self.match_trip(id, lat, lon, timestamp)
+                    self.data.update(id, lat, lon, pax, occupancy, percentage, timestamp, zone, trip)
+                    reported.add(id)
 
-                else:
-                    print(f"Vehicle at location {point} is at bus depot. Not sending update.")
+        self.data.retain(reported)
+        if self.matcher is not None:
+            self.matcher.retain(reported)
+        print(f"Fetched vehicle data from thingsboard, {unchanged} vehicles unchanged")
+
+    def update_vehicles_batch(self, ids, results):
+        # Same result as the loop in update_vehicles, but timestamps, coordinates, occupancy and
+        # the zone lookup are computed column-wise for the whole poll.
+        results = list(results)
+        fetched = [index for index, timeseries in enumerate(results) if timeseries != None]
+        reported = set(ids[index] for index in fetched)
 
-        print("Fetched vehicle data from thingsboard")
-        self.data = vehicles
+        # one pass over the parsed JSON per key, everything after it works on whole columns
+        latest = {key: [results[index][key][0] for index in fetched] for key in TELEMETRY_KEYS}
+        timestamps = numpy.maximum.reduce([
+            numpy.fromiter((value["ts"] for value in latest[key]), numpy.int64, len(fetched))
+            for key in TELEMETRY_KEYS
+        ])
+        previous = numpy.fromiter((
+            vehicle.timestamp if vehicle is not None else -1
+            for vehicle in map(self.data.get, (ids[index] for index in fetched))
+        ), numpy.int64, len(fetched))
+        changed = numpy.flatnonzero(timestamps != previous)
+
+        lats = numpy.array([latest["latitude"][row]["value"] for row in changed.tolist()], dtype=numpy.float64)
+        lons = numpy.array([latest["longitude"][row]["value"] for row in changed.tolist()], dtype=numpy.float64)
+        paxs = numpy.array([latest["pax"][row]["value"] for row in changed.tolist()]).astype(numpy.int64)
+        capacities = numpy.fromiter((self.capacities.total(ids[fetched[row]]) for row in changed.tolist()),
+            numpy.int64, len(changed))
+        percentages = paxs / capacities * 100
+        # same rounding and threshold search as CapacityRegistry.occupancy
+        occupancies = numpy.array(self.capacities.statuses)[numpy.maximum(
+            numpy.searchsorted(self.capacities.thresholds, percentages, side="right") - 1, 0)]
+        zones = self.geofences.find_all(lats, lons)
+
+        updates = []
+        columns = zip(changed.tolist(), lats.tolist(), lons.tolist(), paxs.tolist(), occupancies.tolist(),
+            numpy.rint(percentages).astype(numpy.int64).tolist(), timestamps[changed].tolist(), zones)
+        for row, lat, lon, pax, occupancy, percentage, timestamp, zone in columns:
+            id = ids[fetched[row]]
+            if zone is not None and zone.action == "suppress":
+                zone_suppressed.inc()
+                print(f"Vehicle at location {lat}, {lon} is at {zone.name}. Not sending update.")
+                reported.discard(id)
+                continue
+            trip = self.match_trip(id, lat, lon, timestamp)
+            updates.append((id, lat, lon, pax, occupancy, percentage, timestamp, zone, trip))
+        self.data.update_many(updates)
+
+        self.data.retain(reported)
+        if self.matcher is not None:
+            self.matcher.retain(reported)
+        print(f"Fetched vehicle data from thingsboard, {len(fetched) - len(changed)} vehicles unchanged")
+
+    def update_telemetry(self, id, data):
+        # websocket updates only contain the keys that changed, so merge them into what we
+        # already know about the device
+        telemetry = self.telemetry.setdefault(id, {})
+        for key, values in data.items():
+            if values:
+                ts, value = values[0]
+                telemetry[key] = (ts, value)
+
+        if any(key not in telemetry for key in TELEMETRY_KEYS):
+            return
+
+        lat = float(telemetry["latitude"][1])
+        lon = float(telemetry["longitude"][1])
+        pax = int(telemetry["pax"][1])
+        timestamp = max(telemetry[key][0] for key in TELEMETRY_KEYS)
+
+        zone = self.find_zone(lat, lon)
+        if zone is not None and zone.action == "suppress":
+            self.data.remove(id)
+            return
+
+        previous = self.data.get(id)
+        occupancy, percentage = self.capacities.occupancy(id, pax)
+        trip = self.match_trip(id, lat, lon, timestamp)
+        vehicle = self.data.update(id, lat, lon, pax, occupancy, percentage, timestamp, zone, trip)
+        if vehicle is not previous:
+            for listener in self.listeners:
+                listener(vehicle)
 
     def get_vehicles(self):
-        return self.data
+        return self.data.values()
+
+
+class ThingsboardSubscriber:
+    """Receives telemetry pushed by ThingsBoard over its websocket API."""
+
+    def __init__(self, thingsboard):
+        self.thingsboard = thingsboard
+        self.connected = False
+        self.ws = None
+        self.subscriptions = {}
+        self.last_cmd_id = 0
+        self.stopped = Event()
+        thingsboard.device_listeners.append(self.update_subscriptions)
+
+    def websocket_url(self):
+        url = self.thingsboard.base_url.replace("http", "ws", 1)
+        return f"{url}/ws/plugins/telemetry?token={self.thingsboard.get_token()}"
+
+    def subscribe(self, ws, ids, unsubscribe=False):
+        if unsubscribe:
+            by_device = {id: cmd_id for cmd_id, id in self.subscriptions.items()}
+            commands = [{"cmdId": by_device[id], "unsubscribe": True} for id in ids if id in by_device]
+            for command in commands:
+                del self.subscriptions[command["cmdId"]]
+        else:
+            commands = []
+            for id in ids:
+                self.last_cmd_id += 1
+                self.subscriptions[self.last_cmd_id] = id
+                commands.append({
+                    "entityType": "DEVICE",
+                    "entityId": id,
+                    "scope": "LATEST_TELEMETRY",
+                    "cmdId": self.last_cmd_id,
+                    "keys": ",".join(TELEMETRY_KEYS)
+                })
+        if commands:
+            ws.send(json.dumps({"tsSubCmds": commands, "historyCmds": [], "attrSubCmds": []}))
+
+    def on_open(self, ws):
+        self.subscriptions = {}
+        self.subscribe(ws, self.thingsboard.device_ids)
+        self.connected = True
+        print(f"Subscribed to telemetry of {len(self.subscriptions)} devices")
+
+    def update_subscriptions(self, added, removed):
+        if not self.connected:
+            # all current devices are subscribed when the websocket (re)connects
+            return
+        try:
+            self.subscribe(self.ws, removed, unsubscribe=True)
+            self.subscribe(self.ws, added)
+        except websocket.WebSocketException as e:
+            print(f"Subscriptions could not be updated: {e}")
+
+    def on_message(self, ws, message):
+        update = json.loads(message)
+        id = self.subscriptions.get(update.get("subscriptionId"))
+        if id is None:
+            return
+        if update.get("errorCode"):
+            print(f"Subscription for device {id} failed: {update.get('errorMsg')}")
+            return
+        self.thingsboard.update_telemetry(id, update.get("data") or {})
+
+    def on_error(self, ws, error):
+        print(f"Thingsboard websocket error: {error}")
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.ws = websocket.WebSocketApp(self.websocket_url(),
+                on_open=self.on_open,
+                on_message=self.on_message,
+                on_error=self.on_error)
+            self.ws.run_forever(ping_interval=30)
+            self.connected = False
+            if self.stopped.is_set():
+                break
+            print("Thingsboard websocket closed, polling until it is reconnected")
+            self.stopped.wait(WEBSOCKET_RECONNECT_DELAY)
+
+    def start(self):
+        Thread(target=self.run, name="websocket", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.ws is not None:
+            self.ws.close()
 
 thingsboard_client = ThingsboardClient()
 
@@ -96,26 +1504,524 @@ def exception_hook(exctype):
     print(exctype.exc_value)
     os._exit(1)
 
-## https://stackoverflow.com/questions/22498038/improve-current-implementation-of-a-setinterval-python/22498708#22498708
-def call_repeatedly(interval, func, *args):
-    stopped = Event()
+class Job:
+    OVERRUN_POLICIES = ("skip", "coalesce", "catch_up")
+
+    def __init__(self, name, interval, func, overrun, offset):
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy {overrun} for job {name}")
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.overrun = overrun
+        self.offset = offset
+        self.next_run = None
+        self.duration = Histogram("job_duration_seconds", "Time a scheduled job took to run", labels={"job": name})
+        self.lag = Histogram("job_lag_seconds", "Delay between the deadline of a job and its start", labels={"job": name})
+        self.missed = Counter("job_missed_runs", "Runs not started on time because the previous run overran", labels={"job": name})
+
+
+class Scheduler:
+    """Runs jobs at a fixed rate on monotonic deadlines, every job on its own thread.
+
+    The deadlines don't move with the time a job takes, so a one second job really runs
+    once per second. The clock and the wait function can be replaced, e.g. in tests.
+    """
+
+    def __init__(self, clock=time.monotonic, wait=None):
+        self.clock = clock
+        self.stopped = Event()
+        self.wait = wait or self.stopped.wait
+        self.jobs = []
+
+    def add(self, name, interval, func, overrun="skip", jitter=0):
+        # the first run is in `interval` secs, plus the random offset of this job
+        job = Job(name, interval, func, overrun, random.uniform(0, jitter))
+        job.next_run = self.clock() + interval + job.offset
+        self.jobs.append(job)
+        threading.excepthook = exception_hook
+        Thread(target=self.loop, args=(job,), name=name, daemon=True).start()
+        return job
+
+    def loop(self, job):
+        while not self.stopped.is_set():
+            delay = job.next_run - self.clock()
+            if delay > 0 and self.wait(delay):
+                break
+            self.run_once(job)
+        print(f"Job {job.name} stopped")
+
+    def run_once(self, job):
+        started = self.clock()
+        job.lag.observe(max(started - job.next_run, 0))
+        job.func()
+        finished = self.clock()
+        job.duration.observe(finished - started)
+        job.next_run = self.next_deadline(job, finished)
+
+    def next_deadline(self, job, now):
+        next_run = job.next_run + job.interval
+        if next_run > now or job.overrun == "catch_up":
+            return next_run
+
+        missed = int((now - next_run) // job.interval) + 1
+        job.missed.inc(missed)
+        if job.overrun == "coalesce":
+            # one run right away for all the missed ones, then back on the original grid
+            return next_run + (missed - 1) * job.interval
+        return next_run + missed * job.interval
+
+    def stop(self):
+        self.stopped.set()
+
+scheduler = Scheduler()
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads and counts them by stack.
+
+    The dump is in the folded format read by flamegraph.pl and speedscope, one line per
+    stack from the thread name down to the innermost function followed by its number of
+    samples. Waiting threads are sampled too, so it is a wall-clock profile.
+    """
+
+    def __init__(self, path, interval=PROFILE_INTERVAL, dump_interval=PROFILE_DUMP_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.stacks = {}
+
+    def start(self):
+        atexit.register(self.dump)
+        Thread(target=self.run, name="profiler", daemon=True).start()
+        print(f"Writing profile to {self.path} every {self.dump_interval}s")
+
+    def run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump += self.dump_interval
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        profiler = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == profiler:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack = ";".join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def dump(self):
+        # written next to it and renamed, so a reader never gets half a profile
+        with open(self.path + ".tmp", "w") as f:
+            for stack, count in list(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Checkpoint:
+    """The last known state of the service, so that a restart can publish right away
+    instead of after a login and a full poll.
+
+    Only the telemetry of the vehicles is kept, their zones, occupancy and trips are
+    derived again on restore just like for a poll. The discovered devices, the capacities
+    read from ThingsBoard and the token are kept too. It is plain JSON, written next to the
+    file and renamed so that a crash while writing keeps the previous checkpoint.
+    """
+    VERSION = 1
+
+    def __init__(self, path, client, max_age=CHECKPOINT_MAX_AGE):
+        self.path = path
+        self.client = client
+        self.max_age = max_age
+
+    def save(self):
+        started = time.perf_counter()
+        client = self.client
+        state = {
+            "version": self.VERSION,
+            "written": time.time(),
+            "devices": client.all_device_ids,
+            "capacities": client.capacities.attributes,
+            "token": {"token": client.token, "refreshToken": client.token_refresh},
+            "vehicles": [(vehicle.id, vehicle.latitude, vehicle.longitude, vehicle.pax, vehicle.timestamp)
+                for vehicle in client.data.values()],
+        }
+        # it holds the token, so only we may read it
+        fd = os.open(self.path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(dump_json(state))
+        os.replace(self.path + ".tmp", self.path)
+        checkpoint_time.observe(time.perf_counter() - started)
+
+    def restore(self):
+        """Loads the checkpoint, returns whether there was a recent enough one."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print(f"Checkpoint {self.path} could not be read: {e}")
+            return False
+        if state.get("version") != self.VERSION:
+            print(f"Ignoring checkpoint {self.path} of version {state.get('version')}")
+            return False
+        age = time.time() - state["written"]
+        if age > self.max_age:
+            print(f"Ignoring checkpoint {self.path} from {age:.0f}s ago")
+            return False
+
+        client = self.client
+        if state["token"]["token"]:
+            # an expired token is replaced by the first request
+            client.store_token(state["token"])
+        if DEVICE_DISCOVERY:
+            # set directly, the device listeners would fetch the capacities of all of them
+            client.all_device_ids = state["devices"]
+            client.device_ids = [id for id in state["devices"] if client.shard.owns(id)]
+        if CAPACITY_ATTRIBUTES:
+            client.capacities.update({id: tuple(capacity) for id, capacity in state["capacities"].items()})
+
+        owned = set(client.device_ids)
+        updates = []
+        for id, lat, lon, pax, timestamp in state["vehicles"]:
+            if id not in owned:
+                continue
+            zone = client.geofences.find(lat, lon)
+            if zone is not None and zone.action == "suppress":
+                continue
+            occupancy, percentage = client.capacities.occupancy(id, pax)
+            updates.append((id, lat, lon, pax, occupancy, percentage, timestamp, zone, client.match_trip(id, lat, lon, timestamp)))
+        client.data.update_many(updates)
+        print(f"Restored {len(updates)} vehicles from the checkpoint of {age:.0f}s ago")
+        return True
+
+
+def record_first_publish():
+    """Sets startup_time to the seconds since the start of the process and returns them."""
+    seconds = time.monotonic() - STARTED
+    startup_time.set(seconds)
+    print(f"First message published {seconds:.2f}s after start")
+    return seconds
+
+
+class MQTTPublisher:
+    """Sends messages to the broker from its own thread through a bounded queue.
+
+    When the broker is slow, the oldest messages are dropped instead of piling up in
+    memory, and messages that waited too long are not sent at all since a newer
+    position of the same vehicle is already queued behind them.
+
+    paho accepts QoS 0 messages into an unbounded buffer and reports them published
+    right away, so the publisher only hands it more while fewer than MQTT_MAX_QUEUED
+    messages wait there to be written to the socket.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=MQTT_QUEUE_SIZE)
+        self.client = None
+        # notified by paho's network thread whenever it wrote a message
+        self.written = threading.Condition()
+        # seconds from the start of the process to the first message the client accepted
+        self.first_publish = None
+
+    def start(self, client):
+        client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+        client.max_queued_messages_set(MQTT_MAX_QUEUED)
+        client.on_publish = self.on_publish
+        self.client = client
+        Thread(target=self.run, name="mqtt-publisher", daemon=True).start()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        # JSON payloads are ASCII, so their length is their size in bytes
+        message_size.observe(len(payload))
+        message = (time.monotonic(), topic, payload, qos, retain)
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    dropped_messages.inc()
+                except queue.Empty:
+                    pass
+
+    def on_publish(self, client, userdata, mid):
+        with self.written:
+            self.written.notify()
+
+    def unwritten(self):
+        # paho has no public count of its outgoing packets, a reconnect empties them
+        return len(self.client._out_packet)
+
+    def run(self):
+        while True:
+            enqueued_at, topic, payload, qos, retain = self.queue.get()
+            with self.written:
+                # the timeout catches the buffer being emptied by a reconnect, which notifies nothing
+                while self.unwritten() >= MQTT_MAX_QUEUED:
+                    self.written.wait(0.1)
+            if time.monotonic() - enqueued_at > MQTT_MAX_MESSAGE_AGE:
+                stale_messages.inc()
+                continue
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                sent_messages.inc()
+                if self.first_publish is None:
+                    self.first_publish = record_first_publish()
+            else:
+                failed_messages.inc()
+
+    def backlog(self):
+        return self.queue.qsize()
+
+
+class TopicBuilder:
+    """Builds the /gtfsrt/vp topics of the vehicles.
+
+    /gtfsrt/vp/<feed_Id>/<agency_id>/<agency_name>/<mode>/<route_id>/<direction_id>/<trip_headsign>/<trip_id>/<next_stop>/<start_time>/<vehicle_id>/<geohash_head>/<geohash_firstdeg>/<geohash_seconddeg>/<geohash_thirddeg>/<short_name>
+
+    Everything around the geohash only changes with the trip of a vehicle, so it is kept
+    per vehicle and only the geohash is filled in for a new position.
+    """
+    PREFIX = "/gtfsrt/vp/hb/1/1"
+
+    def __init__(self):
+        # trip, topic up to the vehicle id and short name per vehicle
+        self.parts = {}
+
+    def topic(self, vehicle, geohash=None):
+        parts = self.parts.get(vehicle.id)
+        if parts is None or parts[0] != vehicle.trip:
+            parts = (vehicle.trip,) + self.build_parts(vehicle)
+            self.parts[vehicle.id] = parts
+        if geohash is None:
+            geohash = self.geohash(vehicle.latitude, vehicle.longitude)
+        return f"{parts[1]}/{geohash}/{parts[2]}"
+
+    def build_parts(self, vehicle):
+        trip = vehicle.trip
+        if trip is None:
+            return f"{self.PREFIX}/bus//0/unknown-headsign/unknown-trip-id/unknown-next-stop/00:00/{vehicle.id}", "0"
+        level = self.level
+        return (f"{self.PREFIX}/{trip.mode}/{level(trip.route_id)}/{trip.direction_id}/{level(trip.headsign)}/"
+            f"{level(trip.trip_id)}/{level(trip.stop_id)}/{trip.start_time[:5]}/{vehicle.id}"), level(trip.route_short_name) or "0"
+
+    def retain(self, ids):
+        self.parts = {id: parts for id, parts in self.parts.items() if id in ids}
+
+    @staticmethod
+    def level(value):
+        # GTFS ids and headsigns may contain characters that have a meaning in MQTT topics
+        return value.replace("/", "_").replace("+", "_").replace("#", "_")
+
+    @staticmethod
+    def geohash(lat, lon):
+        """Digitransit's geohash levels: the whole degrees, then a digit of latitude and
+        longitude for each of the first three decimals, e.g. 48;8/68/41/17."""
+        # rounded to micro degrees first, so that 48.6 doesn't become 48.599...
+        lat_millis = round(abs(lat) * 1000000) // 1000
+        lon_millis = round(abs(lon) * 1000000) // 1000
+        return (f"{'-' if lat < 0 else ''}{lat_millis // 1000};{'-' if lon < 0 else ''}{lon_millis // 1000}/"
+            f"{lat_millis // 100 % 10}{lon_millis // 100 % 10}/{lat_millis // 10 % 10}{lon_millis // 10 % 10}/"
+            f"{lat_millis % 10}{lon_millis % 10}")
+
+    @staticmethod
+    def geohashes(lats, lons):
+        """geohash of every position of the two NumPy arrays."""
+        lat_millis = numpy.rint(numpy.abs(lats) * 1000000).astype(numpy.int64) // 1000
+        lon_millis = numpy.rint(numpy.abs(lons) * 1000000).astype(numpy.int64) // 1000
+        heads = zip(numpy.where(lats < 0, "-", "").tolist(), (lat_millis // 1000).tolist(),
+            numpy.where(lons < 0, "-", "").tolist(), (lon_millis // 1000).tolist())
+        # the three decimal levels as one number each, e.g. 64 for latitude .6x and longitude .x4
+        levels = zip(*((lat_millis // divisor % 10 * 10 + lon_millis // divisor % 10).tolist() for divisor in (100, 10, 1)))
+        return [f"{lat_sign}{lat_head};{lon_sign}{lon_head}/{first:02d}/{second:02d}/{third:02d}"
+            for (lat_sign, lat_head, lon_sign, lon_head), (first, second, third) in zip(heads, levels)]
+
+
+class LeaderElection:
+    """Active/standby election through a retained lease on LEADER_TOPIC.
+
+    The lease names the leader, when it claimed the lease and until when it is valid. The
+    leader's last will is an expired lease in its name, so the standbys take over as soon
+    as the broker notices it is gone, and at the latest when the lease runs out. MQTT has
+    no compare-and-set, so when two instances claim the lease at once the earlier claim
+    wins and the other one steps down on the first lease it receives.
+    """
+
+    def __init__(self, id, on_elected):
+        self.id = id
+        # called, from the MQTT network thread, when this instance becomes the leader
+        self.on_elected = on_elected
+        self.leader = False
+        self.since = None
+        # the current lease of another instance, None when there is none
+        self.lease = None
+        self.client = None
+        self.connected = False
+        self.lock = threading.Lock()
+
+    def attach(self, client):
+        self.client = client
+        client.message_callback_add(LEADER_TOPIC, self.on_message)
+        # set on every instance, the lease it expires only counts while its sender leads
+        client.will_set(LEADER_TOPIC, self.payload(0, 0), qos=1, retain=True)
+
+    def payload(self, since, expires):
+        return json.dumps({"leader": self.id, "since": since, "expires": expires})
 
-    def loop():
-        while not stopped.wait(interval):  # the first call is in `interval` secs
-            func(*args)
-        print("Polling stopped")
+    def on_connect(self, client):
+        with self.lock:
+            self.connected = True
+            self.lease = None
+        client.subscribe(LEADER_TOPIC, qos=1)
 
-    threading.excepthook = exception_hook
-    Thread(target=loop, daemon=True).start()
-    return stopped.set
+    def on_disconnect(self):
+        # the lease can't be renewed without a connection, a standby takes over
+        with self.lock:
+            self.connected = False
+            if self.leader:
+                print("Lost the MQTT connection, stepping down as leader")
+            self.step_down()
+
+    def on_message(self, client, userdata, message):
+        try:
+            lease = json.loads(message.payload)
+            leader, since, expires = lease["leader"], lease["since"], lease["expires"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring invalid leader lease %r", message.payload)
+            return
+        if leader == self.id:
+            return
+        elected = False
+        with self.lock:
+            if expires <= time.time():
+                # The last will of an instance, which replaced the retained lease. Only the
+                # one of the current leader counts, otherwise the leader restores its lease.
+                if self.leader:
+                    self.renew()
+                elif self.lease is not None and self.lease["leader"] == leader:
+                    print(f"Leader {leader} is gone, taking over")
+                    self.claim()
+                    elected = True
+            elif self.leader:
+                if (since, leader) < (self.since, self.id):
+                    print(f"{leader} claimed the lease before us, stepping down")
+                    self.step_down()
+                    self.lease = lease
+                else:
+                    # the other one steps down when it receives our lease
+                    self.renew()
+            else:
+                if self.lease is None or self.lease["leader"] != leader:
+                    print(f"Standing by for leader {leader}")
+                self.lease = lease
+        if elected:
+            self.on_elected()
+
+    def heartbeat(self):
+        elected = False
+        with self.lock:
+            if not self.connected:
+                return
+            if self.leader:
+                self.renew()
+            elif self.lease is None or self.lease["expires"] <= time.time():
+                print("No valid leader lease, taking over")
+                self.claim()
+                elected = True
+        if elected:
+            self.on_elected()
+
+    def claim(self):
+        self.leader = True
+        self.since = time.time()
+        self.lease = None
+        leader_state.set(1)
+        leader_takeovers.inc()
+        self.renew()
+
+    def renew(self):
+        self.client.publish(LEADER_TOPIC, self.payload(self.since, time.time() + LEADER_LEASE_TIME), qos=1, retain=True)
+
+    def step_down(self):
+        self.leader = False
+        self.since = None
+        leader_state.set(0)
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != "/gtfs-rt/vehicle-positions.pb":
+            self.send_error(404)
+            return
+        body = self.server.transformer.aggregate_payload()
+        if body is None:
+            self.send_error(503, "No vehicle data yet")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
 
 
 class GTFSRTHTTP2MQTTTransformer:
-    def __init__(self, mqttConnect, mqttCredentials):
+    def __init__(self, mqttConnect, mqttCredentials, start_polling=True, elect_leader=True):
         self.mqttConnect = mqttConnect
         self.mqttCredentials = mqttCredentials
         self.mqttConnected = False
-        self.startThingsboardPolling()
+        self.mqttConnectedBefore = False
+        self.publisher = MQTTPublisher()
+        self.subscriber = None
+        # state and monotonic time of the last publish per vehicle
+        self.published = {}
+        # topic and encoded entity per vehicle, keyed by the vehicle state they were built from
+        self.payloads = {}
+        # incremented whenever an entity is rebuilt or a vehicle is dropped
+        self.payloads_version = 0
+        self.topics = TopicBuilder()
+        # The caches above and the aggregate are changed by the publish tick and, with the
+        # websocket, by the websocket thread for every update, one of them at a time.
+        self.publish_lock = threading.Lock()
+        self.header_cache = None
+        self.aggregate = None
+        self.last_tick = None
+        # the asyncio runtime has no election, it always polls and publishes
+        self.election = LeaderElection(LEADER_ID, self.onElected) if LEADER_ELECTION and elect_leader else None
+        # the start of the leader term whose takeover poll finished
+        self.takeover_polled = None
+        if SHARDING == "mqtt":
+            self.replicas = {SHARD_REPLICA_ID}
+            self.reshard = Event()
+            Thread(target=self.reshard_loop, name="reshard", daemon=True).start()
+        self.checkpoint = Checkpoint(CHECKPOINT_FILE, thingsboard_client) if CHECKPOINT_FILE else None
+        if HTTP_PORT:
+            self.startHTTPServer(int(HTTP_PORT))
+        if start_polling:
+            self.startThingsboardPolling()
         print("Connecting to MQTT")
 
     def onMQTTConnected(self, client, userdata, flags, rc):
@@ -125,74 +2031,613 @@ class GTFSRTHTTP2MQTTTransformer:
             return False
         if self.mqttConnected is True:
             print("Reconnecting and restarting poller")
+        if self.mqttConnectedBefore:
+            mqtt_reconnects.inc()
         self.mqttConnected = True
+        self.mqttConnectedBefore = True
+        if SHARDING == "mqtt":
+            # The retained announcements of all replicas arrive right after subscribing, our
+            # own last. Replicas that left while we were disconnected don't show up again.
+            self.replicas = {SHARD_REPLICA_ID}
+            client.subscribe(f"{SHARD_TOPIC}/+", qos=1)
+            client.publish(f"{SHARD_TOPIC}/{SHARD_REPLICA_ID}", SHARD_REPLICA_ID, qos=1, retain=True)
+        if self.election is not None:
+            self.election.on_connect(client)
+
+    def onMQTTDisconnected(self, client, userdata, rc):
+        if self.election is not None:
+            self.election.on_disconnect()
+
+    def onElected(self):
+        # The standby didn't poll, so its vehicles are stale. It polls right away instead of
+        # waiting for the next poll tick and only publishes once that poll finished.
+        Thread(target=self.take_over, args=(self.election.since,), name="takeover", daemon=True).start()
+
+    def take_over(self, since):
+        try:
+            self.update_thingsboard()
+        finally:
+            self.takeover_polled = since
+
+    def is_active(self):
+        return self.election is None or self.election.leader
+
+    def is_publishing(self):
+        # compared to the term, so that a takeover poll from an earlier term doesn't count
+        return self.election is None or (self.election.leader and self.takeover_polled == self.election.since)
+
+    def onReplicaMessage(self, client, userdata, message):
+        # an empty retained message, e.g. the last will of a replica, means it is gone
+        replica = message.topic.rsplit("/", 1)[1]
+        if message.payload:
+            replicas = self.replicas | {replica}
+        else:
+            replicas = self.replicas - {replica}
+        # replaced as a whole, the reshard thread always sees a complete set
+        self.replicas = replicas | {SHARD_REPLICA_ID}
+        # Resharding may fetch the capacities of added devices, which must not block paho's
+        # network thread. The announcements arriving together result in one reshard.
+        self.reshard.set()
+
+    def reshard_loop(self):
+        while True:
+            self.reshard.wait()
+            self.reshard.clear()
+            thingsboard_client.update_replicas(self.replicas)
 
     def connectMQTT(self):
         self.client = mqtt.Client()
         self.client.enable_logger(logger)
 
         self.client.on_connect = self.onMQTTConnected
+        self.client.on_disconnect = self.onMQTTDisconnected
+        if SHARDING == "mqtt":
+            self.client.message_callback_add(f"{SHARD_TOPIC}/+", self.onReplicaMessage)
+            # clears our announcement when we lose the connection without saying goodbye
+            self.client.will_set(f"{SHARD_TOPIC}/{SHARD_REPLICA_ID}", None, qos=1, retain=True)
         self.client.tls_set(cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS)
 
+        if self.election is not None:
+            self.election.attach(self.client)
+
         self.client.username_pw_set(**self.mqttCredentials)
-        self.client.connect(**self.mqttConnect)
+        if self.election is not None:
+            # the broker sends the last will of a silent leader after 1.5 keepalive intervals
+            self.client.connect(**self.mqttConnect, keepalive=max(1, int(LEADER_HEARTBEAT_INTERVAL)))
+        else:
+            self.client.connect(**self.mqttConnect)
+        self.publisher.start(self.client)
         self.client.loop_forever()
 
+    def startHTTPServer(self, port):
+        server = ThreadingHTTPServer(("", port), FeedRequestHandler)
+        server.daemon_threads = True
+        server.transformer = self
+        Thread(target=server.serve_forever, name="http", daemon=True).start()
+        print(f"Serving GTFS-RT feed and metrics on port {port}")
+
     def update_thingsboard(self):
+        if not self.is_active():
+            return
+        if self.subscriber is not None and self.subscriber.connected:
+            return
         thingsboard_client.fetch_vehicle_data()
 
+    def first_poll(self):
+        if DEVICE_DISCOVERY:
+            thingsboard_client.discover_devices()
+        if CAPACITY_ATTRIBUTES:
+            thingsboard_client.fetch_capacities()
+        thingsboard_client.fetch_vehicle_data()
+
+    def save_checkpoint(self):
+        # a standby doesn't poll, its stale store must not replace the leader's checkpoint
+        if self.is_publishing():
+            self.checkpoint.save()
+
     def startThingsboardPolling(self):
         print("Starting Thingsboard poller")
-        thingsboard_client.fetch_vehicle_data()
-        call_repeatedly(15, self.update_thingsboard)
-        self.ThingsboardPoller = call_repeatedly(1, self.publish_to_mqtt)
-
-    def calculate_occupancy(self, pax):
-        percent_full = pax / 60 * 100
-        if (percent_full < 50):
-            return "MANY_SEATS_AVAILABLE"
-        elif (percent_full < 85):
-            return "FEW_SEATS_AVAILABLE"
+        if self.checkpoint is not None and self.checkpoint.restore():
+            # the restored vehicles are published as soon as MQTT is connected, the first
+            # poll catches up in the background
+            Thread(target=self.first_poll, name="first-poll", daemon=True).start()
         else:
-            return "STANDING_ROOM_ONLY"
+            self.first_poll()
+        if DEVICE_DISCOVERY:
+            scheduler.add("discovery", DEVICE_DISCOVERY_INTERVAL, thingsboard_client.discover_devices, jitter=POLL_JITTER)
+        if INGESTION_MODE == "websocket":
+            thingsboard_client.listeners.append(self.publish_vehicle_update)
+            self.subscriber = ThingsboardSubscriber(thingsboard_client)
+            self.subscriber.start()
+        scheduler.add("poll", POLL_INTERVAL, self.update_thingsboard, overrun=POLL_OVERRUN, jitter=POLL_JITTER)
+        scheduler.add("token", TOKEN_CHECK_INTERVAL, thingsboard_client.refresh_token_if_expiring)
+        if CAPACITY_ATTRIBUTES:
+            scheduler.add("capacities", CAPACITY_REFRESH_INTERVAL, thingsboard_client.fetch_capacities, jitter=POLL_JITTER)
+        if self.election is not None:
+            scheduler.add("leader", LEADER_HEARTBEAT_INTERVAL, self.election.heartbeat)
+        if self.checkpoint is not None:
+            scheduler.add("checkpoint", CHECKPOINT_INTERVAL, self.save_checkpoint)
+        self.ThingsboardPoller = scheduler.add("publish", PUBLISH_INTERVAL, self.publish_to_mqtt)
 
     def publish_to_mqtt(self):
+        if not self.is_publishing():
+            return
 
-        vehicles = thingsboard_client.get_vehicles()
+        started = time.perf_counter()
+        now = time.monotonic()
+        if self.last_tick is not None:
+            tick_jitter.set(now - self.last_tick - PUBLISH_INTERVAL)
+        self.last_tick = now
 
+        # the poller keeps updating the store, everything below works on one consistent snapshot
+        snapshot = thingsboard_client.data.snapshot()
+        snapshot_age.set(now - snapshot.updated)
+        vehicles = snapshot.vehicles
+
+        if BATCH_TRANSFORM and numpy is not None:
+            with self.publish_lock:
+                self.encode_changed(vehicles)
         for vehicle in vehicles:
+            # taken per vehicle, so that websocket updates don't wait for the whole tick
+            with self.publish_lock:
+                if not self.is_due(vehicle, now):
+                    suppressed_publishes.inc()
+                    continue
+                self.publish_vehicle(vehicle)
+
+        self.count_zone_vehicles(vehicles)
+
+        with self.publish_lock:
+            if len(self.payloads) > len(vehicles):
+                # forget vehicles that are no longer reported
+                ids = set(vehicle.id for vehicle in vehicles)
+                self.payloads = {id: payload for id, payload in self.payloads.items() if id in ids}
+                self.published = {id: published for id, published in self.published.items() if id in ids}
+                self.topics.retain(ids)
+                self.payloads_version += 1
+
+            if AGGREGATE_TOPIC or HTTP_PORT:
+                self.update_aggregate(vehicles)
+
+        if PUBLISH_ONLY_CHANGES:
+            logger.debug(f"{suppressed_publishes.value} unchanged vehicle publishes suppressed so far")
+        logger.debug(f"{self.publisher.backlog()} messages queued, {dropped_messages.value} dropped, "
+            f"{stale_messages.value} stale, {failed_messages.value} failed")
+        logger.debug(f"Published snapshot {snapshot.version} of age {snapshot_age.value:.1f}s, "
+            f"tick jitter {tick_jitter.value * 1000:.0f}ms")
+        tick_time.observe(time.perf_counter() - started)
+
+    def count_zone_vehicles(self, vehicles):
+        counts = {}
+        for vehicle in vehicles:
+            if vehicle.zone is not None:
+                counts[vehicle.zone] = counts.get(vehicle.zone, 0) + 1
+        # every zone is set, so that the ones the last vehicle left go back to 0
+        for zone in thingsboard_client.geofences.zones:
+            if zone.vehicles is not None:
+                zone.vehicles.set(counts.get(zone, 0))
+
+    def vehicle_state(self, vehicle):
+        return vehicle.version
 
+    def is_due(self, vehicle, now):
+        zone = vehicle.zone
+        if zone is not None and zone.action == "reduce":
+            last = self.published.get(vehicle.id)
+            return last is None or now - last[1] >= zone.publish_interval
+        if PUBLISH_ONLY_CHANGES:
+            return self.has_changed(vehicle, now)
+        return True
+
+    def has_changed(self, vehicle, now):
+        last = self.published.get(vehicle.id)
+        if last is None:
+            return True
+        state, published_at = last
+        return state != self.vehicle_state(vehicle) or now - published_at >= HEARTBEAT_INTERVAL
+
+    def publish_vehicle_update(self, vehicle):
+        if not self.mqttConnected or not self.is_publishing():
+            return
+        with self.publish_lock:
+            if not self.is_due(vehicle, time.monotonic()):
+                return
+            self.publish_vehicle(vehicle)
+        latency = time.time() * 1000 - vehicle.timestamp
+        logger.debug(f"Published update of {vehicle.id} {latency:.0f} ms after its telemetry timestamp")
+
+    def header_payload(self):
+        # the header is the same for all vehicles published within the same second
+        timestamp = int(time.time())
+        if self.header_cache is None or self.header_cache[0] != timestamp:
             nfeedmsg = gtfs_realtime_pb2.FeedMessage()
             nfeedmsg.header.gtfs_realtime_version = "1.0"
             nfeedmsg.header.incrementality = nfeedmsg.header.DIFFERENTIAL
-            nfeedmsg.header.timestamp = int(time.time())
-            ent = nfeedmsg.entity.add()
-            ent.id = vehicle["id"]
-            trip = ent.vehicle.trip.trip_id = "unknown-trip-id"
-            ent.vehicle.position.latitude = vehicle['latitude']
-            ent.vehicle.position.longitude = vehicle['longitude']
-            ent.vehicle.vehicle.id = vehicle['id']
+            nfeedmsg.header.timestamp = timestamp
+            header_json = dump_json({
+                "gtfsRealtimeVersion": "1.0",
+                "incrementality": "DIFFERENTIAL",
+                "timestamp": str(timestamp)
+            })
+            self.header_cache = (timestamp, nfeedmsg.SerializeToString(), header_json)
+        return self.header_cache[1], self.header_cache[2]
+
+    def encode_changed(self, vehicles):
+        # With the batch transform, the geohashes of all vehicles whose entity has to be
+        # rebuilt are computed at once before they are encoded one by one.
+        changed = [vehicle for vehicle in vehicles
+            if self.payloads.get(vehicle.id, (None,))[0] != self.vehicle_state(vehicle)]
+        if len(changed) < BATCH_TRANSFORM_MIN_SIZE:
+            return
+        geohashes = TopicBuilder.geohashes(
+            numpy.fromiter((vehicle.latitude for vehicle in changed), numpy.float64, len(changed)),
+            numpy.fromiter((vehicle.longitude for vehicle in changed), numpy.float64, len(changed)))
+        for vehicle, geohash in zip(changed, geohashes):
+            self.entity_payload(vehicle, geohash)
+
+    def entity_payload(self, vehicle, geohash=None):
+        # the encoded entity only changes with the vehicle state, so it is built once per
+        # state version and combined with the current header on every publish
+        state = self.vehicle_state(vehicle)
+        cached = self.payloads.get(vehicle.id)
+        if cached is None or cached[0] != state:
+            started = time.perf_counter()
+            cached = (state,) + self.encode_entity(vehicle, geohash)
+            encode_time.observe(time.perf_counter() - started)
+            self.payloads[vehicle.id] = cached
+            self.payloads_version += 1
+        return cached[1:]
+
+    def update_aggregate(self, vehicles):
+        # The full feed is only re-encoded when one of the entities changed, all readers
+        # share the cached bytes until then.
+        entities = [self.entity_payload(vehicle)[1] for vehicle in vehicles]
+        if self.aggregate is not None and self.aggregate[0] == self.payloads_version:
+            return
+
+        nfeedmsg = gtfs_realtime_pb2.FeedMessage()
+        nfeedmsg.header.gtfs_realtime_version = "1.0"
+        nfeedmsg.header.incrementality = nfeedmsg.header.FULL_DATASET
+        nfeedmsg.header.timestamp = int(time.time())
+        self.aggregate = (self.payloads_version, nfeedmsg.SerializeToString() + b"".join(entities))
+
+        if AGGREGATE_TOPIC:
+            self.publisher.publish(AGGREGATE_TOPIC, self.aggregate[1], qos=MQTT_QOS_GTFSRT, retain=True)
+
+    def aggregate_payload(self):
+        aggregate = self.aggregate
+        return aggregate[1] if aggregate is not None else None
+
+    def encode_entity(self, vehicle, geohash=None):
+        nfeedmsg = gtfs_realtime_pb2.FeedMessage()
+        ent = nfeedmsg.entity.add()
+        ent.id = vehicle.id
+        trip = vehicle.trip
+        if trip is not None:
+            ent.vehicle.trip.trip_id = trip.trip_id
+            ent.vehicle.trip.start_time = trip.start_time
+            ent.vehicle.trip.start_date = trip.start_date
+            ent.vehicle.trip.route_id = trip.route_id
+            ent.vehicle.trip.direction_id = trip.direction_id
+        else:
+            ent.vehicle.trip.trip_id = "unknown-trip-id"
+        ent.vehicle.position.latitude = vehicle.latitude
+        ent.vehicle.position.longitude = vehicle.longitude
+        if trip is not None:
+            ent.vehicle.current_stop_sequence = trip.stop_sequence
+            ent.vehicle.stop_id = trip.stop_id
+        ent.vehicle.vehicle.id = vehicle.id
+
+        occupancy = vehicle.occupancy
+        ent.vehicle.occupancy_status = occupancy
+        ent.vehicle.occupancy_percentage = vehicle.occupancy_percentage
+
+        full_topic = self.topics.topic(vehicle, geohash)
+
+        # without the header the message is incomplete, but its bytes are exactly the
+        # encoded entity field that follows the header in the published feed
+        return full_topic, nfeedmsg.SerializePartialToString(), self.entity_json(vehicle, occupancy)
+
+    def entity_json(self, vehicle, occupancy):
+        # Same field names, field order and enum names as MessageToJson of the entity, built
+        # straight from the vehicle instead of walking the message descriptors. The pinned
+        # protobuf renders the coordinates as the doubles they were set to, so do we.
+        trip = vehicle.trip
+        position = {
+            "trip": {"tripId": "unknown-trip-id"},
+            "position": {
+                "latitude": vehicle.latitude,
+                "longitude": vehicle.longitude
+            }
+        }
+        if trip is not None:
+            position["trip"] = {
+                "tripId": trip.trip_id,
+                "startTime": trip.start_time,
+                "startDate": trip.start_date,
+                "routeId": trip.route_id,
+                "directionId": trip.direction_id
+            }
+            position["currentStopSequence"] = trip.stop_sequence
+            position["stopId"] = trip.stop_id
+        position["vehicle"] = {"id": vehicle.id}
+        position["occupancyStatus"] = gtfs_realtime_pb2.VehiclePosition.OccupancyStatus.Name(occupancy)
+        position["occupancyPercentage"] = vehicle.occupancy_percentage
+        return dump_json({"id": vehicle.id, "vehicle": position})
+
+    def publish_vehicle(self, vehicle):
+        vehicle_publishes.inc()
+        state = self.vehicle_state(vehicle)
+        last = self.published.get(vehicle.id)
+        if last is None or last[0] != state:
+            publish_latency.observe(time.time() - vehicle.timestamp / 1000)
+        self.published[vehicle.id] = (state, time.monotonic())
+
+        header_bytes, header_json = self.header_payload()
+        full_topic, entity_bytes, entity_json = self.entity_payload(vehicle)
+
+        self.publisher.publish(full_topic, header_bytes + entity_bytes, qos=MQTT_QOS_GTFSRT)
+
+        json = f'{{"header":{header_json},"entity":[{entity_json}]}}'
+        self.publisher.publish(f'/json/vp/{vehicle.id}', json, qos=MQTT_QOS_JSON)
+
+class AsyncMQTTPublisher:
+    """Bounded outbound queue like MQTTPublisher, drained by a task on the event loop."""
 
-            pax = vehicle["pax"]
-            occupancy = gtfs_realtime_pb2.VehiclePosition.OccupancyStatus.Value(self.calculate_occupancy(pax))
-            ent.vehicle.occupancy_status = occupancy
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=MQTT_QUEUE_SIZE)
+        self.first_publish = None
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        # JSON payloads are ASCII, so their length is their size in bytes
+        message_size.observe(len(payload))
+        message = (time.monotonic(), topic, payload, qos, retain)
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except asyncio.QueueFull:
+                try:
+                    self.queue.get_nowait()
+                    dropped_messages.inc()
+                except asyncio.QueueEmpty:
+                    pass
+
+    async def run(self, client):
+        while True:
+            enqueued_at, topic, payload, qos, retain = await self.queue.get()
+            if time.monotonic() - enqueued_at > MQTT_MAX_MESSAGE_AGE:
+                stale_messages.inc()
+                continue
+            try:
+                await client.publish(topic, payload, qos=qos, retain=retain)
+            except aiomqtt.MqttError:
+                failed_messages.inc()
+                raise
+            sent_messages.inc()
+            if self.first_publish is None:
+                self.first_publish = record_first_publish()
 
-            #percent_full = pax / 60 * 100
-            #ent.vehicle.occupancy_percentage = percent_full
+    def backlog(self):
+        return self.queue.qsize()
 
-            # /gtfsrt/vp/<feed_Id>/<agency_id>/<agency_name>/<mode>/<route_id>/<direction_id>/<trip_headsign>/<trip_id>/<next_stop>/<start_time>/<vehicle_id>/<geo_hash>/<short_name>
-            full_topic = f'/gtfsrt/vp/hb/1/1/bus//0/unknown-headsign/unknown-trip-id/unknown-next-stop/00:00/{ vehicle["id"] }/0/0'
 
-            sernmesg = nfeedmsg.SerializeToString()
-            self.client.publish(full_topic, sernmesg)
+class AsyncRuntime:
+    """Runs fetching, transformation and publishing as tasks on one asyncio event loop.
 
-            json = MessageToJson(nfeedmsg)
-            self.client.publish(f'/json/vp/{vehicle["id"]}', json)
+    Device telemetry is fetched with aiohttp and published with an asyncio MQTT client.
+    Login, token refresh and device discovery reuse the ThingsboardClient on worker
+    threads, they only run every few minutes. The vehicle state and all payloads are
+    shared with the threaded mode.
+    """
+
+    def __init__(self, mqttConnect, mqttCredentials):
+        self.mqttConnect = mqttConnect
+        self.mqttCredentials = mqttCredentials
+        self.transformer = GTFSRTHTTP2MQTTTransformer(mqttConnect, mqttCredentials, start_polling=False, elect_leader=False)
+
+    async def fetch_timeseries(self, session, id, token, retry=True):
+        auth_headers = {
+            "X-Authorization": f"Bearer {token}"
+        }
+        timeseries_url = f"{thingsboard_client.base_url}/plugins/telemetry/DEVICE/{id}/values/timeseries"
+        params = {"keys": ",".join(TELEMETRY_KEYS)}
+        async with self.fetch_slots:
+            started = time.perf_counter()
+            try:
+                async with session.get(timeseries_url, params=params, headers=auth_headers,
+                        timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as resp:
+                    status = resp.status
+                    if(status == 200):
+                        return await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                fetch_failures.inc()
+                print(f"Data for device {id} could not be fetched: {e!r}")
+                return None
+            finally:
+                device_fetch_time.observe(time.perf_counter() - started)
+        if(status == 401 and retry):
+            token = await asyncio.to_thread(thingsboard_client.renew_token, token)
+            return await self.fetch_timeseries(session, id, token, retry=False)
+        fetch_failures.inc()
+        print(f"Data for device {id} could not be fetched")
+        return None
+
+    async def fetch_latest_telemetry(self, session, ids, token):
+        query_url = f"{thingsboard_client.base_url}/entitiesQuery/find"
+        query = thingsboard_client.latest_telemetry_query(ids)
+
+        results = {}
+        retry = True
+        while True:
+            auth_headers = {
+                "X-Authorization": f"Bearer {token}"
+            }
+            started = time.perf_counter()
+            try:
+                async with session.post(query_url, json=query, headers=auth_headers,
+                        timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as resp:
+                    status = resp.status
+                    page = await resp.json() if status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                fetch_failures.inc()
+                print(f"Data for devices could not be fetched: {e!r}")
+                return results
+            finally:
+                bulk_fetch_time.observe(time.perf_counter() - started)
+            if(status == 401 and retry):
+                token = await asyncio.to_thread(thingsboard_client.renew_token, token)
+                retry = False
+                continue
+            if(page is None):
+                fetch_failures.inc()
+                print(f"Data for devices could not be fetched ({status})")
+                return results
+
+            thingsboard_client.parse_latest_telemetry(page, results)
+            if not page.get("hasNext"):
+                return results
+            query["pageLink"]["page"] += 1
+
+    async def fetch_vehicle_data(self, session):
+        started = time.perf_counter()
+        token = await asyncio.to_thread(thingsboard_client.get_token)
+        ids = list(thingsboard_client.device_ids)
+        if FETCH_MODE == "bulk":
+            latest = await self.fetch_latest_telemetry(session, ids, token)
+            results = [latest.get(id) for id in ids]
+        else:
+            # like the threaded poll, devices queued behind hanging ones don't hold up the next poll
+            tasks = [asyncio.create_task(self.fetch_timeseries(session, id, token)) for id in ids]
+            done, pending = await asyncio.wait(tasks, timeout=POLL_INTERVAL) if tasks else (set(), set())
+            if pending:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                fetch_failures.inc(len(pending))
+                print(f"Data for {len(pending)} devices could not be fetched within {POLL_INTERVAL}s")
+            results = [task.result() if task in done else None for task in tasks]
+        poll_time.observe(time.perf_counter() - started)
+        thingsboard_client.update_vehicles(ids, results)
+
+    async def every(self, job):
+        # the same fixed-rate deadlines and overrun handling as the threaded Scheduler
+        loop = asyncio.get_running_loop()
+        job.next_run = loop.time() + job.interval + job.offset
+        while True:
+            await asyncio.sleep(max(job.next_run - loop.time(), 0))
+            started = loop.time()
+            job.lag.observe(max(started - job.next_run, 0))
+            await job.func()
+            finished = loop.time()
+            job.duration.observe(finished - started)
+            job.next_run = scheduler.next_deadline(job, finished)
+
+    def job(self, name, interval, func, overrun="skip", jitter=0):
+        job = Job(name, interval, func, overrun, random.uniform(0, jitter))
+        scheduler.jobs.append(job)
+        return asyncio.create_task(self.every(job), name=name)
+
+    async def connect_mqtt(self):
+        connected_before = False
+        while True:
+            try:
+                async with aiomqtt.Client(self.mqttConnect['host'], self.mqttConnect['port'],
+                        tls_context=ssl.create_default_context(),
+                        max_inflight_messages=MQTT_MAX_INFLIGHT,
+                        max_queued_messages=MQTT_MAX_QUEUED,
+                        logger=logger,
+                        **self.mqttCredentials) as client:
+                    print("Connected to MQTT")
+                    if connected_before:
+                        mqtt_reconnects.inc()
+                    connected_before = True
+                    self.transformer.mqttConnected = True
+                    await self.publisher.run(client)
+            except aiomqtt.MqttError as e:
+                self.transformer.mqttConnected = False
+                print(f"MQTT connection lost: {e}, reconnecting in {MQTT_RECONNECT_DELAY}s")
+                await asyncio.sleep(MQTT_RECONNECT_DELAY)
+
+    async def run(self):
+        if INGESTION_MODE == "websocket":
+            print("Websocket ingestion is not supported in asyncio mode, polling instead")
+        if SHARDING == "mqtt":
+            print("MQTT coordinated sharding is not supported in asyncio mode, polling all devices")
+        if LEADER_ELECTION:
+            print("Leader election is not supported in asyncio mode, polling and publishing without it")
+        # created here so that they belong to the running loop
+        self.fetch_slots = asyncio.Semaphore(FETCH_CONCURRENCY)
+        self.publisher = AsyncMQTTPublisher()
+        self.transformer.publisher = self.publisher
+
+        async def publish():
+            self.transformer.publish_to_mqtt()
+
+        async def discover():
+            await asyncio.to_thread(thingsboard_client.discover_devices)
+
+        async def refresh_token():
+            await asyncio.to_thread(thingsboard_client.refresh_token_if_expiring)
+
+        async def refresh_capacities():
+            await asyncio.to_thread(thingsboard_client.fetch_capacities)
+
+        async def save_checkpoint():
+            await asyncio.to_thread(self.transformer.checkpoint.save)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=FETCH_CONCURRENCY)) as session:
+            async def first_poll():
+                if DEVICE_DISCOVERY:
+                    await discover()
+                if CAPACITY_ATTRIBUTES:
+                    await refresh_capacities()
+                await self.fetch_vehicle_data(session)
+
+            print("Starting Thingsboard poller")
+            checkpoint = self.transformer.checkpoint
+            restored = checkpoint is not None and await asyncio.to_thread(checkpoint.restore)
+            if not restored:
+                await first_poll()
+
+            tasks = [
+                asyncio.create_task(self.connect_mqtt(), name="mqtt"),
+                self.job("poll", POLL_INTERVAL, lambda: self.fetch_vehicle_data(session), overrun=POLL_OVERRUN, jitter=POLL_JITTER),
+                self.job("token", TOKEN_CHECK_INTERVAL, refresh_token),
+                self.job("publish", PUBLISH_INTERVAL, publish)
+            ]
+            if DEVICE_DISCOVERY:
+                tasks.append(self.job("discovery", DEVICE_DISCOVERY_INTERVAL, discover, jitter=POLL_JITTER))
+            if CAPACITY_ATTRIBUTES:
+                tasks.append(self.job("capacities", CAPACITY_REFRESH_INTERVAL, refresh_capacities, jitter=POLL_JITTER))
+            if checkpoint is not None:
+                tasks.append(self.job("checkpoint", CHECKPOINT_INTERVAL, save_checkpoint))
+            if restored:
+                # the restored vehicles are published while the first poll catches up
+                tasks.append(asyncio.create_task(first_poll(), name="first-poll"))
+            try:
+                # the first task that fails ends the service, all others are cancelled with it
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
 if __name__ == '__main__':
-    gh2mt = GTFSRTHTTP2MQTTTransformer(
-        {'host': os.environ['MQTT_BROKER_URL'], 'port': 8883},
-        {'username': os.environ['MQTT_USER'], 'password': os.environ['MQTT_PASSWORD'],}
-    )
+    if PROFILE_FILE:
+        SamplingProfiler(PROFILE_FILE).start()
+
+    mqttConnect = {'host': os.environ['MQTT_BROKER_URL'], 'port': 8883}
+    mqttCredentials = {'username': os.environ['MQTT_USER'], 'password': os.environ['MQTT_PASSWORD'],}
+
+    if LEADER_ELECTION and SHARDING == "mqtt" and RUNTIME_MODE != "asyncio":
+        # paho keeps one last will per client, the expired lease would replace the one clearing our announcement
+        print("LEADER_ELECTION can't be combined with SHARDING=mqtt")
+        sys.exit(1)
+
+    if RUNTIME_MODE == "asyncio":
+        asyncio.run(AsyncRuntime(mqttConnect, mqttCredentials).run())
+    else:
+        gh2mt = GTFSRTHTTP2MQTTTransformer(mqttConnect, mqttCredentials)
 
-    gh2mt.connectMQTT()
+        gh2mt.connectMQTT()